@@ -0,0 +1,353 @@
+"""End-to-end ingest benchmark.
+
+Publishes synthetic sensor readings from many devices at a fixed rate and
+reports sustained throughput, publish -> DB commit and publish -> WebSocket
+delivery latency (p50/p99), and memory growth.
+
+Brokers:
+    fake            messages are handed straight to MQTTClient.onMessage, as the
+                    paho network thread would (no network, no broker needed)
+    HOST[:PORT]     a local broker such as mosquitto; the benchmark publishes to
+                    it with its own paho client and the historian subscribes
+
+Stages:
+    pipeline        onMessage -> parse -> persist -> fan out (the full path)
+    storage         saveMessage only, to isolate the database writer
+
+    python benchmarks/ingestBenchmark.py --rate 10000 --devices 5000 --duration 20
+    python benchmarks/ingestBenchmark.py --broker localhost:1883 --rate 1000
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import database
+from database import initDatabase, writer, saveMessage, getWriterStats
+
+SENSOR_TYPES = ['temperature', 'humidity', 'pressure', 'voltage']
+TOPIC_PREFIX = 'codePower/bench'
+
+# How often the publisher tops up to the target rate
+PUBLISH_TICK = 0.001
+
+# Every Nth committed row has its payload decoded for the commit latency sample
+COMMIT_SAMPLE_EVERY = 10
+
+FakeMessage = namedtuple('FakeMessage', ['topic', 'payload', 'qos', 'retain'])
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def currentRssMb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except (OSError, ValueError):
+        # Peak rather than current, but still shows growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class FleetPublisher:
+    """Publishes one reading per device in turn at `rate` messages per second"""
+
+    def __init__(self, rate, devices, duration, send):
+        self.rate = rate
+        self.duration = duration
+        self.send = send
+        self.topics = [
+            (f"device{i:05d}", SENSOR_TYPES[i % len(SENSOR_TYPES)],
+             f"{TOPIC_PREFIX}/device{i:05d}/{SENSOR_TYPES[i % len(SENSOR_TYPES)]}")
+            for i in range(devices)
+        ]
+        self.published = 0
+        self.startedAt = None
+        self.finishedAt = None
+
+    def run(self):
+        self.startedAt = time.perf_counter()
+        deadline = self.startedAt + self.duration
+        deviceCount = len(self.topics)
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            due = int((now - self.startedAt) * self.rate)
+            while self.published < due:
+                deviceId, sensorType, topic = self.topics[self.published % deviceCount]
+                # The publish time travels in the payload so latency can be measured at every hop
+                payload = '{"deviceId": "%s", "type": "%s", "value": %.2f, "unit": "bench", "timestamp": %.6f}' % (
+                    deviceId, sensorType, (self.published % 1000) / 10, time.time()
+                )
+                self.send(topic, payload.encode('utf-8'))
+                self.published += 1
+            time.sleep(PUBLISH_TICK)
+        self.finishedAt = time.perf_counter()
+
+class FakeBroker:
+    """Delivers publishes straight to the historian's MQTT callback"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def start(self):
+        pass
+
+    def publish(self, topic, payload):
+        self.client.onMessage(None, None, FakeMessage(topic, payload, 0, False))
+
+    def stop(self):
+        pass
+
+class LocalBroker:
+    """A real broker: one paho client publishes, the historian's client subscribes"""
+
+    def __init__(self, client, host, port):
+        import paho.mqtt.client as mqtt
+        self.client = client
+        self.host = host
+        self.port = port
+        self.publisher = mqtt.Client()
+
+    def start(self):
+        self.client.connect()
+        self.publisher.connect(self.host, self.port, 60)
+        self.publisher.loop_start()
+        deadline = time.time() + 10
+        while not self.client.connected and time.time() < deadline:
+            time.sleep(0.05)
+        if not self.client.connected:
+            raise RuntimeError(f"Could not connect to {self.host}:{self.port}")
+        # Give the subscriptions a moment to be acknowledged
+        time.sleep(0.5)
+
+    def publish(self, topic, payload):
+        self.publisher.publish(topic, payload)
+
+    def stop(self):
+        self.publisher.loop_stop()
+        self.publisher.disconnect()
+        self.client.disconnect()
+
+class CommitRecorder:
+    """Counts committed rows and samples publish -> commit latency by wrapping the writer's batch write"""
+
+    def __init__(self):
+        self.committed = 0
+        self.latencies = []
+        self.original = writer.writeBatch
+        writer.writeBatch = self.writeBatch
+
+    def writeBatch(self, batch):
+        if not self.original(batch):
+            return False
+        now = time.time()
+        for row, _, _ in batch[::COMMIT_SAMPLE_EVERY]:
+            try:
+                self.latencies.append(now - json.loads(row[3])['timestamp'])
+            except (KeyError, TypeError, ValueError):
+                pass
+        self.committed += len(batch)
+        return True
+
+class WebSocketProbe:
+    """One WebSocket client, fed by the real ConnectionManager on its own event loop"""
+
+    def __init__(self, maxRate):
+        self.maxRate = maxRate
+        self.deliveries = []
+        self.frames = 0
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+
+    async def accept(self):
+        pass
+
+    async def close(self, code=None):
+        pass
+
+    async def send_text(self, text):
+        receivedAt = time.time()
+        self.frames += 1
+        frame = json.loads(text)
+        # Summary frames still carry the latest message per topic, which is a fair sample
+        messages = frame.get('messages') or frame.get('latest') or []
+        for message in messages:
+            try:
+                publishedAt = json.loads(message['payload'])['timestamp']
+            except (KeyError, TypeError, ValueError):
+                continue
+            self.deliveries.append((publishedAt, receivedAt))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="websocketProbe", daemon=True)
+        self.thread.start()
+        self.ready.wait(5)
+
+    def run(self):
+        from websocketManager import manager, messageStream
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        async def session():
+            messageStream.bind(asyncio.get_running_loop())
+            await manager.connect(self)
+            await manager.handleClientMessage(self, json.dumps({
+                "action": "subscribe", "filters": [f"{TOPIC_PREFIX}/#"], "maxRate": self.maxRate, "parsedData": False
+            }))
+            self.ready.set()
+            try:
+                await manager.streamTo(self)
+            finally:
+                manager.disconnect(self)
+
+        self.task = self.loop.create_task(session())
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+            self.thread.join(5)
+
+def runBenchmark(options):
+    dbPath = os.path.join(tempfile.mkdtemp(prefix='historianBench'), 'bench.db')
+    database.DB_PATH = dbPath
+    writer.dbPath = dbPath
+    writer.log.directory = os.path.join(os.path.dirname(dbPath), 'ingestLog')
+    initDatabase()
+    writer.start()
+    recorder = CommitRecorder()
+
+    probe = None
+    if options.stage == 'storage':
+        send = lambda topic, payload: saveMessage(topic, payload.decode('utf-8'))
+        broker = None
+    else:
+        from ingestPipeline import pipeline, getPipelineStats
+        from mqttClient import MQTTClient
+        pipeline.start()
+        if options.websocket:
+            probe = WebSocketProbe(options.wsRate)
+            probe.start()
+        host, _, port = options.broker.partition(':')
+        client = MQTTClient({"name": "bench", "host": host, "port": int(port or 1883), "filters": [f"{TOPIC_PREFIX}/#"]})
+        if options.broker == 'fake':
+            broker = FakeBroker(client)
+        else:
+            broker = LocalBroker(client, host, int(port or 1883))
+        broker.start()
+        send = broker.publish
+
+    publisher = FleetPublisher(options.rate, options.devices, options.duration, send)
+    rssBefore = currentRssMb()
+    peakRss = rssBefore
+
+    # The pipeline prints a line per message; keep that out of the measurement
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        thread = threading.Thread(target=publisher.run, name="fleetPublisher", daemon=True)
+        thread.start()
+        while thread.is_alive():
+            thread.join(0.5)
+            peakRss = max(peakRss, currentRssMb())
+
+        # Let everything that was accepted reach the database
+        drainStart = time.perf_counter()
+        drainDeadline = drainStart + options.drainTimeout
+        while recorder.committed < publisher.published and time.perf_counter() < drainDeadline:
+            time.sleep(0.05)
+            peakRss = max(peakRss, currentRssMb())
+        drainSeconds = time.perf_counter() - drainStart
+
+        if probe is not None:
+            time.sleep(0.5)
+            probe.stop()
+        if broker is not None:
+            broker.stop()
+            pipeline.stop()
+        writer.flush()
+
+    rssAfter = currentRssMb()
+    committed = recorder.committed
+    elapsed = publisher.finishedAt - publisher.startedAt
+    deliveryLatencies = [receivedAt - publishedAt for publishedAt, receivedAt in probe.deliveries] if probe else []
+
+    report = {
+        "broker": options.broker if options.stage == 'pipeline' else None,
+        "stage": options.stage,
+        "targetRate": options.rate,
+        "devices": options.devices,
+        "published": publisher.published,
+        "publishRate": round(publisher.published / elapsed),
+        "committed": committed,
+        "sustainedRate": round(committed / (elapsed + drainSeconds)),
+        "drainSeconds": round(drainSeconds, 2),
+        "commitLatencyMs": latencySummary(recorder.latencies),
+        "deliveryLatencyMs": latencySummary(deliveryLatencies),
+        "websocketFrames": probe.frames if probe else None,
+        "rssMb": {"before": round(rssBefore, 1), "peak": round(peakRss, 1), "after": round(rssAfter, 1),
+                  "growth": round(rssAfter - rssBefore, 1)},
+        "writer": getWriterStats()
+    }
+    if options.stage == 'pipeline':
+        report["pipeline"] = getPipelineStats()
+    writer.stop()
+    return report
+
+def latencySummary(latencies):
+    if not latencies:
+        return None
+    return {
+        "samples": len(latencies),
+        "p50": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99": round(percentile(latencies, 0.99) * 1000, 2),
+        "max": round(max(latencies) * 1000, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Historian ingest benchmark")
+    parser.add_argument('--rate', type=int, default=1000, help="messages per second to publish")
+    parser.add_argument('--devices', type=int, default=1000, help="synthetic devices (one topic each)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to publish for")
+    parser.add_argument('--broker', default='fake', help="'fake' or HOST[:PORT] of a local broker")
+    parser.add_argument('--stage', choices=['pipeline', 'storage'], default='pipeline')
+    parser.add_argument('--no-websocket', dest='websocket', action='store_false', help="skip the WebSocket probe")
+    parser.add_argument('--ws-rate', dest='wsRate', type=float, default=100.0, help="probe frames per second")
+    parser.add_argument('--drain-timeout', dest='drainTimeout', type=float, default=60.0)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    options = parser.parse_args()
+
+    report = runBenchmark(options)
+    if options.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{report['stage']} via {report['broker'] or 'saveMessage'}: "
+          f"{report['devices']} devices, target {report['targetRate']:,} msg/s")
+    print(f"  published   {report['published']:,} ({report['publishRate']:,} msg/s)")
+    print(f"  committed   {report['committed']:,} (sustained {report['sustainedRate']:,} msg/s, "
+          f"drained in {report['drainSeconds']} s)")
+    for name, key in (("commit", "commitLatencyMs"), ("delivery", "deliveryLatencyMs")):
+        summary = report[key]
+        if summary:
+            print(f"  {name:<11} p50 {summary['p50']} ms, p99 {summary['p99']} ms, max {summary['max']} ms "
+                  f"({summary['samples']:,} samples)")
+    rss = report['rssMb']
+    print(f"  memory      {rss['before']} -> {rss['after']} MB (peak {rss['peak']} MB, growth {rss['growth']} MB)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Messages per second through MessageParser.extractSensorData.
+
+Compares the parser against the previous implementation (kept below as
+legacyExtractSensorData) on a mix of simulator-style JSON and plain text
+payloads spread over a realistic number of distinct topics.
+
+    python benchmarks/parserBenchmark.py [messages]
+"""
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import messageParser
+import payloadDecoders
+from messageParser import MessageParser
+
+DEVICES = 200
+SENSOR_TYPES = ['temperature', 'humidity', 'pressure', 'voltage']
+
+def legacyExtractSensorData(topic, payload, qos=0, retain=False):
+    """extractSensorData as it was before topic caching and structural number extraction"""
+    try:
+        data = json.loads(payload)
+        parsed = {"format": "json", "data": data}
+    except json.JSONDecodeError:
+        parsed = {"format": "text", "data": payload, "length": len(payload)}
+    parsed.update({
+        "timestamp": datetime.now().isoformat(),
+        "topicStructure": topic.split('/'),
+        "mqttMetadata": {"qos": qos, "retained": retain, "topic": topic}
+    })
+
+    sensorTypes = ['temperature', 'humidity', 'pressure', 'voltage', 'status', 'sensor', 'data']
+    detectedSensors = []
+    for segment in parsed['topicStructure']:
+        for sensorType in sensorTypes:
+            if sensorType in segment.lower():
+                detectedSensors.append(segment)
+                break
+
+    numbers = re.findall(r"[-+]?\d*\.\d+|\d+", str(payload))
+    parsed['sensorInfo'] = {
+        'detectedSensors': detectedSensors,
+        'numericValues': [float(num) for num in numbers] if numbers else [],
+        'isSensorData': len(detectedSensors) > 0 or len(numbers) > 0,
+        'readings': MessageParser.extractReadings(topic, parsed)
+    }
+    return parsed
+
+def buildMessages(count):
+    random.seed(1)
+    messages = []
+    for i in range(count):
+        device = f"device{random.randrange(DEVICES):03d}"
+        sensorType = random.choice(SENSOR_TYPES)
+        topic = f"codePower/sensors/{device}/{sensorType}"
+        if i % 10 == 0:
+            payload = f"{random.uniform(0, 100):.2f}"
+        else:
+            payload = json.dumps({
+                "deviceId": device,
+                "type": sensorType,
+                "value": round(random.uniform(0, 100), 2),
+                "unit": "C",
+                "timestamp": datetime.now().isoformat()
+            })
+        messages.append((topic, payload))
+    return messages
+
+def measure(name, func, messages):
+    start = time.perf_counter()
+    for topic, payload in messages:
+        func(topic, payload)
+    elapsed = time.perf_counter() - start
+    rate = len(messages) / elapsed
+    print(f"{name:<10} {rate:>12,.0f} msg/s")
+    return rate
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    messages = buildMessages(count)
+    backend = getattr(payloadDecoders.loadJson, '__module__', 'json')
+    print(f"{count} messages, {DEVICES * len(SENSOR_TYPES)} topics, JSON backend: {backend}")
+
+    before = measure("before", legacyExtractSensorData, messages)
+    after = measure("after", MessageParser.extractSensorData, messages)
+    print(f"speedup    {after / before:.2f}x")
+    print(f"topic cache: {messageParser.classifyTopic.cache_info()}")
+
+if __name__ == '__main__':
+    main()
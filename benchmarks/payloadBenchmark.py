@@ -0,0 +1,169 @@
+"""Storage size and read/write cost of compressed payload storage.
+
+Writes the same simulator-style messages through the DatabaseWriter once per
+payload compression mode, each into its own temporary database, and reports
+the payload compression ratio, the size of the message partitions, rows per
+page (what a scan or page query reads), write throughput and the cost of
+reading the rows back through exportMessages, getMessagesPage and
+getRecentMessages. It also checks that fleetSimulator's replay reads back
+every payload as it was sent.
+
+    python benchmarks/payloadBenchmark.py [--messages N] [--compression none|zlib|zstd]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import database
+import payloadCodec
+from database import (
+    MESSAGE_PARTITION_PREFIX, exportMessages, getMessagesPage, getRecentMessages, getWriterStats,
+    initDatabase, saveMessage, writer
+)
+from fleetSimulator import loadRecordedMessages
+
+LOCATIONS = ['room1', 'room2', 'lab', 'warehouse', 'office', 'roof']
+DEVICES = 500
+MODES = ['none', 'zlib', 'zstd']
+
+def buildMessages(count):
+    """Payloads shaped like deviceSimulator's, over DEVICES devices"""
+    random.seed(1)
+    start = time.time()
+    messages = []
+    for i in range(count):
+        device = random.randrange(DEVICES)
+        deviceId = f"sensor{device:03d}"
+        location = LOCATIONS[device % len(LOCATIONS)]
+        kind = device % 4
+        timestamp = start + i * 0.01
+        if kind == 0:
+            topic = f"codePower/sensors/{deviceId}/temperature"
+            payload = {"deviceId": deviceId, "type": "temperature", "value": round(random.gauss(22, 3), 2),
+                       "unit": "°C", "location": location, "timestamp": timestamp}
+        elif kind == 1:
+            topic = f"codePower/sensors/{deviceId}/humidity"
+            payload = {"deviceId": deviceId, "type": "humidity", "value": round(random.uniform(30, 70), 1),
+                       "unit": "%", "location": location, "timestamp": timestamp}
+        elif kind == 2:
+            topic = f"codePower/devices/{deviceId}/status"
+            payload = {"deviceId": deviceId, "status": random.choice(["online", "online", "online", "degraded"]),
+                       "location": location, "timestamp": timestamp}
+        else:
+            topic = f"codePower/actuators/{deviceId}/state"
+            payload = {"deviceId": deviceId, "state": random.choice(["on", "off"]), "location": location,
+                       "timestamp": timestamp}
+        messages.append((topic, json.dumps(payload)))
+    return messages
+
+def partitionSize(dbPath):
+    """(bytes, pages) of the message partition tables, without their indexes"""
+    conn = sqlite3.connect(dbPath)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    size, pages = conn.execute(
+        "SELECT SUM(pgsize), COUNT(*) FROM dbstat WHERE name GLOB ?", (MESSAGE_PARTITION_PREFIX + '*',)
+    ).fetchone()
+    conn.close()
+    return size or 0, pages or 0
+
+def timed(func, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+def runMode(compression, count):
+    directory = tempfile.mkdtemp(prefix='historianPayloadBench')
+    dbPath = os.path.join(directory, 'bench.db')
+    database.DB_PATH = dbPath
+    writer.dbPath = dbPath
+    writer.log.directory = os.path.join(directory, 'ingestLog')
+    payloadCodec.setPayloadCompression(None if compression == 'none' else compression)
+    initDatabase()
+    writer.start()
+
+    messages = buildMessages(count)
+
+    def write():
+        for topic, payload in messages:
+            saveMessage(topic, payload)
+        writer.flush()
+    writeSeconds, _ = timed(write)
+    stats = getWriterStats()
+    writer.stop()
+
+    size, pages = partitionSize(dbPath)
+    exportSeconds, exported = timed(lambda: sum(chunk.count('\n') for chunk in exportMessages()))
+    topic = messages[0][0]
+    pageSeconds, _ = timed(lambda: getMessagesPage(limit=100, topic=topic), repeat=20)
+    recentSeconds, _ = timed(lambda: getRecentMessages(100), repeat=20)
+    # Replay must republish the original text, not the stored BLOB
+    replayed = [(topic, payload) for _, topic, payload, _ in loadRecordedMessages(dbPath)]
+    replayMismatches = len(messages) - len(replayed) + sum(1 for sent, read in zip(messages, replayed) if sent != read)
+
+    rawBytes = sum(len(payload.encode('utf-8')) for _, payload in messages)
+    codecStats = payloadCodec.getPayloadCodecStats()
+    return {
+        "compression": payloadCodec.payloadCodec.compression or 'none',
+        "messages": count,
+        "payloadRatio": round(rawBytes / codecStats["storedBytes"], 2) if codecStats["storedBytes"] else 1.0,
+        "dictionaries": codecStats["dictionaries"],
+        "partitionMb": round(size / 1e6, 2),
+        "partitionPages": pages,
+        "rowsPerPage": round(count / pages, 1) if pages else None,
+        "databaseMb": round(os.path.getsize(dbPath) / 1e6, 2),
+        "writeRate": round(count / writeSeconds),
+        "avgFlushMs": stats["avgFlushMs"],
+        "exportRate": round(exported / exportSeconds),
+        "pageQueryMs": round(pageSeconds * 1000, 2),
+        "recentQueryMs": round(recentSeconds * 1000, 2),
+        "replayMismatches": replayMismatches
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compressed payload storage benchmark")
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--compression', choices=MODES, help="run one mode only")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    options = parser.parse_args()
+
+    if options.compression:
+        report = runMode(options.compression, options.messages)
+        print(json.dumps(report) if options.json else report)
+        return
+
+    # Each mode in its own process, so dictionaries and caches start empty
+    reports = []
+    for mode in MODES:
+        if mode == 'zstd' and payloadCodec.zstandard is None:
+            print("zstandard is not installed; skipping zstd")
+            continue
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--compression', mode, '--messages', str(options.messages), '--json'],
+            check=True, capture_output=True, text=True
+        ).stdout
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+
+    if options.json:
+        print(json.dumps(reports, indent=2))
+        return
+    baseline = reports[0]
+    print(f"{options.messages} messages, {DEVICES} devices")
+    print(f"{'mode':<6} {'payload':>8} {'table MB':>9} {'smaller':>8} {'rows/page':>10} {'write/s':>9} "
+          f"{'export/s':>9} {'page ms':>8} {'recent ms':>10} {'replay':>7}")
+    for report in reports:
+        print(f"{report['compression']:<6} {report['payloadRatio']:>7.2f}x {report['partitionMb']:>9.2f} "
+              f"{baseline['partitionMb'] / report['partitionMb']:>7.2f}x {report['rowsPerPage']:>10} "
+              f"{report['writeRate']:>9,} {report['exportRate']:>9,} {report['pageQueryMs']:>8} {report['recentQueryMs']:>10} "
+              f"{'ok' if not report['replayMismatches'] else report['replayMismatches']:>7}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import sqlite3
+from datetime import datetime
+from database import DB_PATH, SENSOR_PARTITION_PREFIX, partitionsInRange, toDbTimestamp, topicCatalog
+from topicMatcher import topicMatches, validateFilter
+
+# Optional: without numpy /api/aggregate is unavailable
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Readings fetched from SQLite per NumPy batch, and the defaults for /api/aggregate
+AGGREGATE_CHUNK_ROWS = 100000
+DEFAULT_PERCENTILES = (50, 90, 99)
+MAX_LTTB_POINTS = 10000
+
+# SQLite converts the stored timestamp text to epoch milliseconds, so no row is parsed in Python
+EPOCH_MS_SQL = "CAST(round((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER)"
+
+def formatEpochMs(ms, withMs=True):
+    text = datetime.utcfromtimestamp(ms / 1000).strftime('%Y-%m-%d %H:%M:%S.%f')
+    return text[:-3] if withMs else text[:19]
+
+def matchingTopics(topicFilter):
+    validateFilter(topicFilter)
+    return [entry["topic"] for entry in topicCatalog.getTopics() if topicMatches(topicFilter, entry["topic"])]
+
+def loadSeries(field, topic=None, start=None, end=None):
+    """(epoch ms, value) arrays of every `field` reading on topics matching the filter, in time order.
+
+    The rows are counted first, so both arrays are allocated once at their
+    final size; rows are then pulled in AGGREGATE_CHUNK_ROWS batches and
+    copied in, and peak memory is the arrays plus one batch.
+    """
+    start = toDbTimestamp(start)
+    end = toDbTimestamp(end)
+    topics = matchingTopics(topic) if topic else None
+    if topics == []:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    conditions = ['sensorType = ?']
+    params = [field]
+    if topics is not None:
+        # A filter can match more topics than SQLite takes bound parameters
+        cursor.execute('CREATE TEMP TABLE aggregateTopics (topic TEXT PRIMARY KEY)')
+        cursor.executemany('INSERT INTO aggregateTopics (topic) VALUES (?)', [(name,) for name in topics])
+        conditions.append('rawTopic IN (SELECT topic FROM aggregateTopics)')
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('timestamp < ?')
+        params.append(end)
+
+    where = ' AND '.join(conditions) + ' AND value IS NOT NULL'
+    # One read transaction, so the counts and the rows come from the same snapshot
+    conn.commit()
+    cursor.execute('BEGIN')
+    days = partitionsInRange(cursor, SENSOR_PARTITION_PREFIX, start, end)
+    total = 0
+    for day in days:
+        cursor.execute(f'SELECT COUNT(*) FROM {SENSOR_PARTITION_PREFIX}{day} WHERE {where}', params)
+        total += cursor.fetchone()[0]
+
+    times = np.empty(total, dtype=np.int64)
+    values = np.empty(total)
+    filled = 0
+    for day in days:
+        cursor.execute(f'''
+            SELECT {EPOCH_MS_SQL}, value
+            FROM {SENSOR_PARTITION_PREFIX}{day}
+            WHERE {where}
+            ORDER BY timestamp
+        ''', params)
+        while True:
+            chunk = cursor.fetchmany(AGGREGATE_CHUNK_ROWS)
+            if not chunk:
+                break
+            batch = np.array(chunk, dtype=np.float64)
+            times[filled:filled + len(chunk)] = batch[:, 0]
+            values[filled:filled + len(chunk)] = batch[:, 1]
+            filled += len(chunk)
+    conn.close()
+
+    # Readings can be back-dated into an earlier day's partition; keep the series ordered
+    if len(times) > 1 and np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+    return times, values
+
+def bucketStatistics(times, values, bucketSeconds, percentiles=DEFAULT_PERCENTILES):
+    """min/max/mean/count and percentiles per bucket, computed with whole-array NumPy operations.
+
+    Values are sorted once by (bucket, value); each bucket is then a
+    contiguous run, so its min and max are the run's ends and any percentile
+    is an interpolation between two positions in it.
+    """
+    if len(values) == 0:
+        return []
+    buckets = times // (bucketSeconds * 1000)
+    order = np.lexsort((values, buckets))
+    buckets = buckets[order]
+    values = values[order]
+
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    counts = np.diff(np.append(starts, len(values)))
+    sums = np.add.reduceat(values, starts)
+    statistics = {
+        "min": values[starts],
+        "max": values[starts + counts - 1],
+        "mean": sums / counts
+    }
+    for percentile in percentiles:
+        # Linear interpolation, as numpy.percentile does
+        position = starts + (counts - 1) * (percentile / 100)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        statistics[f"p{percentile:g}"] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    bucketStarts = buckets[starts] * bucketSeconds * 1000
+    columns = {name: column.tolist() for name, column in statistics.items()}
+    return [
+        {
+            "bucket": formatEpochMs(bucketStart, withMs=False),
+            "count": count,
+            **{name: column[i] for name, column in columns.items()}
+        }
+        for i, (bucketStart, count) in enumerate(zip(bucketStarts.tolist(), counts.tolist()))
+    ]
+
+def lttb(times, values, threshold):
+    """Indexes of the points Largest-Triangle-Three-Buckets keeps to draw the series with `threshold` points.
+
+    The first and last points are always kept. For each bucket in between,
+    the point forming the largest triangle with the previously kept point and
+    the average of the next bucket is chosen; that search is vectorized, so
+    the Python loop runs once per output point, not per input point.
+    """
+    count = len(values)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+
+    x = times.astype(np.float64)
+    edges = np.floor(np.linspace(1, count - 1, threshold - 1)).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = count - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        nextStart = end
+        nextEnd = edges[i + 2] if i + 2 < len(edges) else count
+        averageX = x[nextStart:nextEnd].mean()
+        averageY = values[nextStart:nextEnd].mean()
+
+        # Twice the triangle area; the constant factor does not change the argmax
+        areas = np.abs(
+            (x[previous] - averageX) * (values[start:end] - values[previous])
+            - (x[previous] - x[start:end]) * (averageY - values[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+def aggregateSeries(field, topic=None, start=None, end=None, bucket=None, points=None, percentiles=DEFAULT_PERCENTILES):
+    """Bucket statistics and/or an LTTB-downsampled series for one reading type"""
+    if np is None:
+        raise RuntimeError("numpy is not installed")
+    if bucket is not None and bucket <= 0:
+        raise ValueError("bucket must be a positive number of seconds")
+    if points is not None and not 3 <= points <= MAX_LTTB_POINTS:
+        raise ValueError(f"points must be between 3 and {MAX_LTTB_POINTS}")
+    for percentile in percentiles:
+        if not 0 <= percentile <= 100:
+            raise ValueError(f"Percentile out of range: {percentile}")
+
+    times, values = loadSeries(field, topic, start, end)
+    result = {"field": field, "topic": topic, "count": len(values)}
+    if bucket is not None:
+        result["bucket"] = bucket
+        result["buckets"] = bucketStatistics(times, values, bucket, percentiles)
+    if points is not None:
+        kept = lttb(times, values, points)
+        result["points"] = [
+            {"timestamp": formatEpochMs(timestamp), "value": value}
+            for timestamp, value in zip(times[kept].tolist(), values[kept].tolist())
+        ]
+    return result
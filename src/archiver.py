@@ -0,0 +1,368 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote
+from database import (
+    DB_PATH, MESSAGE_PARTITION_PREFIX, SENSOR_PARTITION_PREFIX, writer, listPartitions,
+    topicCatalog, toDbTimestamp
+)
+from payloadCodec import decodeStoredPayload
+from topicMatcher import topicMatches, validateFilter
+
+# Optional: without pyarrow the archive job does not run and archive queries are unavailable
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Parquet files go to ARCHIVE_DIR/<table>/date=YYYY-MM-DD/topic=<first topic level>/part.parquet
+ARCHIVE_DIR = 'archive'
+ARCHIVE_COMPRESSION = 'zstd'
+
+# How often the job looks for closed days, and how long after midnight (UTC) a
+# day counts as closed, so rows still in the writer's log are included
+ARCHIVE_INTERVAL = 3600
+ARCHIVE_LAG = 600
+
+# Rows read from SQLite and written as one Parquet row group at a time
+ARCHIVE_CHUNK_ROWS = 100000
+
+TABLES = ('mqttMessages', 'sensorData')
+
+if pa is not None:
+    SCHEMAS = {
+        'mqttMessages': pa.schema([
+            ('id', pa.int64()),
+            ('timestamp', pa.timestamp('ms')),
+            ('topic', pa.string()),
+            ('payload', pa.string()),
+            ('qos', pa.int8()),
+            ('retained', pa.bool_())
+        ]),
+        'sensorData': pa.schema([
+            ('deviceId', pa.string()),
+            ('sensorType', pa.string()),
+            ('value', pa.float64()),
+            ('unit', pa.string()),
+            ('timestamp', pa.timestamp('ms')),
+            ('rawTopic', pa.string())
+        ])
+    }
+
+def topicRoot(topic):
+    return topic.split('/', 1)[0]
+
+def rootDirectory(root):
+    # Topics may hold any character; '_' stands in for an empty first level
+    return f"topic={quote(root, safe='') or '_'}"
+
+def dayDirectory(table, day):
+    return os.path.join(ARCHIVE_DIR, table, f"date={day[0:4]}-{day[4:6]}-{day[6:8]}")
+
+def closedDays(cursor, now=None):
+    """Partition days that can no longer receive rows at their receive time"""
+    now = now or time.time()
+    lastClosed = datetime.utcfromtimestamp(now - ARCHIVE_LAG - 86400).strftime('%Y%m%d')
+    days = set(listPartitions(cursor, MESSAGE_PARTITION_PREFIX)) | set(listPartitions(cursor, SENSOR_PARTITION_PREFIX))
+    return sorted(day for day in days if day <= lastClosed)
+
+def partitionRowCounts(cursor, day):
+    counts = []
+    for prefix in (MESSAGE_PARTITION_PREFIX, SENSOR_PARTITION_PREFIX):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (prefix + day,))
+        if cursor.fetchone() is None:
+            counts.append(0)
+            continue
+        cursor.execute(f'SELECT COUNT(*) FROM {prefix}{day}')
+        counts.append(cursor.fetchone()[0])
+    return tuple(counts)
+
+def archivedRowCounts(cursor):
+    cursor.execute('SELECT day, messageRows, sensorRows FROM archiveState')
+    return {day: (messageRows, sensorRows) for day, messageRows, sensorRows in cursor.fetchall()}
+
+class RootWriters:
+    """One ParquetWriter per first topic level, for one table and day, written to a staging directory"""
+
+    def __init__(self, table, directory):
+        self.schema = SCHEMAS[table]
+        self.directory = directory
+        self.writers = {}
+
+    def write(self, root, columns):
+        writer = self.writers.get(root)
+        if writer is None:
+            path = os.path.join(self.directory, rootDirectory(root))
+            os.makedirs(path, exist_ok=True)
+            writer = pq.ParquetWriter(os.path.join(path, 'part.parquet'), self.schema, compression=ARCHIVE_COMPRESSION)
+            self.writers[root] = writer
+        arrays = [
+            pa.array(values, type=field.type) if field.type != pa.timestamp('ms')
+            else pa.array(values, type=pa.string()).cast(field.type)
+            for values, field in zip(columns, self.schema)
+        ]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+def writeChunks(cursor, table, directory, prepare):
+    """Stream the current query's rows into per-root Parquet files; returns the row count.
+
+    prepare(row) returns the row's first topic level and the row to store.
+    """
+    writers = RootWriters(table, directory)
+    rows = 0
+    try:
+        while True:
+            chunk = cursor.fetchmany(ARCHIVE_CHUNK_ROWS)
+            if not chunk:
+                break
+            grouped = {}
+            for row in chunk:
+                root, output = prepare(row)
+                grouped.setdefault(root, []).append(output)
+            for root, groupRows in grouped.items():
+                writers.write(root, list(zip(*groupRows)))
+            rows += len(chunk)
+    finally:
+        writers.close()
+    return rows
+
+def archiveDay(conn, day):
+    """Write one day of messages and readings to Parquet, replacing any earlier archive of it.
+
+    Files are written to a staging directory and swapped in whole, so readers
+    never see a partly written day.
+    """
+    cursor = conn.cursor()
+    lookup = conn.cursor()
+    counts = []
+    for table, prefix in zip(TABLES, (MESSAGE_PARTITION_PREFIX, SENSOR_PARTITION_PREFIX)):
+        final = dayDirectory(table, day)
+        staging = final + '.tmp'
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (prefix + day,))
+        if cursor.fetchone() is None:
+            counts.append(0)
+        elif table == 'mqttMessages':
+            # Sorted by time, so row group statistics let time-range reads skip most of a file
+            cursor.execute(f'''
+                SELECT id, timestamp, topicId, payload, qos, retained
+                FROM {prefix}{day}
+                ORDER BY timestamp, id
+            ''')
+
+            def prepareMessage(row):
+                topic = topicCatalog.topicName(row[2], lookup) or ''
+                return topicRoot(topic), (row[0], row[1], topic, decodeStoredPayload(row[3], lookup), row[4], bool(row[5]))
+            counts.append(writeChunks(cursor, table, staging, prepareMessage))
+        else:
+            # Sorted by series, so a single device or sensor type reads few row groups
+            cursor.execute(f'''
+                SELECT deviceId, sensorType, value, unit, timestamp, rawTopic
+                FROM {prefix}{day}
+                ORDER BY deviceId, sensorType, timestamp
+            ''')
+            counts.append(writeChunks(cursor, table, staging, lambda row: (topicRoot(row[5] or ''), row)))
+
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(staging, final)
+    return tuple(counts)
+
+def recordArchivedDay(day, counts):
+    def record(conn):
+        with conn:
+            conn.execute('''
+                INSERT INTO archiveState (day, archivedAt, messageRows, sensorRows) VALUES (?, ?, ?, ?)
+                ON CONFLICT(day) DO UPDATE SET
+                    archivedAt = excluded.archivedAt,
+                    messageRows = excluded.messageRows,
+                    sensorRows = excluded.sensorRows
+            ''', (day, toDbTimestamp(time.time()), counts[0], counts[1]))
+    writer.call(record).result()
+
+def archiveClosedDays():
+    """Archive every closed day not yet archived, or whose row counts changed since.
+
+    Readings are partitioned by their own timestamp, so a late or back-dated
+    reading can still land in a closed day; the count check re-archives it.
+    Reads go through their own connection, off the writer thread; only the
+    archiveState update is passed to the writer.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    archived = []
+    try:
+        done = archivedRowCounts(cursor)
+        for day in closedDays(cursor):
+            counts = partitionRowCounts(cursor, day)
+            if done.get(day) == counts:
+                continue
+            counts = archiveDay(conn, day)
+            recordArchivedDay(day, counts)
+            archived.append(day)
+            print(f"Archived {day}: {counts[0]} messages, {counts[1]} readings")
+    finally:
+        conn.close()
+    return archived
+
+class ArchiveJob:
+    """Background thread that archives closed days to Parquet every ARCHIVE_INTERVAL"""
+
+    def __init__(self, interval=ARCHIVE_INTERVAL):
+        self.interval = interval
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.lastRun = None
+        self.lastError = None
+        self.archivedDays = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        if pa is None:
+            print("pyarrow is not installed; Parquet archiving is disabled")
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="archiveJob", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(5.0)
+            self.thread = None
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.archivedDays += len(archiveClosedDays())
+                self.lastRun = time.time()
+                self.lastError = None
+            except Exception as e:
+                self.lastError = str(e)
+                print(f"Archive job failed: {e}")
+            self.stopEvent.wait(self.interval)
+
+    def getStats(self):
+        return {
+            "enabled": pa is not None,
+            "running": self.thread is not None,
+            "archivedDays": self.archivedDays,
+            "lastRun": self.lastRun,
+            "lastError": self.lastError
+        }
+
+# Global instance
+archiveJob = ArchiveJob()
+
+def startArchiveJob():
+    archiveJob.start()
+
+def stopArchiveJob():
+    archiveJob.stop()
+
+def getArchiveStats():
+    return archiveJob.getStats()
+
+def archiveFiles(table, start=None, end=None, topic=None):
+    """Archived Parquet files for days overlapping [start, end) and, when the
+    filter's first level is not a wildcard, only that topic root"""
+    base = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(base):
+        return []
+    first = start[0:10] if start else None
+    last = end[0:10] if end else None
+    root = None
+    if topic and topicRoot(topic) not in ('+', '#'):
+        root = rootDirectory(topicRoot(topic))
+
+    files = []
+    for dateName in sorted(os.listdir(base)):
+        if not dateName.startswith('date=') or dateName.endswith('.tmp'):
+            continue
+        date = dateName[5:]
+        if (first and date < first) or (last and date > last):
+            continue
+        for rootName in sorted(os.listdir(os.path.join(base, dateName))):
+            if root is None or rootName == root:
+                files.append(os.path.join(base, dateName, rootName, 'part.parquet'))
+    return files
+
+def queryArchive(start=None, end=None, deviceId=None, sensorType=None, topic=None, resolution=3600):
+    """min/max/avg/count of archived readings per series and `resolution`-second bucket over [start, end).
+
+    Each file is read through a memory map with the filters pushed down, so
+    Parquet row group statistics skip data outside the range, and is
+    aggregated with Arrow compute kernels on its own. Only the per-file
+    partial aggregates are held and merged, so memory follows the number of
+    buckets, not the number of readings.
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    if resolution <= 0:
+        raise ValueError("resolution must be a positive number of seconds")
+    if topic:
+        validateFilter(topic)
+    start = toDbTimestamp(start)
+    end = toDbTimestamp(end)
+
+    filters = []
+    if start:
+        filters.append(('timestamp', '>=', datetime.strptime(start, '%Y-%m-%d %H:%M:%S.%f')))
+    if end:
+        filters.append(('timestamp', '<', datetime.strptime(end, '%Y-%m-%d %H:%M:%S.%f')))
+    if deviceId:
+        filters.append(('deviceId', '=', deviceId))
+    if sensorType:
+        filters.append(('sensorType', '=', sensorType))
+
+    keys = ['deviceId', 'sensorType', 'bucket']
+    partials = []
+    for path in archiveFiles('sensorData', start, end, topic):
+        table = pq.read_table(path, columns=['deviceId', 'sensorType', 'value', 'timestamp', 'rawTopic'],
+                              filters=filters or None, memory_map=True)
+        if topic:
+            topics = [value for value in pc.unique(table['rawTopic']).to_pylist() if value and topicMatches(topic, value)]
+            table = table.filter(pc.is_in(table['rawTopic'], value_set=pa.array(topics, type=pa.string())))
+        if table.num_rows == 0:
+            continue
+        table = table.append_column('bucket', pc.floor_temporal(table['timestamp'], multiple=resolution, unit='second'))
+        partials.append(table.group_by(keys).aggregate([
+            ('value', 'min'), ('value', 'max'), ('value', 'sum'), ('value', 'count')
+        ]))
+
+    if not partials:
+        return {"resolution": resolution, "files": 0, "series": []}
+
+    merged = pa.concat_tables(partials).group_by(keys).aggregate([
+        ('value_min', 'min'), ('value_max', 'max'), ('value_sum', 'sum'), ('value_count', 'sum')
+    ]).sort_by([(key, 'ascending') for key in keys])
+
+    series = {}
+    for row in merged.to_pylist():
+        entry = series.setdefault((row['deviceId'], row['sensorType']), [])
+        entry.append({
+            "bucket": row['bucket'].strftime('%Y-%m-%d %H:%M:%S'),
+            "min": row['value_min_min'],
+            "max": row['value_max_max'],
+            "avg": row['value_sum_sum'] / row['value_count_sum'],
+            "count": row['value_count_sum']
+        })
+    return {
+        "resolution": resolution,
+        "files": len(partials),
+        "series": [
+            {"deviceId": deviceId, "sensorType": sensorType, "buckets": buckets}
+            for (deviceId, sensorType), buckets in series.items()
+        ]
+    }
@@ -1,87 +1,1334 @@
 import sqlite3
+import base64
+import csv
+import io
 import json
-from datetime import datetime
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from ingestLog import SegmentLog, INGEST_LOG_DIR, lockExclusive
+from metrics import histogram, gauge, callbackCounter, SIZE_BUCKETS
+from payloadCodec import payloadCodec, decodeStoredPayload
+from topicMatcher import topicMatches, validateFilter
 
-def initDatabase():
-	conn = sqlite3.connect('mqttData.db')
+DB_PATH = 'mqttData.db'
+
+# Writer tuning: rows are committed once WRITER_BATCH_SIZE rows are pending
+# or WRITER_MAX_DELAY seconds after the first pending row, whichever is first
+WRITER_BATCH_SIZE = 500
+WRITER_MAX_DELAY = 0.05
+WRITER_QUEUE_SIZE = 50000
+WRITER_SYNCHRONOUS = 'NORMAL'
+
+# How long the writer waits before retrying a batch while the database is
+# locked or unavailable; messages keep going to the ingest log meanwhile
+WRITER_RETRY_DELAY = 1.0
+
+# Lock file next to the database, held by the one process whose writer stores into it
+WRITER_LOCK_SUFFIX = '.writer.lock'
+
+# Messages and readings are stored in one table pair per UTC day, e.g.
+# mqttMessages_20261017 / sensorData_20261017. Partitions older than
+# RETENTION_DAYS are dropped whole; None keeps everything.
+RETENTION_DAYS = 30
+MESSAGE_PARTITION_PREFIX = 'mqttMessages_'
+SENSOR_PARTITION_PREFIX = 'sensorData_'
+
+# Largest /messages page, and rows fetched per query when exporting
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = ('id', 'timestamp', 'topic', 'payload', 'qos', 'retained')
+
+def initDatabase(migrate=True):
+	"""Create the schema; with migrate=False the slow upgrade work is left to runMigrations/buildMissingIndexes"""
+	conn = sqlite3.connect(DB_PATH)
+	cursor = conn.cursor()
+	
+	# Only takes effect on a new file; lets dropped partitions give pages back to the OS
+	cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+	# WAL is persistent, so readers never block the writer thread
+	cursor.execute('PRAGMA journal_mode=WAL')
+	
+	# Topic dictionary: mqttMessages stores topics.id rather than the topic string
+	cursor.execute('''
+		CREATE TABLE IF NOT EXISTS topics (
+			id INTEGER PRIMARY KEY,
+			topic TEXT NOT NULL UNIQUE,
+			firstSeen DATETIME,
+			lastSeen DATETIME,
+			messageCount INTEGER DEFAULT 0,
+			lastPayload TEXT
+		)
+	''')
+	
+	# min/max/avg/count per series at 1-minute, 1-hour and 1-day resolution,
+	# filled by rollups.RollupJob and kept after raw partitions expire
+	for table in ('sensorRollup1m', 'sensorRollup1h', 'sensorRollup1d'):
+		cursor.execute(f'''
+			CREATE TABLE IF NOT EXISTS {table} (
+				deviceId TEXT NOT NULL,
+				sensorType TEXT NOT NULL,
+				bucket DATETIME NOT NULL,
+				minValue REAL,
+				maxValue REAL,
+				sumValue REAL,
+				count INTEGER,
+				PRIMARY KEY (deviceId, sensorType, bucket)
+			) WITHOUT ROWID
+		''')
+	
+	cursor.execute('''
+		CREATE TABLE IF NOT EXISTS rollupState (
+			resolution TEXT PRIMARY KEY,
+			watermark DATETIME
+		)
+	''')
+	# Last sensor partition rowid folded into the rollups, per day
+	cursor.execute('''
+		CREATE TABLE IF NOT EXISTS rollupProgress (
+			day TEXT PRIMARY KEY,
+			lastId INTEGER NOT NULL
+		)
+	''')
+	
+	# Days written to Parquet by archiver.ArchiveJob, with the row counts archived
+	cursor.execute('''
+		CREATE TABLE IF NOT EXISTS archiveState (
+			day TEXT PRIMARY KEY,
+			archivedAt DATETIME,
+			messageRows INTEGER,
+			sensorRows INTEGER
+		)
+	''')
+	
+	# Trained payload compression dictionaries, referenced by id from compressed payloads
+	cursor.execute('''
+		CREATE TABLE IF NOT EXISTS payloadDictionaries (
+			id INTEGER PRIMARY KEY,
+			family TEXT NOT NULL,
+			codec TEXT NOT NULL,
+			createdAt DATETIME,
+			dictionary BLOB NOT NULL
+		)
+	''')
+	
+	# Alerts raised by ruleEngine.RuleEngine, one row each time a rule starts or stops firing
+	cursor.execute('''
+		CREATE TABLE IF NOT EXISTS systemAlerts (
+			id INTEGER PRIMARY KEY,
+			timestamp DATETIME NOT NULL,
+			rule TEXT NOT NULL,
+			severity TEXT,
+			state TEXT NOT NULL,
+			topic TEXT,
+			deviceId TEXT,
+			field TEXT,
+			value REAL,
+			message TEXT
+		)
+	''')
+	cursor.execute('CREATE INDEX IF NOT EXISTS idxSystemAlertsTime ON systemAlerts (timestamp)')
+	
+	# Upgrades done in the background, by name, so they are not repeated
+	cursor.execute('''
+		CREATE TABLE IF NOT EXISTS schemaMigrations (
+			name TEXT PRIMARY KEY,
+			appliedAt DATETIME
+		)
+	''')
+	
+	conn.commit()
+	if migrate:
+		runMigrations(conn)
+		for day in partitionsMissingIndexes(cursor):
+			buildPartitionIndexes(conn, day)
+		for table in tablesWithLegacyTimestamps(cursor):
+			normaliseTimestamps(conn, table)
+	conn.close()
+	print("Database initialized.")
+
+def nextMigrationStep(cursor):
+	"""(description, func(cursor)) of the next schema upgrade still to do, or None when up to date.
+
+	Each step commits on its own and the next one is worked out from the
+	schema as it is, so an interrupted upgrade resumes where it stopped.
+	"""
+	# Databases from before partitioning still have the single mqttMessages/sensorData tables
+	if tableExists(cursor, 'mqttMessages'):
+		cursor.execute('PRAGMA table_info(mqttMessages)')
+		if 'topic' in [column[1] for column in cursor.fetchall()]:
+			return "mqttMessages to topic ids", migrateTopicIds
+		return "mqttMessages to daily partitions", lambda stepCursor: migrateNextDay(stepCursor, 'mqttMessages')
+	if tableExists(cursor, 'sensorData'):
+		return "sensorData to daily partitions", lambda stepCursor: migrateNextDay(stepCursor, 'sensorData')
+	return None
+
+def runMigrations(conn, progress=None):
+	"""Run every pending migration step, one transaction each; returns the number of steps run"""
 	cursor = conn.cursor()
+	steps = 0
+	while True:
+		step = nextMigrationStep(cursor)
+		if step is None:
+			return steps
+		description, func = step
+		# Explicit BEGIN so the step's DDL is part of its transaction too
+		with conn:
+			conn.execute('BEGIN')
+			func(conn.cursor())
+		steps += 1
+		if progress is not None:
+			progress(description, steps)
+
+def partitionsMissingIndexes(cursor):
+	"""Days whose partitions were created before keyset pagination or the sensor topic and
+	field indexes, and lack them"""
+	cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name GLOB 'idx*_*'")
+	indexed = {row[0] for row in cursor.fetchall()}
+	days = set()
+	for prefix, suffixes in ((MESSAGE_PARTITION_PREFIX, ('Topic',)), (SENSOR_PARTITION_PREFIX, ('Topic', 'Field'))):
+		days.update(
+			day for day in listPartitions(cursor, prefix)
+			if any(f'idx{prefix}{day}{suffix}' not in indexed for suffix in suffixes)
+		)
+	return sorted(days)
+
+def buildPartitionIndexes(conn, day):
+	with conn:
+		cursor = conn.cursor()
+		if tableExists(cursor, MESSAGE_PARTITION_PREFIX + day):
+			createMessageIndexes(cursor, day)
+		if tableExists(cursor, SENSOR_PARTITION_PREFIX + day):
+			createSensorIndexes(cursor, day)
+
+# Timestamps in the stored layout ('YYYY-MM-DD HH:MM:SS.mmm'), from any text SQLite parses;
+# legacy tables held 'YYYY-MM-DD HH:MM:SS', which does not compare correctly against it
+STORED_TIMESTAMP_SQL = "CASE WHEN typeof(timestamp) = 'text' THEN strftime('%Y-%m-%d %H:%M:%f', timestamp) END"
+TIMESTAMP_LAYOUT_MIGRATION = 'timestampLayout'
+
+def tablesWithLegacyTimestamps(cursor):
+	"""Partitions that may still hold rows migrated before timestamps were normalised, plus
+	topics last; empty once every one has been through normaliseTimestamps"""
+	cursor.execute('SELECT name FROM schemaMigrations')
+	applied = {row[0] for row in cursor.fetchall()}
+	if TIMESTAMP_LAYOUT_MIGRATION in applied:
+		return []
+	tables = [
+		f'{prefix}{day}'
+		for prefix in (MESSAGE_PARTITION_PREFIX, SENSOR_PARTITION_PREFIX)
+		for day in listPartitions(cursor, prefix)
+		if f'{TIMESTAMP_LAYOUT_MIGRATION}:{prefix}{day}' not in applied
+	]
+	return tables + ['topics']
+
+def normaliseTimestamps(conn, table):
+	"""Rewrite one table's timestamps in the stored layout and record it as done.
+	topics is done last: its marker stands for every table."""
+	with conn:
+		if table == 'topics':
+			conn.execute(f'''
+				UPDATE topics SET
+					firstSeen = COALESCE({STORED_TIMESTAMP_SQL.replace('timestamp', 'firstSeen')}, firstSeen),
+					lastSeen = COALESCE({STORED_TIMESTAMP_SQL.replace('timestamp', 'lastSeen')}, lastSeen)
+				WHERE length(firstSeen) != 23 OR length(lastSeen) != 23
+			''')
+			conn.execute('DELETE FROM schemaMigrations WHERE name GLOB ?', (f'{TIMESTAMP_LAYOUT_MIGRATION}:*',))
+			name = TIMESTAMP_LAYOUT_MIGRATION
+		else:
+			conn.execute(f'''
+				UPDATE {table} SET timestamp = {STORED_TIMESTAMP_SQL}
+				WHERE length(timestamp) != 23 AND {STORED_TIMESTAMP_SQL} IS NOT NULL
+			''')
+			name = f'{TIMESTAMP_LAYOUT_MIGRATION}:{table}'
+		conn.execute(
+			'INSERT OR REPLACE INTO schemaMigrations (name, appliedAt) VALUES (?, ?)', (name, utcTimestamp())
+		)
+
+def migrateTopicIds(cursor):
+	"""Rewrite a legacy mqttMessages table (topic TEXT) to reference topics.id"""
+	print("Migrating mqttMessages to topic ids...")
+	
+	# Databases that predate the topics table need it filled first
+	cursor.execute('SELECT COUNT(*) FROM topics')
+	if cursor.fetchone()[0] == 0:
+		cursor.execute('''
+			INSERT INTO topics (topic, firstSeen, lastSeen, messageCount, lastPayload)
+			SELECT grouped.topic, grouped.firstSeen, grouped.lastSeen, grouped.messageCount, latest.payload
+			FROM (
+				SELECT topic, MIN(timestamp) AS firstSeen, MAX(timestamp) AS lastSeen,
+					COUNT(*) AS messageCount, MAX(id) AS lastId
+				FROM mqttMessages
+				GROUP BY topic
+			) AS grouped
+			JOIN mqttMessages AS latest ON latest.id = grouped.lastId
+		''')
 	
 	cursor.execute('''
-		CREATE TABLE IF NOT EXISTS mqttMessages(
+		CREATE TABLE mqttMessagesInterned(
 			id INTEGER PRIMARY KEY AUTOINCREMENT,
 			timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-			topic TEXT NOT NULL,
+			topicId INTEGER NOT NULL REFERENCES topics(id),
 			payload TEXT NOT NULL,
 			qos INTEGER DEFAULT 0,
 			retained INTEGER DEFAULT FALSE
 		)
 	''')
-	
 	cursor.execute('''
-		CREATE TABLE IF NOT EXISTS sensorData (
-			id INTEGER PRIMARY KEY AUTOINCREMENT,
+		INSERT INTO mqttMessagesInterned (id, timestamp, topicId, payload, qos, retained)
+		SELECT mqttMessages.id, mqttMessages.timestamp, topics.id, mqttMessages.payload,
+			mqttMessages.qos, mqttMessages.retained
+		FROM mqttMessages
+		JOIN topics ON topics.topic = mqttMessages.topic
+		ORDER BY mqttMessages.id
+	''')
+	cursor.execute('DROP TABLE mqttMessages')
+	cursor.execute('ALTER TABLE mqttMessagesInterned RENAME TO mqttMessages')
+
+# Columns moved from each legacy table into its daily partitions
+LEGACY_COLUMNS = {
+	'mqttMessages': (MESSAGE_PARTITION_PREFIX, 'id, timestamp, topicId, payload, qos, retained'),
+	'sensorData': (SENSOR_PARTITION_PREFIX, 'deviceId, sensorType, value, unit, timestamp, rawTopic')
+}
+
+def migrateNextDay(cursor, table):
+	"""Move one day of a legacy single table into its partition, and drop the table once it is empty"""
+	prefix, columns = LEGACY_COLUMNS[table]
+	# Rows are appended in time order, so the first rowid belongs to the oldest day left
+	cursor.execute(f'SELECT substr(timestamp, 1, 10) FROM {table} ORDER BY rowid LIMIT 1')
+	row = cursor.fetchone()
+	if row is None:
+		cursor.execute(f'DROP TABLE {table}')
+		return
+	
+	date = row[0]
+	print(f"Migrating {table} rows of {date} to a daily partition...")
+	day = partitionDay(date)
+	createPartition(cursor, day)
+	# Legacy rows have second-resolution timestamps; store them in the current layout
+	selected = columns.replace('timestamp', f'COALESCE({STORED_TIMESTAMP_SQL}, timestamp)')
+	cursor.execute(f'''
+		INSERT INTO {prefix}{day} ({columns})
+		SELECT {selected} FROM {table}
+		WHERE substr(timestamp, 1, 10) = ?
+	''', (date,))
+	cursor.execute(f'DELETE FROM {table} WHERE substr(timestamp, 1, 10) = ?', (date,))
+
+def tableExists(cursor, name):
+	cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+	return cursor.fetchone() is not None
+
+def partitionDay(timestamp):
+	"""'2026-10-17 12:34:56.789' -> '20261017'"""
+	return timestamp[0:4] + timestamp[5:7] + timestamp[8:10]
+
+def createPartition(cursor, day):
+	cursor.execute(f'''
+		CREATE TABLE IF NOT EXISTS {MESSAGE_PARTITION_PREFIX}{day} (
+			id INTEGER PRIMARY KEY,
+			timestamp DATETIME NOT NULL,
+			topicId INTEGER NOT NULL REFERENCES topics(id),
+			payload TEXT NOT NULL,
+			qos INTEGER DEFAULT 0,
+			retained INTEGER DEFAULT FALSE
+		)
+	''')
+	cursor.execute(f'''
+		CREATE TABLE IF NOT EXISTS {SENSOR_PARTITION_PREFIX}{day} (
+			id INTEGER PRIMARY KEY,
 			deviceId TEXT,
 			sensorType TEXT,
 			value REAL,
 			unit TEXT,
-			timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+			timestamp DATETIME NOT NULL,
 			rawTopic TEXT
 		)
 	''')
+	createMessageIndexes(cursor, day)
+	createSensorIndexes(cursor, day)
+
+def createMessageIndexes(cursor, day):
+	# Keyset pagination walks (timestamp, id), optionally within a topic; the
+	# rowid is the trailing column of every index, so id needs no column of its own
+	cursor.execute(f'''
+		CREATE INDEX IF NOT EXISTS idx{MESSAGE_PARTITION_PREFIX}{day}Time
+		ON {MESSAGE_PARTITION_PREFIX}{day} (timestamp)
+	''')
+	cursor.execute(f'''
+		CREATE INDEX IF NOT EXISTS idx{MESSAGE_PARTITION_PREFIX}{day}Topic
+		ON {MESSAGE_PARTITION_PREFIX}{day} (topicId, timestamp)
+	''')
+
+def createSensorIndexes(cursor, day):
+	# Covering index for per-series range scans: (deviceId, sensorType) equality plus
+	# a timestamp range, with value carried in the index so rows are never visited
+	cursor.execute(f'''
+		CREATE INDEX IF NOT EXISTS idx{SENSOR_PARTITION_PREFIX}{day}Series
+		ON {SENSOR_PARTITION_PREFIX}{day} (deviceId, sensorType, timestamp, value)
+	''')
+	# Recent readings of one topic, read by the hot cache on a miss
+	cursor.execute(f'''
+		CREATE INDEX IF NOT EXISTS idx{SENSOR_PARTITION_PREFIX}{day}Topic
+		ON {SENSOR_PARTITION_PREFIX}{day} (rawTopic, timestamp)
+	''')
+	# One field across all series in time order (/api/aggregate), value carried as in Series
+	cursor.execute(f'''
+		CREATE INDEX IF NOT EXISTS idx{SENSOR_PARTITION_PREFIX}{day}Field
+		ON {SENSOR_PARTITION_PREFIX}{day} (sensorType, timestamp, value)
+	''')
+
+def listPartitions(cursor, prefix=MESSAGE_PARTITION_PREFIX):
+	"""Days that have a partition table with this prefix, oldest first"""
+	cursor.execute(
+		"SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ?",
+		(prefix + '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]',)
+	)
+	return sorted(row[0][len(prefix):] for row in cursor.fetchall())
+
+def partitionsInRange(cursor, prefix, start=None, end=None):
+	"""Partition days that can hold timestamps in [start, end)"""
+	days = listPartitions(cursor, prefix)
+	if start is not None:
+		days = [day for day in days if day >= partitionDay(start)]
+	if end is not None:
+		days = [day for day in days if day <= partitionDay(end)]
+	return days
+
+def dropExpiredPartitions(conn, retentionDays=RETENTION_DAYS):
+	"""Drop whole daily partitions older than the retention window. Runs on the writer thread."""
+	if retentionDays is None:
+		return []
 	
-	conn.commit()
-	conn.close()
-	print("Database initialized.")
+	cutoff = (datetime.utcnow() - timedelta(days=retentionDays)).strftime('%Y%m%d')
+	cursor = conn.cursor()
+	expired = [day for day in listPartitions(cursor, MESSAGE_PARTITION_PREFIX) if day < cutoff]
+	expired += [
+		day for day in listPartitions(cursor, SENSOR_PARTITION_PREFIX)
+		if day < cutoff and day not in expired
+	]
+	
+	for day in expired:
+		with conn:
+			if tableExists(cursor, MESSAGE_PARTITION_PREFIX + day):
+				# Keep the topic catalog's counts in line with what is still stored
+				cursor.execute(f'''
+					SELECT topicId, COUNT(*) FROM {MESSAGE_PARTITION_PREFIX}{day} GROUP BY topicId
+				''')
+				counts = dict(cursor.fetchall())
+				cursor.executemany(
+					'UPDATE topics SET messageCount = messageCount - ? WHERE id = ?',
+					[(count, topicId) for topicId, count in counts.items()]
+				)
+				topicCatalog.subtract(counts)
+			cursor.execute(f'DROP TABLE IF EXISTS {MESSAGE_PARTITION_PREFIX}{day}')
+			cursor.execute(f'DROP TABLE IF EXISTS {SENSOR_PARTITION_PREFIX}{day}')
+			# A partition created again for this day starts its rowids over
+			cursor.execute('DELETE FROM rollupProgress WHERE day = ?', (day,))
+		print(f"Dropped expired partition {day}")
+	
+	if expired:
+		cursor.execute('PRAGMA incremental_vacuum')
+		cursor.fetchall()
+	return expired
 
-def saveMessage(topic, payload, qos=0, retained=False):
-	conn = sqlite3.connect('mqttData.db')
+def utcTimestamp():
+	"""Receive time in the same layout as CURRENT_TIMESTAMP, with milliseconds"""
+	return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+def toDbTimestamp(value):
+	"""Normalise epoch seconds or an ISO-8601 string to the stored timestamp layout"""
+	if value is None:
+		return None
+	if isinstance(value, (int, float)):
+		return datetime.utcfromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+	
+	text = str(value).strip()
+	if len(text) == 23 and text[10] == ' ' and text[19] == '.':
+		# Already in the stored layout
+		return text
+	try:
+		return toDbTimestamp(float(text))
+	except ValueError:
+		pass
+	
+	parsed = datetime.fromisoformat(text.replace('Z', '+00:00'))
+	if parsed.tzinfo is not None:
+		parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+	return parsed.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+class TopicCatalog:
+	"""In-memory mirror of the topics table, updated by the writer after each commit.
+
+	Stats and topic listings are answered from here, so their cost depends on
+	the number of topics rather than the number of stored messages.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.topics = {}
+		self.totalMessages = 0
+		self.loaded = False
+		
+		# Intern map shared by the ingest path and the read APIs
+		self.ids = {}
+		self.names = {}
+		self.nextId = 1
+
+	def load(self, conn=None):
+		ownConnection = conn is None
+		if ownConnection:
+			conn = sqlite3.connect(DB_PATH)
+		cursor = conn.cursor()
+		cursor.execute('SELECT id, topic, firstSeen, lastSeen, messageCount, lastPayload FROM topics')
+		topics = {
+			row[1]: {
+				"id": row[0],
+				"topic": row[1],
+				"firstSeen": row[2],
+				"lastSeen": row[3],
+				"messageCount": row[4],
+				"lastPayload": row[5]
+			}
+			for row in cursor.fetchall()
+		}
+		if ownConnection:
+			conn.close()
+		
+		with self.lock:
+			self.topics = topics
+			self.totalMessages = sum(entry["messageCount"] for entry in topics.values())
+			for topic, entry in topics.items():
+				self.ids[topic] = entry["id"]
+				self.names[entry["id"]] = topic
+			self.nextId = max([self.nextId] + [topicId + 1 for topicId in self.names])
+			self.loaded = True
+
+	def intern(self, topic):
+		"""Id for topic, allocating one if it has never been seen.
+
+		Only the writer inserts into topics, so ids can be handed out here and the
+		topics row is written in the same batch as the first message that uses it.
+		"""
+		topicId = self.ids.get(topic)
+		if topicId is None:
+			with self.lock:
+				topicId = self.ids.get(topic)
+				if topicId is None:
+					topicId = self.nextId
+					self.nextId += 1
+					self.ids[topic] = topicId
+					self.names[topicId] = topic
+		return topicId
+
+	def topicName(self, topicId, cursor=None):
+		name = self.names.get(topicId)
+		if name is None and cursor is not None:
+			# Written by another process since the cache was filled
+			cursor.execute('SELECT topic FROM topics WHERE id = ?', (topicId,))
+			row = cursor.fetchone()
+			if row:
+				name = row[0]
+				with self.lock:
+					self.names[topicId] = name
+					self.ids.setdefault(name, topicId)
+		return name
+
+	def ensureLoaded(self):
+		if not self.loaded:
+			self.load()
+
+	def apply(self, updates):
+		"""Fold one committed batch of per-topic updates into the cache"""
+		with self.lock:
+			for topic, update in updates.items():
+				entry = self.topics.get(topic)
+				if entry is None:
+					entry = {
+						"id": update["id"],
+						"topic": topic,
+						"firstSeen": update["firstSeen"],
+						"lastSeen": None,
+						"messageCount": 0,
+						"lastPayload": None
+					}
+					self.topics[topic] = entry
+				entry["lastSeen"] = update["lastSeen"]
+				entry["messageCount"] += update["messageCount"]
+				entry["lastPayload"] = update["lastPayload"]
+				self.totalMessages += update["messageCount"]
+
+	def subtract(self, countsById):
+		"""Remove the messages of a dropped partition from the cached counts"""
+		with self.lock:
+			for topicId, count in countsById.items():
+				entry = self.topics.get(self.names.get(topicId))
+				if entry is not None:
+					entry["messageCount"] -= count
+					self.totalMessages -= count
+
+	def getTopics(self):
+		self.ensureLoaded()
+		with self.lock:
+			return [dict(entry) for entry in self.topics.values()]
+
+	def lastPayload(self, topic):
+		"""Last stored payload text of topic, or None if it has never been stored"""
+		self.ensureLoaded()
+		entry = self.topics.get(topic)
+		return entry["lastPayload"] if entry is not None else None
+
+	def getTopicCount(self):
+		self.ensureLoaded()
+		return len(self.topics)
+
+	def getMessageCount(self):
+		self.ensureLoaded()
+		return self.totalMessages
+
+# Global instance
+topicCatalog = TopicCatalog()
+
+# Ingest log records are packed, never pickled, so replaying a log cannot run code
+# found in it: qos, retained, reading count and the UTF-8 byte lengths of the
+# timestamp, topic and payload, then those strings; then per reading its value
+# (and whether it is None) and the lengths of deviceId, sensorType, unit and
+# timestamp, then those strings. NULL_LENGTH stands for a None string.
+LOG_RECORD = struct.Struct('<BBHIII')
+LOG_READING = struct.Struct('<d?IIII')
+NULL_LENGTH = 0xFFFFFFFF
+
+def encodeLogRecord(timestamp, topic, payload, qos, retained, sensorRows):
+	timestampBytes = timestamp.encode('utf-8')
+	topicBytes = topic.encode('utf-8')
+	payloadBytes = payload.encode('utf-8')
+	parts = [
+		LOG_RECORD.pack(qos, retained, len(sensorRows), len(timestampBytes), len(topicBytes), len(payloadBytes)),
+		timestampBytes, topicBytes, payloadBytes
+	]
+	for deviceId, sensorType, value, unit, readingTimestamp, _ in sensorRows:
+		strings = [
+			None if text is None else str(text).encode('utf-8')
+			for text in (deviceId, sensorType, unit, readingTimestamp)
+		]
+		lengths = [NULL_LENGTH if text is None else len(text) for text in strings]
+		parts.append(LOG_READING.pack(0.0 if value is None else value, value is None, *lengths))
+		parts.extend(text for text in strings if text is not None)
+	return b''.join(parts)
+
+def decodeLogRecord(data):
+	"""(timestamp, topic, payload, qos, retained, sensorRows) of an encodeLogRecord record"""
+	qos, retained, readingCount, timestampLength, topicLength, payloadLength = LOG_RECORD.unpack_from(data)
+	start = LOG_RECORD.size
+	topicStart = start + timestampLength
+	payloadStart = topicStart + topicLength
+	offset = payloadStart + payloadLength
+	timestamp = data[start:topicStart].decode('utf-8')
+	topic = data[topicStart:payloadStart].decode('utf-8')
+	payload = data[payloadStart:offset].decode('utf-8')
+	
+	sensorRows = []
+	for _ in range(readingCount):
+		value, isNull, *lengths = LOG_READING.unpack_from(data, offset)
+		offset += LOG_READING.size
+		strings = []
+		for length in lengths:
+			if length == NULL_LENGTH:
+				strings.append(None)
+			else:
+				strings.append(data[offset:offset + length].decode('utf-8'))
+				offset += length
+		deviceId, sensorType, unit, readingTimestamp = strings
+		sensorRows.append((deviceId, sensorType, None if isNull else value, unit, readingTimestamp, topic))
+	if offset != len(data):
+		raise ValueError("Ingest log record has trailing bytes")
+	return timestamp, topic, payload, qos, retained, sensorRows
+
+class WriterTask:
+	"""A function to run on the writer thread with its connection, between batches"""
+
+	def __init__(self, func):
+		self.func = func
+		self.future = Future()
+
+class DatabaseWriter:
+	"""Owns the only write connection and commits queued rows in batches.
+
+	Message ids are allocated here when a row is queued, so callers get the id
+	back immediately and the batch can be written with a single executemany.
+	Rows are queued by appending them to the on-disk ingest log, which the
+	writer reads back in order: a database stall or crash only grows the log,
+	and whatever was not committed is replayed on the next start. Maintenance
+	work (retention, rollups) is passed in with call() so it never competes
+	with ingest for the write lock.
+	"""
+
+	def __init__(self, dbPath=DB_PATH, batchSize=WRITER_BATCH_SIZE, maxDelay=WRITER_MAX_DELAY,
+			maxQueueSize=WRITER_QUEUE_SIZE, synchronous=WRITER_SYNCHRONOUS, logDir=INGEST_LOG_DIR):
+		self.dbPath = dbPath
+		self.batchSize = batchSize
+		self.maxDelay = maxDelay
+		self.synchronous = synchronous
+		self.queue = queue.Queue(maxsize=maxQueueSize)
+		self.log = SegmentLog(logDir)
+		self.readPosition = None
+		self.committedId = 0
+		self.firstLiveId = 1
+		self.conn = None
+		self.lockFile = None
+		self.thread = None
+		self.running = False
+		self.idLock = threading.Lock()
+		self.startLock = threading.Lock()
+		self.nextId = 1
+		self.partitions = set()
+		
+		self.replayedRows = 0
+		self.duplicateRows = 0
+		self.unreadableRows = 0
+		self.retries = 0
+		self.totalRows = 0
+		self.totalSensorRows = 0
+		self.totalFlushes = 0
+		self.failedRows = 0
+		self.lastBatchSize = 0
+		self.lastFlushMs = 0.0
+		self.maxFlushMs = 0.0
+		self.totalFlushMs = 0.0
+
+	def start(self):
+		with self.startLock:
+			if self.running:
+				return
+			
+			# Message and topic ids are handed out in this process, so only one writer may run per database
+			self.lockFile = lockExclusive(f"{self.dbPath}{WRITER_LOCK_SUFFIX}")
+			try:
+				self.open()
+			except Exception:
+				self.lockFile.close()
+				self.lockFile = None
+				raise
+			
+			self.running = True
+			self.thread = threading.Thread(target=self.run, name="databaseWriter", daemon=True)
+			self.thread.start()
+
+	def open(self):
+		self.conn = sqlite3.connect(self.dbPath, check_same_thread=False)
+		try:
+			self.conn.execute('PRAGMA journal_mode=WAL')
+			self.conn.execute(f'PRAGMA synchronous={self.synchronous}')
+			self.nextId = self.loadNextId()
+			topicCatalog.load(self.conn)
+			payloadCodec.load(self.conn)
+			
+			# Rows logged after the checkpoint are replayed; a crash between a
+			# commit and its checkpoint leaves some that are already stored
+			self.log.open()
+		except Exception:
+			self.log.close()
+			self.conn.close()
+			self.conn = None
+			raise
+		self.committedId = self.nextId - 1
+		self.nextId = max(self.nextId, self.log.lastId + 1)
+		self.firstLiveId = self.nextId
+		self.readPosition = self.log.checkpoint
+		if self.log.hasRecordsAfter(self.readPosition):
+			print(f"Replaying ingest log from segment {self.readPosition[0]}, offset {self.readPosition[1]}")
+
+	def stop(self, timeout=5.0):
+		if not self.running:
+			return
+		self.running = False
+		self.thread.join(timeout)
+		self.log.close()
+		self.conn.close()
+		self.conn = None
+		self.lockFile.close()
+		self.lockFile = None
+
+	def loadNextId(self):
+		cursor = self.conn.cursor()
+		maxId = 0
+		days = listPartitions(cursor, MESSAGE_PARTITION_PREFIX)
+		self.partitions = set(days)
+		# Ids only grow, so the newest non-empty partition holds the maximum
+		for day in reversed(days):
+			cursor.execute(f'SELECT MAX(id) FROM {MESSAGE_PARTITION_PREFIX}{day}')
+			maxId = cursor.fetchone()[0] or 0
+			if maxId:
+				break
+		return maxId + 1
+
+	def submit(self, topic, payload, qos=0, retained=False, timestamp=None, readings=None):
+		timestamp = timestamp or utcTimestamp()
+		sensorRows = []
+		for reading in readings or []:
+			try:
+				readingTimestamp = toDbTimestamp(reading.get('timestamp')) or timestamp
+			except (ValueError, OverflowError, OSError):
+				readingTimestamp = timestamp
+			sensorRows.append((
+				reading['deviceId'],
+				reading['sensorType'],
+				reading['value'],
+				reading.get('unit'),
+				readingTimestamp,
+				topic
+			))
+		record = encodeLogRecord(timestamp, topic, payload, qos, int(retained), sensorRows)
+		
+		# Ids go into the log in order, so replay and the id sequence agree
+		with self.idLock:
+			messageId = self.nextId
+			self.nextId += 1
+			self.log.append(messageId, record)
+		return messageId
+
+	def flush(self):
+		"""Block until every row logged so far has been committed"""
+		while self.running and self.log.hasRecordsAfter(self.readPosition):
+			time.sleep(self.maxDelay)
+		self.queue.join()
+
+	def call(self, func):
+		"""Run func(conn) on the writer thread; returns a Future with its result"""
+		if not self.running:
+			self.start()
+		task = WriterTask(func)
+		self.queue.put(task)
+		return task.future
+
+	def run(self):
+		records = []
+		position = self.readPosition
+		while True:
+			while not self.queue.empty():
+				self.runTask(self.queue.get())
+			
+			if len(records) < self.batchSize:
+				more, position = self.log.read(position, self.batchSize - len(records))
+				records += more
+			if not records and not self.running and self.queue.empty():
+				break
+			if len(records) < self.batchSize and self.running:
+				# Give the batch up to maxDelay to fill; a queued task ends the wait early
+				self.waitForTask(self.maxDelay)
+				more, position = self.log.read(position, self.batchSize - len(records))
+				records += more
+			if not records:
+				continue
+			
+			batch, unreadable = self.loggedRows(records)
+			if batch and not self.writeBatch(batch):
+				# Database locked or unavailable: the rows stay in the log, try them again
+				if not self.running:
+					break
+				self.retries += 1
+				self.waitForTask(WRITER_RETRY_DELAY)
+				continue
+			self.log.commit(position, len(records), records[-1][0])
+			self.readPosition = position
+			self.replayedRows += sum(1 for row, _, _ in batch if row[0] < self.firstLiveId)
+			self.duplicateRows += len(records) - len(batch) - unreadable
+			if unreadable:
+				print(f"Ingest log: skipped {unreadable} records that are not in this version's format")
+				self.unreadableRows += unreadable
+			records = []
+
+	def waitForTask(self, timeout):
+		try:
+			task = self.queue.get(timeout=timeout)
+		except queue.Empty:
+			return
+		self.runTask(task)
+
+	def loggedRows(self, records):
+		"""Writer batch items for records read back from the ingest log, and how many could not be read"""
+		batch = []
+		unreadable = 0
+		for messageId, data in records:
+			if messageId <= self.committedId:
+				# Committed before a crash, but the checkpoint never moved past it
+				continue
+			try:
+				timestamp, topic, payload, qos, retained, sensorRows = decodeLogRecord(data)
+			except (struct.error, ValueError):
+				# Not a record this version wrote (older logs used pickle, which is not replayed)
+				unreadable += 1
+				continue
+			row = (messageId, timestamp, topicCatalog.intern(topic), payload, qos, retained)
+			batch.append((row, sensorRows, topic))
+		return batch, unreadable
+
+	def runTask(self, task):
+		try:
+			task.future.set_result(task.func(self.conn))
+		except Exception as e:
+			task.future.set_exception(e)
+		finally:
+			self.queue.task_done()
+
+	def ensurePartition(self, day):
+		if day not in self.partitions:
+			createPartition(self.conn.cursor(), day)
+			self.partitions.add(day)
+
+	def writeBatch(self, batch):
+		"""Commit a batch; False means the database was unavailable and the batch should be retried.
+
+		A constraint error is down to one row, so the batch is split in halves
+		until that row is alone; every other row still commits.
+		"""
+		try:
+			self.commitBatch(batch)
+		except sqlite3.Error as e:
+			# A rolled-back CREATE TABLE must be re-created with the next batch
+			try:
+				self.partitions = set(listPartitions(self.conn.cursor(), MESSAGE_PARTITION_PREFIX))
+			except sqlite3.Error:
+				self.partitions = set()
+			if isinstance(e, sqlite3.OperationalError):
+				# Locked, disk full, I/O error: worth retrying once the database recovers
+				print(f"Database unavailable, retrying batch of {len(batch)} messages: {e}")
+				return False
+			if len(batch) > 1:
+				middle = len(batch) // 2
+				return self.writeBatch(batch[:middle]) and self.writeBatch(batch[middle:])
+			self.failedRows += 1
+			print(f"Error writing message {batch[0][0][0]} on {batch[0][2]}: {e}")
+		# Ids are logged in order: a retry after a later half failed skips what is stored
+		self.committedId = max(self.committedId, batch[-1][0][0])
+		return True
+
+	def commitBatch(self, batch):
+		messageRows = [row for row, _, _ in batch]
+		payloadCodec.beginBatch()
+		if payloadCodec.enabled:
+			# topics.lastPayload keeps the text; only the partition rows are compressed
+			messageRows = [row[:3] + (payloadCodec.encode(topic, row[3]),) + row[4:] for row, _, topic in batch]
+		sensorRows = [sensorRow for _, rows, _ in batch for sensorRow in rows]
+		
+		# Collapse the batch to one topics upsert per distinct topic
+		topicUpdates = {}
+		for (messageId, timestamp, topicId, payload, qos, retained), _, topic in batch:
+			update = topicUpdates.get(topic)
+			if update is None:
+				topicUpdates[topic] = {
+					"id": topicId,
+					"firstSeen": timestamp,
+					"lastSeen": timestamp,
+					"messageCount": 1,
+					"lastPayload": payload
+				}
+			else:
+				update["lastSeen"] = timestamp
+				update["messageCount"] += 1
+				update["lastPayload"] = payload
+		
+		# Messages go to the partition of their receive time, readings to that of their own timestamp
+		messagesByDay = {}
+		for row in messageRows:
+			messagesByDay.setdefault(partitionDay(row[1]), []).append(row)
+		sensorRowsByDay = {}
+		for row in sensorRows:
+			sensorRowsByDay.setdefault(partitionDay(row[4]), []).append(row)
+		
+		started = time.perf_counter()
+		# Raw messages and their readings commit in the same transaction
+		with self.conn:
+			for day in messagesByDay.keys() | sensorRowsByDay.keys():
+				self.ensurePartition(day)
+			# Dictionaries commit with the first rows compressed with them
+			savedDictionaries = payloadCodec.saveDictionaries(self.conn)
+			for day, rows in messagesByDay.items():
+				self.conn.executemany(f'''
+					INSERT INTO {MESSAGE_PARTITION_PREFIX}{day} (id, timestamp, topicId, payload, qos, retained)
+					VALUES (?, ?, ?, ?, ?, ?)
+				''', rows)
+			for day, rows in sensorRowsByDay.items():
+				self.conn.executemany(f'''
+					INSERT INTO {SENSOR_PARTITION_PREFIX}{day} (deviceId, sensorType, value, unit, timestamp, rawTopic)
+					VALUES (?, ?, ?, ?, ?, ?)
+				''', rows)
+			self.conn.executemany('''
+				INSERT INTO topics (id, topic, firstSeen, lastSeen, messageCount, lastPayload)
+				VALUES (?, ?, ?, ?, ?, ?)
+				ON CONFLICT(id) DO UPDATE SET
+					lastSeen = excluded.lastSeen,
+					messageCount = messageCount + excluded.messageCount,
+					lastPayload = excluded.lastPayload
+			''', [
+				(update["id"], topic, update["firstSeen"], update["lastSeen"], update["messageCount"], update["lastPayload"])
+				for topic, update in topicUpdates.items()
+			])
+		
+		topicCatalog.apply(topicUpdates)
+		payloadCodec.markSaved(savedDictionaries)
+		
+		elapsedMs = (time.perf_counter() - started) * 1000
+		self.totalRows += len(batch)
+		self.totalSensorRows += len(sensorRows)
+		self.totalFlushes += 1
+		self.lastBatchSize = len(batch)
+		self.lastFlushMs = elapsedMs
+		self.totalFlushMs += elapsedMs
+		self.maxFlushMs = max(self.maxFlushMs, elapsedMs)
+		FLUSH_SECONDS.observe(elapsedMs / 1000)
+		FLUSH_ROWS.observe(len(batch))
+
+	def getStats(self):
+		flushes = self.totalFlushes or 1
+		return {
+			"running": self.running,
+			"pendingTasks": self.queue.qsize(),
+			"log": self.log.getStats(),
+			"replayedRows": self.replayedRows,
+			"duplicateRows": self.duplicateRows,
+			"unreadableRows": self.unreadableRows,
+			"retries": self.retries,
+			"batchSizeLimit": self.batchSize,
+			"maxDelayMs": self.maxDelay * 1000,
+			"lastBatchSize": self.lastBatchSize,
+			"avgBatchSize": round(self.totalRows / flushes, 2),
+			"lastFlushMs": round(self.lastFlushMs, 3),
+			"avgFlushMs": round(self.totalFlushMs / flushes, 3),
+			"maxFlushMs": round(self.maxFlushMs, 3),
+			"totalFlushes": self.totalFlushes,
+			"totalRows": self.totalRows,
+			"totalSensorRows": self.totalSensorRows,
+			"failedRows": self.failedRows
+		}
+
+# Global instance
+writer = DatabaseWriter()
+
+FLUSH_SECONDS = histogram('historian_db_flush_seconds', 'Time to commit one writer batch')
+FLUSH_ROWS = histogram('historian_db_flush_rows', 'Messages committed per writer batch', SIZE_BUCKETS)
+callbackCounter('historian_db_rows_total', 'Messages committed by the writer', lambda: writer.totalRows)
+callbackCounter('historian_db_failed_rows_total', 'Messages dropped after a non-retryable database error', lambda: writer.failedRows)
+callbackCounter('historian_db_duplicate_rows_total', 'Logged messages skipped on replay because they were already stored', lambda: writer.duplicateRows)
+callbackCounter('historian_db_retries_total', 'Batches retried while the database was unavailable', lambda: writer.retries)
+gauge('historian_ingest_log_backlog_bytes', 'Ingest log bytes not yet committed to the database',
+	lambda: writer.log.getStats()["backlogBytes"] if writer.log.writeSegment else None)
+gauge('historian_db_pending_tasks', 'Maintenance tasks queued for the writer thread', lambda: writer.queue.qsize())
+
+def startWriter():
+	writer.start()
+
+def stopWriter():
+	writer.stop()
+
+def getWriterStats():
+	return writer.getStats()
+
+def saveMessage(topic, payload, qos=0, retained=False, readings=None, timestamp=None):
+	if not writer.running:
+		writer.start()
+	return writer.submit(topic, payload, qos, retained, timestamp, readings)
+
+def getSensorReadings(deviceId, sensorType, start=None, end=None, limit=10000):
+	"""Readings for one series in [start, end), oldest first.
+
+	Only the daily partitions overlapping the range are visited, each through
+	its (deviceId, sensorType, timestamp, value) covering index.
+	"""
+	start = toDbTimestamp(start)
+	end = toDbTimestamp(end)
+	
+	conn = sqlite3.connect(DB_PATH)
 	cursor = conn.cursor()
 	
-	cursor.execute('''
-		INSERT INTO mqttMessages (topic, payload, qos, retained)
-		VALUES (?, ?, ?, ?)
-	''', (topic, payload, qos, int(retained)))
+	readings = []
+	unitPartition = None
+	for day in partitionsInRange(cursor, SENSOR_PARTITION_PREFIX, start, end):
+		query = f'''
+			SELECT timestamp, value
+			FROM {SENSOR_PARTITION_PREFIX}{day}
+			WHERE deviceId = ? AND sensorType = ?
+		'''
+		params = [deviceId, sensorType]
+		if start is not None:
+			query += ' AND timestamp >= ?'
+			params.append(start)
+		if end is not None:
+			query += ' AND timestamp < ?'
+			params.append(end)
+		query += ' ORDER BY timestamp LIMIT ?'
+		params.append(limit - len(readings))
+		
+		cursor.execute(query, params)
+		rows = cursor.fetchall()
+		if rows:
+			readings.extend(rows)
+			unitPartition = day
+		if len(readings) >= limit:
+			break
 	
-	conn.commit()
+	unit = None
+	if unitPartition is not None:
+		cursor.execute(f'''
+			SELECT unit FROM {SENSOR_PARTITION_PREFIX}{unitPartition}
+			WHERE deviceId = ? AND sensorType = ?
+			ORDER BY timestamp DESC
+			LIMIT 1
+		''', (deviceId, sensorType))
+		unit = cursor.fetchone()[0]
 	conn.close()
-	return cursor.lastrowid
+	
+	return {
+		"unit": unit,
+		"readings": [
+			{
+				"timestamp": reading[0],
+				"value": reading[1]
+			}
+			for reading in readings
+		]
+	}
 
 def getRecentMessages(limit=10):
-	conn = sqlite3.connect('mqttData.db')
+	conn = sqlite3.connect(DB_PATH)
 	cursor = conn.cursor()
 	
-	cursor.execute('''
-		SELECT id, timestamp, topic, payload
-		FROM mqttMessages
-		ORDER BY timestamp DESC
-		LIMIT ?
-	''', (limit,))
-	
-	messages = cursor.fetchall()
-	conn.close()
+	# Newest partition first; older days are only touched if it has fewer than limit rows
+	messages = []
+	for day in reversed(listPartitions(cursor, MESSAGE_PARTITION_PREFIX)):
+		cursor.execute(f'''
+			SELECT id, timestamp, topicId, payload
+			FROM {MESSAGE_PARTITION_PREFIX}{day}
+			ORDER BY id DESC
+			LIMIT ?
+		''', (limit - len(messages),))
+		messages.extend(cursor.fetchall())
+		if len(messages) >= limit:
+			break
 	
-	return [
+	# Topic names come from the catalog cache instead of a SQL join
+	result = [
 		{
 			"id": msg[0],
 			"timestamp": msg[1],
-			"topic": msg[2],
-			"payload": msg[3]
+			"topic": topicCatalog.topicName(msg[2], cursor),
+			"payload": decodeStoredPayload(msg[3], cursor)
 		} 
 		for msg in messages
 	]
+	conn.close()
+	return result
+
+def encodeMessageCursor(timestamp, messageId):
+	return base64.urlsafe_b64encode(f"{timestamp}|{messageId}".encode()).decode()
+
+def decodeMessageCursor(token):
+	"""(timestamp, id) from a cursor returned by getMessagesPage; ValueError if malformed"""
+	try:
+		timestamp, messageId = base64.urlsafe_b64decode(token.encode()).decode().split('|')
+		# The row's own timestamp text, not re-normalised: keyset comparisons must match what is stored
+		return timestamp, int(messageId)
+	except (ValueError, UnicodeError) as e:
+		raise ValueError(f"Invalid cursor: {token}") from e
+
+def topicIdsForFilter(topicFilter):
+	"""Topic ids an exact topic or MQTT filter selects, from the catalog"""
+	validateFilter(topicFilter)
+	return sorted(
+		entry["id"] for entry in topicCatalog.getTopics()
+		if topicMatches(topicFilter, entry["topic"])
+	)
+
+def iterMessages(topic=None, start=None, end=None, after=None, descending=True, chunkSize=EXPORT_CHUNK_SIZE):
+	"""Yield lists of message rows in (timestamp, id) order, at most chunkSize rows at a time.
+
+	Each chunk is a separate keyset query that resumes after the last row of
+	the previous one, so no read transaction stays open across chunks and
+	memory does not grow with the number of rows. after is a (timestamp, id)
+	position to continue from; topic may be an MQTT filter.
+	"""
+	start = toDbTimestamp(start)
+	end = toDbTimestamp(end)
+	topicIds = topicIdsForFilter(topic) if topic else None
+	if topicIds == []:
+		return
+	
+	conn = sqlite3.connect(DB_PATH)
+	cursor = conn.cursor()
+	try:
+		days = partitionsInRange(cursor, MESSAGE_PARTITION_PREFIX, start, end)
+		if after is not None:
+			afterDay = partitionDay(after[0])
+			days = [day for day in days if (day <= afterDay if descending else day >= afterDay)]
+		if descending:
+			days.reverse()
+		
+		conditions = []
+		params = []
+		if topicIds is not None and len(topicIds) == 1:
+			conditions.append('topicId = ?')
+			params.extend(topicIds)
+		elif topicIds is not None:
+			# Several topics: walk the time index and filter, rather than sort every match per chunk
+			conditions.append(f"+topicId IN ({', '.join('?' * len(topicIds))})")
+			params.extend(topicIds)
+		if start is not None:
+			conditions.append('timestamp >= ?')
+			params.append(start)
+		if end is not None:
+			conditions.append('timestamp < ?')
+			params.append(end)
+		direction = 'DESC' if descending else 'ASC'
+		
+		for day in days:
+			position = after
+			while True:
+				where = list(conditions)
+				if position is not None:
+					where.append(f"(timestamp, id) {'<' if descending else '>'} (?, ?)")
+				cursor.execute(f'''
+					SELECT id, timestamp, topicId, payload, qos, retained
+					FROM {MESSAGE_PARTITION_PREFIX}{day}
+					{'WHERE ' + ' AND '.join(where) if where else ''}
+					ORDER BY timestamp {direction}, id {direction}
+					LIMIT ?
+				''', params + list(position or ()) + [chunkSize])
+				rows = cursor.fetchall()
+				if not rows:
+					break
+				yield [
+					(row[0], row[1], topicCatalog.topicName(row[2], cursor), decodeStoredPayload(row[3], cursor), row[4], bool(row[5]))
+					for row in rows
+				]
+				if len(rows) < chunkSize:
+					break
+				position = (rows[-1][1], rows[-1][0])
+	finally:
+		conn.close()
+
+def getMessagesPage(limit=10, cursor=None, topic=None, start=None, end=None, descending=True):
+	"""One page of messages, newest first by default, and the cursor for the next page (None at the end)"""
+	limit = max(1, min(limit, MAX_PAGE_SIZE))
+	after = decodeMessageCursor(cursor) if cursor else None
+	
+	rows = []
+	for chunk in iterMessages(topic, start, end, after, descending, limit + 1 - len(rows)):
+		rows.extend(chunk)
+		if len(rows) > limit:
+			break
+	
+	nextCursor = None
+	if len(rows) > limit:
+		rows = rows[:limit]
+		nextCursor = encodeMessageCursor(rows[-1][1], rows[-1][0])
+	return {
+		"messages": [dict(zip(EXPORT_COLUMNS, row)) for row in rows],
+		"nextCursor": nextCursor
+	}
+
+def exportMessages(format='ndjson', topic=None, start=None, end=None, descending=False):
+	"""Yield NDJSON or CSV text, one chunk per query, for every matching message"""
+	if format not in ('ndjson', 'csv'):
+		raise ValueError(f"Unsupported export format: {format}")
+	chunks = iterMessages(topic, start, end, descending=descending)
+	
+	if format == 'ndjson':
+		for rows in chunks:
+			yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+		return
+	
+	buffer = io.StringIO()
+	output = csv.writer(buffer)
+	output.writerow(EXPORT_COLUMNS)
+	for rows in chunks:
+		output.writerows(rows)
+		yield buffer.getvalue()
+		buffer.seek(0)
+		buffer.truncate()
+	if buffer.tell():
+		yield buffer.getvalue()
+
+def getRecentReadings(topic, since):
+	"""(epoch seconds, sensorType, value, unit) of the readings from one topic at or after since, oldest first"""
+	start = toDbTimestamp(since)
+	conn = sqlite3.connect(DB_PATH)
+	cursor = conn.cursor()
+	readings = []
+	for day in partitionsInRange(cursor, SENSOR_PARTITION_PREFIX, start):
+		cursor.execute(f'''
+			SELECT (julianday(timestamp) - 2440587.5) * 86400.0, sensorType, value, unit
+			FROM {SENSOR_PARTITION_PREFIX}{day}
+			WHERE rawTopic = ? AND timestamp >= ? AND value IS NOT NULL
+			ORDER BY timestamp
+		''', (topic, start))
+		readings.extend(cursor.fetchall())
+	conn.close()
+	return readings
+
+def getLatestPartitionReadings(window, maxRows):
+	"""(rawTopic, epoch seconds, sensorType, value, unit) of up to maxRows readings in the newest
+	sensor partition within window seconds of its last one, oldest first"""
+	conn = sqlite3.connect(DB_PATH)
+	cursor = conn.cursor()
+	days = listPartitions(cursor, SENSOR_PARTITION_PREFIX)
+	readings = []
+	if days:
+		table = f'{SENSOR_PARTITION_PREFIX}{days[-1]}'
+		# Rows are appended in time order, so the last maxRows rowids hold the newest readings;
+		# a rowid range is a primary key scan however large the partition is
+		cursor.execute(f'SELECT id, timestamp FROM {table} ORDER BY id DESC LIMIT 1')
+		row = cursor.fetchone()
+		if row is not None:
+			lastId, lastTimestamp = row
+			cursor.execute(f'''
+				SELECT rawTopic, (julianday(timestamp) - 2440587.5) * 86400.0, sensorType, value, unit
+				FROM {table}
+				WHERE id > ? AND timestamp >= datetime(?, ?) AND rawTopic IS NOT NULL AND value IS NOT NULL
+				ORDER BY id
+			''', (lastId - maxRows, lastTimestamp, f'-{int(window)} seconds'))
+			readings = cursor.fetchall()
+	conn.close()
+	return readings
+
+def getAlerts(limit=100, rule=None, state=None, since=None):
+	"""Alerts from systemAlerts, newest first"""
+	conditions = []
+	params = []
+	if rule is not None:
+		conditions.append('rule = ?')
+		params.append(rule)
+	if state is not None:
+		conditions.append('state = ?')
+		params.append(state)
+	if since is not None:
+		conditions.append('timestamp >= ?')
+		params.append(toDbTimestamp(since))
+	
+	conn = sqlite3.connect(DB_PATH)
+	cursor = conn.cursor()
+	cursor.execute(f'''
+		SELECT id, timestamp, rule, severity, state, topic, deviceId, field, value, message
+		FROM systemAlerts
+		{'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+		ORDER BY timestamp DESC, id DESC
+		LIMIT ?
+	''', params + [max(1, min(limit, MAX_PAGE_SIZE))])
+	columns = [column[0] for column in cursor.description]
+	alerts = [dict(zip(columns, row)) for row in cursor.fetchall()]
+	conn.close()
+	return alerts
 
 def getMessageCount():
-    conn = sqlite3.connect('mqttData.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM mqttMessages')
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    return topicCatalog.getMessageCount()
 
 def getUniqueTopics():
-    conn = sqlite3.connect('mqttData.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT topic FROM mqttMessages')
-    topics = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return topics
\ No newline at end of file
+    return [entry["topic"] for entry in topicCatalog.getTopics()]
+
+def getTopicCount():
+    return topicCatalog.getTopicCount()
+
+def getTopics(limit=None):
+    """Topic catalog entries, most recently seen first"""
+    topics = sorted(topicCatalog.getTopics(), key=lambda entry: entry["lastSeen"] or '', reverse=True)
+    return topics[:limit] if limit else topics
\ No newline at end of file
@@ -0,0 +1,117 @@
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from payloadDecoders import decodePayload, payloadText
+
+# Identical messages (same topic and payload) received within DEDUP_WINDOW
+# seconds of each other are stored once. Overlapping subscriptions deliver
+# their copies within milliseconds, so the window is kept short: a device
+# that legitimately repeats a payload faster than this would lose repeats.
+DEDUP_WINDOW = 0.5
+DEDUP_CAPACITY = 100000
+
+# Topics whose last payload is remembered, to recognise retained replays on reconnect
+RETAINED_CAPACITY = 50000
+
+REASONS = ('duplicate', 'retained')
+
+def messageKey(topic, payload):
+    """64-bit digest of (topic, payload), the same in every process (hash() is salted per process)"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    digest = hashlib.blake2b(topic.encode('utf-8'), digest_size=8)
+    # Topics cannot contain NUL, so the boundary between topic and payload is unambiguous
+    digest.update(b'\0')
+    digest.update(payload)
+    return digest.digest()
+
+def storedText(topic, payload):
+    """The payload as the writer stores it: text as is, binary as hex, decoded formats as JSON"""
+    if isinstance(payload, str):
+        # Already the stored text (ingest workers send payloads in this form)
+        return payload
+    format, value = decodePayload(topic, payload)
+    return payloadText(payload, format, value)
+
+class Deduplicator:
+    """Time-windowed duplicate filter for the ingest path.
+
+    Each message is reduced to one 64-bit blake2b digest of (topic, payload).
+    Digests seen in the last `window` seconds are kept in a dict, with a deque
+    in arrival order so expired and over-capacity entries are evicted from the
+    front in O(1). A retained message whose digest matches the last payload
+    received on its topic is a broker replay after a reconnect and is
+    skipped; after a restart, the topic catalog's last stored payload stands
+    in for the first comparison, against the payload in its stored form.
+    """
+
+    def __init__(self, window=DEDUP_WINDOW, capacity=DEDUP_CAPACITY, retainedCapacity=RETAINED_CAPACITY,
+            lastStoredPayload=None):
+        self.window = window
+        self.capacity = capacity
+        self.retainedCapacity = retainedCapacity
+        self.lastStoredPayload = lastStoredPayload
+        self.seen = {}
+        self.order = deque()
+        self.lastPayloads = OrderedDict()
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.suppressed = dict.fromkeys(REASONS, 0)
+
+    def check(self, topic, payload, retain, receivedAt):
+        """None if the message should be stored, otherwise why it is suppressed"""
+        key = messageKey(topic, payload)
+        with self.lock:
+            self.checked += 1
+            self.expire(receivedAt)
+
+            if retain and self.isRetainedReplay(topic, payload, key):
+                self.suppressed['retained'] += 1
+                return 'retained'
+
+            last = self.seen.get(key)
+            if last is not None and receivedAt - last <= self.window:
+                self.suppressed['duplicate'] += 1
+                return 'duplicate'
+
+            self.seen[key] = receivedAt
+            self.order.append((receivedAt, key))
+            if len(self.order) > self.capacity:
+                self.evict()
+            self.remember(topic, key)
+            return None
+
+    def isRetainedReplay(self, topic, payload, key):
+        previous = self.lastPayloads.get(topic)
+        if previous is not None:
+            return previous == key
+        if self.lastStoredPayload is None:
+            return False
+        # The catalog keeps the stored text, which for binary and decoded payloads is not the raw bytes
+        stored = self.lastStoredPayload(topic)
+        return stored is not None and stored == storedText(topic, payload)
+
+    def remember(self, topic, key):
+        self.lastPayloads[topic] = key
+        self.lastPayloads.move_to_end(topic)
+        if len(self.lastPayloads) > self.retainedCapacity:
+            self.lastPayloads.popitem(last=False)
+
+    def expire(self, now):
+        cutoff = now - self.window
+        while self.order and self.order[0][0] < cutoff:
+            self.evict()
+
+    def evict(self):
+        receivedAt, key = self.order.popleft()
+        # A later copy of the same key refreshed the entry; keep that one
+        if self.seen.get(key) == receivedAt:
+            del self.seen[key]
+
+    def getStats(self):
+        return {
+            "windowSeconds": self.window,
+            "tracked": len(self.seen),
+            "checked": self.checked,
+            "suppressed": dict(self.suppressed)
+        }
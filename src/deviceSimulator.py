@@ -1,7 +1,76 @@
 ﻿import time
 import random
 import json
-from mqttClient import startMqttClient, publishMessage, stopMqttClient
+from mqttClient import createPublisher
+
+def generateTemperature(device):
+    baseTemp = random.uniform(device["min"], device["max"])
+    # Add some realistic variation
+    variation = random.uniform(-0.5, 0.5)
+    return round(baseTemp + variation, 2)
+
+def generateHumidity(device):
+    baseHumidity = random.uniform(device["min"], device["max"])
+    variation = random.uniform(-2, 2)
+    return round(baseHumidity + variation, 2)
+
+def generateStatus(device):
+    statuses = ["online", "offline", "warning", "error"]
+    weights = [0.85, 0.05, 0.07, 0.03]  # Mostly online, sometimes issues
+    return random.choices(statuses, weights=weights)[0]
+
+def generateSwitchState(device):
+    return random.choice(["ON", "OFF"])
+
+def simulateDevice(deviceId, deviceConfig):
+    """(topic, payload) for one reading of a device; needs no publisher, so the fleet workers use it too"""
+    deviceType = deviceConfig["type"]
+    
+    if deviceType == "temperature":
+        value = generateTemperature(deviceConfig)
+        topic = f"codePower/sensors/{deviceConfig['location']}/temperature"
+        payload = json.dumps({
+            "deviceId": deviceId,
+            "type": "temperature",
+            "value": value,
+            "unit": "°C",
+            "location": deviceConfig["location"],
+            "timestamp": time.time()
+        })
+        
+    elif deviceType == "humidity":
+        value = generateHumidity(deviceConfig)
+        topic = f"codePower/sensors/{deviceConfig['location']}/humidity"
+        payload = json.dumps({
+            "deviceId": deviceId,
+            "type": "humidity",
+            "value": value,
+            "unit": "%",
+            "location": deviceConfig["location"],
+            "timestamp": time.time()
+        })
+        
+    elif deviceType == "status":
+        value = generateStatus(deviceConfig)
+        topic = f"codePower/devices/{deviceId}/status"
+        payload = json.dumps({
+            "deviceId": deviceId,
+            "status": value,
+            "location": deviceConfig["location"],
+            "timestamp": time.time()
+        })
+        
+    elif deviceType == "switch":
+        value = generateSwitchState(deviceConfig)
+        topic = f"codePower/actuators/{deviceConfig['location']}/state"
+        payload = json.dumps({
+            "deviceId": deviceId,
+            "state": value,
+            "location": deviceConfig["location"],
+            "timestamp": time.time()
+        })
+    
+    return topic, payload
 
 class DeviceSimulator:
     def __init__(self):
@@ -13,79 +82,15 @@ class DeviceSimulator:
             "actuator01": {"type": "switch", "location": "light1"}
         }
         self.running = False
-
-    def generateTemperature(self, device):
-        baseTemp = random.uniform(device["min"], device["max"])
-        # Add some realistic variation
-        variation = random.uniform(-0.5, 0.5)
-        return round(baseTemp + variation, 2)
-
-    def generateHumidity(self, device):
-        baseHumidity = random.uniform(device["min"], device["max"])
-        variation = random.uniform(-2, 2)
-        return round(baseHumidity + variation, 2)
-
-    def generateStatus(self, device):
-        statuses = ["online", "offline", "warning", "error"]
-        weights = [0.85, 0.05, 0.07, 0.03]  # Mostly online, sometimes issues
-        return random.choices(statuses, weights=weights)[0]
-
-    def generateSwitchState(self, device):
-        return random.choice(["ON", "OFF"])
-
-    def simulateDevice(self, deviceId, deviceConfig):
-        deviceType = deviceConfig["type"]
-        
-        if deviceType == "temperature":
-            value = self.generateTemperature(deviceConfig)
-            topic = f"codePower/sensors/{deviceConfig['location']}/temperature"
-            payload = json.dumps({
-                "deviceId": deviceId,
-                "type": "temperature",
-                "value": value,
-                "unit": "°C",
-                "location": deviceConfig["location"],
-                "timestamp": time.time()
-            })
-            
-        elif deviceType == "humidity":
-            value = self.generateHumidity(deviceConfig)
-            topic = f"codePower/sensors/{deviceConfig['location']}/humidity"
-            payload = json.dumps({
-                "deviceId": deviceId,
-                "type": "humidity",
-                "value": value,
-                "unit": "%",
-                "location": deviceConfig["location"],
-                "timestamp": time.time()
-            })
-            
-        elif deviceType == "status":
-            value = self.generateStatus(deviceConfig)
-            topic = f"codePower/devices/{deviceId}/status"
-            payload = json.dumps({
-                "deviceId": deviceId,
-                "status": value,
-                "location": deviceConfig["location"],
-                "timestamp": time.time()
-            })
-            
-        elif deviceType == "switch":
-            value = self.generateSwitchState(deviceConfig)
-            topic = f"codePower/actuators/{deviceConfig['location']}/state"
-            payload = json.dumps({
-                "deviceId": deviceId,
-                "state": value,
-                "location": deviceConfig["location"],
-                "timestamp": time.time()
-            })
-        
-        return topic, payload
+        # Publish only: the historian stores what reaches the broker, the simulator does not
+        self.publisher = createPublisher()
 
     def startSimulation(self, duration=60, interval=5):
         """Start the device simulation"""
-        if not startMqttClient():
+        # connect() only starts connecting; the first round would find no connection up
+        if not self.publisher.connect() or not self.publisher.waitConnected():
             print("Failed to connect to MQTT broker")
+            self.publisher.disconnect()
             return
         
         print("Device simulator started")
@@ -100,9 +105,9 @@ class DeviceSimulator:
             while self.running and (time.time() - startTime) < duration:
                 # Simulate each device
                 for deviceId, deviceConfig in self.devices.items():
-                    topic, payload = self.simulateDevice(deviceId, deviceConfig)
+                    topic, payload = simulateDevice(deviceId, deviceConfig)
                     
-                    if publishMessage(topic, payload):
+                    if self.publisher.publishMessage(topic, payload):
                         messageCount += 1
                         print(f"Published: {topic} -> {payload}")
                     else:
@@ -116,7 +121,7 @@ class DeviceSimulator:
         
         finally:
             self.running = False
-            stopMqttClient()
+            self.publisher.disconnect()
             print(f"Simulation completed. Total messages sent: {messageCount}")
 
     def stopSimulation(self):
@@ -126,9 +131,8 @@ def quickTest():
     """Quick test with a few messages"""
     simulator = DeviceSimulator()
     
-    if startMqttClient():
-        time.sleep(2)
-        
+    # Wait for the connection itself rather than a fixed delay
+    if simulator.publisher.connect() and simulator.publisher.waitConnected():
         print("Publishing quick test messages...")
         
         # Test each device type once
@@ -139,21 +143,28 @@ def quickTest():
         }
         
         for deviceId, deviceConfig in testDevices.items():
-            topic, payload = simulator.simulateDevice(deviceId, deviceConfig)
-            if publishMessage(topic, payload):
+            topic, payload = simulateDevice(deviceId, deviceConfig)
+            if simulator.publisher.publishMessage(topic, payload):
                 print(f"✓ {topic} -> {payload}")
             else:
                 print(f"✗ Failed: {topic}")
             
             time.sleep(1)
         
-        stopMqttClient()
+        simulator.publisher.disconnect()
+    else:
+        print("Failed to connect to MQTT broker")
+        simulator.publisher.disconnect()
 
 if __name__ == "__main__":
     import sys
     
     if len(sys.argv) > 1 and sys.argv[1] == "quick":
         quickTest()
+    elif len(sys.argv) > 1 and sys.argv[1] in ("fleet", "replay"):
+        # Load generation: many devices across processes, or replay of recorded messages
+        from fleetSimulator import main
+        main(sys.argv[1:])
     else:
         # Full simulation
         simulator = DeviceSimulator()
@@ -0,0 +1,269 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime
+from database import DB_PATH, MESSAGE_PARTITION_PREFIX, partitionsInRange, toDbTimestamp
+from deviceSimulator import simulateDevice
+from mqttClient import MQTTClient, loadBrokerConfig
+from payloadCodec import decodeStoredPayload, payloadCodec
+
+# Devices, what they are, and how often each publishes. payloadSize pads every
+# payload to at least that many bytes; jitter varies each interval by up to
+# that fraction without changing the average rate.
+DEFAULT_FLEET_SPEC = {
+    "devices": 1000,
+    "typeMix": {"temperature": 0.4, "humidity": 0.3, "status": 0.2, "switch": 0.1},
+    "ratePerDevice": 0.2,
+    "jitter": 0.1,
+    "payloadSize": 0,
+    "workers": 4,
+    "duration": 60
+}
+
+TYPE_RANGES = {
+    "temperature": (18, 30),
+    "humidity": (40, 80)
+}
+
+# How far behind schedule the publisher may fall before a message counts as late
+LATE_THRESHOLD = 0.05
+
+def buildDevices(spec):
+    """Device configs in the layout DeviceSimulator uses, with types assigned by typeMix"""
+    mix = spec["typeMix"]
+    total = sum(mix.values())
+    devices = []
+    assigned = 0
+    types = list(mix.items())
+    for index, (deviceType, share) in enumerate(types):
+        count = spec["devices"] - assigned if index == len(types) - 1 else round(spec["devices"] * share / total)
+        for _ in range(count):
+            config = {"type": deviceType, "location": f"zone{assigned % 100:02d}"}
+            if deviceType in TYPE_RANGES:
+                config["min"], config["max"] = TYPE_RANGES[deviceType]
+            devices.append((f"fleet{assigned:06d}", config))
+            assigned += 1
+    return devices
+
+def padPayload(payload, size):
+    if len(payload) >= size:
+        return payload
+    # Keep the payload valid JSON: pad inside the object
+    return payload[:-1] + ', "padding": "' + 'x' * max(0, size - len(payload) - 15) + '"}'
+
+def resolveBroker(host=None, port=None):
+    """The first broker of brokers.json (or the default broker), with host and port overridden when given"""
+    config = dict(loadBrokerConfig()[0])
+    if host:
+        config["host"] = host
+    if port:
+        config["port"] = port
+    return config
+
+def connectPublisher(broker, clientId):
+    """A publish-only connection, with the broker's credentials, TLS and protocol, once it is up"""
+    publisher = MQTTClient(dict(broker, clientId=clientId, connections=1), publishOnly=True)
+    if not publisher.connect() or not publisher.waitConnected():
+        publisher.disconnect()
+        raise ConnectionError(f"Could not connect to {publisher.host}:{publisher.port}")
+    # The load loops publish on the paho client directly, without the per-message bookkeeping
+    return publisher
+
+def runFleetWorker(workerIndex, devices, spec, broker, counters):
+    """Publish for one slice of the fleet from its own process and MQTT connection.
+
+    The schedule is open loop: every device has fixed due times derived from
+    its rate, and a publish that runs late does not push later ones back, so
+    the offered load stays at the requested rate instead of sagging whenever
+    the broker or network slows down.
+    """
+    publisher = connectPublisher(broker, f"fleetSimulator-{workerIndex}-{os.getpid()}")
+    client = publisher.client
+    period = 1.0 / spec["ratePerDevice"]
+    jitter = spec["jitter"]
+    payloadSize = spec["payloadSize"]
+    rng = random.Random(workerIndex)
+
+    start = time.monotonic()
+    deadline = start + spec["duration"]
+    # Spread first publishes over one period so devices do not fire in lockstep
+    schedule = [(start + rng.uniform(0, period), index) for index in range(len(devices))]
+    heapq.heapify(schedule)
+
+    published = 0
+    late = 0
+    try:
+        while schedule:
+            due, index = schedule[0]
+            if due >= deadline:
+                break
+            now = time.monotonic()
+            if due > now:
+                time.sleep(min(due - now, 0.01))
+                continue
+
+            deviceId, config = devices[index]
+            topic, payload = simulateDevice(deviceId, config)
+            client.publish(topic, padPayload(payload, payloadSize))
+            published += 1
+            if now - due > LATE_THRESHOLD:
+                late += 1
+
+            nextDue = due + period * (1 + rng.uniform(-jitter, jitter))
+            heapq.heapreplace(schedule, (nextDue, index))
+            if published % 100 == 0:
+                counters[workerIndex * 2] = published
+                counters[workerIndex * 2 + 1] = late
+    finally:
+        counters[workerIndex * 2] = published
+        counters[workerIndex * 2 + 1] = late
+        publisher.disconnect()
+
+def reportProgress(processes, counters, workers):
+    startTime = time.time()
+    lastTotal = 0
+    while any(process.is_alive() for process in processes):
+        time.sleep(1)
+        total = sum(counters[i * 2] for i in range(workers))
+        late = sum(counters[i * 2 + 1] for i in range(workers))
+        print(f"[{time.time() - startTime:5.0f}s] {total - lastTotal} msg/s, {total} sent, {late} late")
+        lastTotal = total
+    return sum(counters[i * 2] for i in range(workers)), sum(counters[i * 2 + 1] for i in range(workers))
+
+def runFleet(spec, host=None, port=None):
+    """Simulate spec["devices"] devices across spec["workers"] processes"""
+    broker = resolveBroker(host, port)
+    host, port = broker["host"], broker.get("port", 1883)
+    devices = buildDevices(spec)
+    workers = max(1, min(spec["workers"], len(devices)))
+    counters = multiprocessing.Array('q', workers * 2, lock=False)
+    offered = spec["devices"] * spec["ratePerDevice"]
+    print(f"Fleet: {len(devices)} devices on {workers} workers, {offered:.0f} msg/s offered to {host}:{port}")
+
+    processes = []
+    for workerIndex in range(workers):
+        process = multiprocessing.Process(
+            target=runFleetWorker,
+            args=(workerIndex, devices[workerIndex::workers], spec, broker, counters),
+            name=f"fleetWorker-{workerIndex}",
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+
+    try:
+        total, late = reportProgress(processes, counters, workers)
+    except KeyboardInterrupt:
+        print("\nSimulation stopped by user")
+        for process in processes:
+            process.terminate()
+        total, late = sum(counters[::2]), sum(counters[1::2])
+    print(f"Fleet simulation completed. Total messages sent: {total} ({late} late)")
+    return total
+
+def loadRecordedMessages(dbPath, start=None, end=None):
+    """Recorded messages in arrival order as (timestamp, topic, payload, qos), payloads as the
+    text originally received even when the database stores them compressed"""
+    conn = sqlite3.connect(f"file:{dbPath}?mode=ro", uri=True)
+    cursor = conn.cursor()
+    # Dictionaries of the recorded database; a second cursor, since decoding may look one up mid-scan
+    payloadCodec.load(conn)
+    lookup = conn.cursor()
+    conditions = []
+    params = []
+    for condition, value in (('m.timestamp >= ?', start), ('m.timestamp < ?', end)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(toDbTimestamp(value))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    for day in partitionsInRange(cursor, MESSAGE_PARTITION_PREFIX, toDbTimestamp(start), toDbTimestamp(end)):
+        query = f'''
+            SELECT m.timestamp, t.topic, m.payload, m.qos
+            FROM {MESSAGE_PARTITION_PREFIX}{day} AS m
+            JOIN topics AS t ON t.id = m.topicId
+            {where}
+            ORDER BY m.id
+        '''
+        for timestamp, topic, payload, qos in cursor.execute(query, params):
+            yield timestamp, topic, decodeStoredPayload(payload, lookup), qos
+    conn.close()
+
+def parseRecordedTimestamp(value):
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+def replayMessages(speed=1.0, dbPath=DB_PATH, start=None, end=None, host=None, port=None):
+    """Republish recorded mqttMessages with their original spacing divided by speed.
+
+    Retained flags are not replayed, so a replay cannot overwrite what the
+    broker holds for real devices.
+    """
+    publisher = connectPublisher(resolveBroker(host, port), f"fleetReplay-{os.getpid()}")
+    client = publisher.client
+    print(f"Replaying {dbPath} at {speed}x to {publisher.host}:{publisher.port}")
+
+    replayStart = None
+    firstRecorded = None
+    published = 0
+    try:
+        for timestamp, topic, payload, qos in loadRecordedMessages(dbPath, start, end):
+            recordedAt = parseRecordedTimestamp(timestamp)
+            if firstRecorded is None:
+                firstRecorded = recordedAt
+                replayStart = time.monotonic()
+            # Open loop: each message is due relative to the start, not to the previous publish
+            due = replayStart + (recordedAt - firstRecorded).total_seconds() / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            client.publish(topic, payload, qos=qos)
+            published += 1
+            if published % 1000 == 0:
+                print(f"Replayed {published} messages")
+    except KeyboardInterrupt:
+        print("\nReplay stopped by user")
+    finally:
+        publisher.disconnect()
+    print(f"Replay completed. Total messages sent: {published}")
+    return published
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fleet load generator and message replay")
+    parser.add_argument('--host', help="broker host (default: the first broker in brokers.json)")
+    parser.add_argument('--port', type=int, help="broker port (default: the first broker in brokers.json)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fleet = commands.add_parser('fleet', help="simulate a fleet of devices")
+    fleet.add_argument('--spec', help="JSON file with fleet spec fields (see DEFAULT_FLEET_SPEC)")
+    for name, value in DEFAULT_FLEET_SPEC.items():
+        if name != "typeMix":
+            fleet.add_argument(f'--{name}', type=type(value), default=None)
+
+    replay = commands.add_parser('replay', help="republish recorded messages")
+    replay.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier")
+    replay.add_argument('--db', default=DB_PATH)
+    replay.add_argument('--start', help="only messages at or after this time")
+    replay.add_argument('--end', help="only messages before this time")
+
+    options = parser.parse_args(argv)
+    if options.command == 'replay':
+        replayMessages(options.speed, options.db, options.start, options.end, options.host, options.port)
+        return
+
+    spec = dict(DEFAULT_FLEET_SPEC)
+    if options.spec:
+        with open(options.spec) as f:
+            spec.update(json.load(f))
+    for name in DEFAULT_FLEET_SPEC:
+        value = getattr(options, name, None)
+        if value is not None:
+            spec[name] = value
+    runFleet(spec, options.host, options.port)
+
+if __name__ == "__main__":
+    main()
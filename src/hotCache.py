@@ -0,0 +1,272 @@
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from database import getLatestPartitionReadings, getRecentReadings, getTopics, topicCatalog
+from topicMatcher import topicMatches, validateFilter
+
+# Topics kept before the least recently updated is evicted, and numeric samples
+# kept per topic and field (RECENT_SAMPLES * 16 bytes each)
+HOT_CACHE_TOPICS = 5000
+RECENT_SAMPLES = 300
+
+# Default window for /api/recent, in seconds
+RECENT_WINDOW = 300
+
+# Readings read from the newest partition to warm the cache at startup
+WARM_ROWS = 200000
+
+class SampleRing:
+    """Fixed-size ring of (epoch seconds, value) samples in two preallocated float arrays"""
+
+    __slots__ = ('times', 'values', 'start', 'count')
+
+    def __init__(self, capacity):
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        capacity = len(self.times)
+        index = (self.start + self.count) % capacity
+        self.times[index] = timestamp
+        self.values[index] = value
+        if self.count == capacity:
+            self.start = (self.start + 1) % capacity
+        else:
+            self.count += 1
+
+    def since(self, cutoff):
+        """Samples at or after cutoff, oldest first"""
+        capacity = len(self.times)
+        samples = []
+        for offset in range(self.count):
+            index = (self.start + offset) % capacity
+            if self.times[index] >= cutoff:
+                samples.append((self.times[index], self.values[index]))
+        return samples
+
+class TopicEntry:
+    __slots__ = ('messageId', 'receivedAt', 'payload', 'values', 'units', 'series')
+
+    def __init__(self):
+        self.messageId = None
+        self.receivedAt = None
+        self.payload = None
+        self.values = {}
+        self.units = {}
+        self.series = {}
+
+def sampleFields(readings, numbers):
+    """(field, value, unit) samples of one message: its readings by sensor type, or
+    its first bare number as 'value' when it has no structured readings"""
+    if readings:
+        return [(reading['sensorType'], reading['value'], reading.get('unit')) for reading in readings]
+    if numbers:
+        return [('value', numbers[0], None)]
+    return []
+
+def isoTimestamp(epoch):
+    # Local time, like the timestamps of the WebSocket stream built from the same receive times
+    return datetime.fromtimestamp(epoch).isoformat()
+
+class HotCache:
+    """Latest message and recent numeric samples per topic, updated by the ingest path.
+
+    Topics live in an OrderedDict used as an LRU: every update moves its topic
+    to the end and the least recently updated topic is evicted past
+    maxTopics. Samples go to a SampleRing per (topic, field), so memory per
+    topic is fixed no matter how fast it publishes. Reads never touch the
+    database unless the topic is not cached.
+    """
+
+    def __init__(self, maxTopics=HOT_CACHE_TOPICS, samples=RECENT_SAMPLES):
+        self.maxTopics = maxTopics
+        self.samples = samples
+        self.topics = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def entryFor(self, topic):
+        entry = self.topics.get(topic)
+        if entry is None:
+            entry = TopicEntry()
+            self.topics[topic] = entry
+            if len(self.topics) > self.maxTopics:
+                self.topics.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.topics.move_to_end(topic)
+        return entry
+
+    def update(self, topic, messageId, receivedAt, payload, readings=None, numbers=None):
+        fields = sampleFields(readings, numbers)
+        with self.lock:
+            entry = self.entryFor(topic)
+            entry.messageId = messageId
+            entry.receivedAt = receivedAt
+            entry.payload = payload
+            for field, value, unit in fields:
+                entry.values[field] = value
+                entry.units[field] = unit
+                ring = entry.series.get(field)
+                if ring is None:
+                    ring = entry.series[field] = SampleRing(self.samples)
+                ring.append(receivedAt, value)
+
+    def latest(self, topicFilter=None, limit=None):
+        """Latest message per cached topic matching the filter, most recently updated first"""
+        with self.lock:
+            items = list(self.topics.items())
+        result = []
+        for topic, entry in reversed(items):
+            if topicFilter is not None and not topicMatches(topicFilter, topic):
+                continue
+            result.append({
+                "topic": topic,
+                "messageId": entry.messageId,
+                "timestamp": isoTimestamp(entry.receivedAt),
+                "payload": entry.payload,
+                "values": dict(entry.values)
+            })
+            if limit and len(result) >= limit:
+                break
+        return result
+
+    def recent(self, topic, cutoff, field=None):
+        """{field: [(epoch, value), ...]} since cutoff, or None if the topic is not cached"""
+        with self.lock:
+            entry = self.topics.get(topic)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {
+                name: ring.since(cutoff)
+                for name, ring in entry.series.items()
+                if field is None or name == field
+            }
+
+    def load(self, topic, samples, payload=None):
+        """Seed a topic's rings from storage after a miss; samples are (epoch, field, value, unit) oldest first"""
+        with self.lock:
+            if topic in self.topics:
+                return
+            entry = self.entryFor(topic)
+            entry.payload = payload
+            for timestamp, field, value, unit in samples:
+                entry.values[field] = value
+                entry.units[field] = unit
+                ring = entry.series.get(field)
+                if ring is None:
+                    ring = entry.series[field] = SampleRing(self.samples)
+                ring.append(timestamp, value)
+            if samples:
+                entry.receivedAt = samples[-1][0]
+
+    def sensors(self):
+        """Latest value of every cached (topic, field), for the dashboard's sensor cards"""
+        with self.lock:
+            items = list(self.topics.items())
+        sensors = []
+        for topic, entry in reversed(items):
+            segments = topic.split('/')
+            for field, value in entry.values.items():
+                sensors.append({
+                    "topic": topic,
+                    "sensorType": field,
+                    "value": value,
+                    "unit": entry.units.get(field),
+                    "location": segments[-2] if len(segments) > 1 else None,
+                    "timestamp": isoTimestamp(entry.receivedAt)
+                })
+        return sensors
+
+    def getStats(self):
+        return {
+            "topics": len(self.topics),
+            "maxTopics": self.maxTopics,
+            "samplesPerSeries": self.samples,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+# Global instance
+hotCache = HotCache()
+
+def updateHotCache(topic, messageId, receivedAt, payload, readings=None, numbers=None):
+    hotCache.update(topic, messageId, receivedAt, payload, readings, numbers)
+
+def warmHotCache(window=RECENT_WINDOW, maxRows=WARM_ROWS):
+    """Seed the cache with the readings of the last `window` seconds of the newest partition.
+
+    Topics already updated by live messages are left alone, and only the
+    maxTopics most recently active topics are loaded. Returns the number of
+    topics seeded.
+    """
+    samples = {}
+    for topic, timestamp, field, value, unit in getLatestPartitionReadings(window, maxRows):
+        samples.setdefault(topic, []).append((timestamp, field, value, unit))
+    # Least recently active first, so the LRU order matches a cache filled live
+    topics = sorted(samples, key=lambda topic: samples[topic][-1][0])[-hotCache.maxTopics:]
+    for topic in topics:
+        hotCache.load(topic, samples[topic], topicCatalog.lastPayload(topic))
+    return len(topics)
+
+def getLatest(topicFilter=None, limit=None):
+    """Latest message per topic from the cache; topics not seen since startup come from the topic catalog"""
+    if topicFilter is not None:
+        validateFilter(topicFilter)
+    latest = hotCache.latest(topicFilter, limit)
+    if limit and len(latest) >= limit:
+        return latest
+
+    cached = {entry["topic"] for entry in latest}
+    for entry in getTopics():
+        if entry["topic"] in cached or (topicFilter is not None and not topicMatches(topicFilter, entry["topic"])):
+            continue
+        latest.append({
+            "topic": entry["topic"],
+            "messageId": None,
+            "timestamp": entry["lastSeen"].replace(' ', 'T') if entry["lastSeen"] else None,
+            "payload": entry["lastPayload"],
+            "values": None
+        })
+        if limit and len(latest) >= limit:
+            break
+    return latest
+
+def getRecent(topic, seconds=RECENT_WINDOW, field=None, now=None):
+    """Samples of the last `seconds` for one topic, by field; read from storage only on a cache miss"""
+    cutoff = (now or time.time()) - seconds
+    series = hotCache.recent(topic, cutoff, field)
+    source = "cache"
+    if series is None:
+        samples = getRecentReadings(topic, cutoff)
+        if samples:
+            hotCache.load(topic, samples)
+        series = {}
+        for timestamp, name, value, _ in samples:
+            if field is None or name == field:
+                series.setdefault(name, []).append((timestamp, value))
+        source = "storage"
+    return {
+        "topic": topic,
+        "seconds": seconds,
+        "source": source,
+        "series": {
+            name: [{"timestamp": isoTimestamp(timestamp), "value": value} for timestamp, value in samples]
+            for name, samples in series.items()
+        }
+    }
+
+def getLatestSensors():
+    return hotCache.sensors()
+
+def getHotCacheStats():
+    return hotCache.getStats()
@@ -0,0 +1,269 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Exclusive file locks: fcntl on POSIX, msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Where the log lives, how big each memory-mapped segment file is, and how many
+# segments may exist before appends block (SEGMENT_SIZE * MAX_SEGMENTS on disk)
+INGEST_LOG_DIR = 'ingestLog'
+SEGMENT_SIZE = 64 * 1024 * 1024
+MAX_SEGMENTS = 64
+
+# Record: data length, CRC32 of id + data, message id; then the data. A zero
+# length marks the end of what has been written to a segment.
+RECORD_HEADER = struct.Struct('<IIQ')
+RECORD_ID = struct.Struct('<Q')
+# Checkpoint: segment number and offset of the first uncommitted record, then the
+# highest id committed (older checkpoint files end after the offset)
+CHECKPOINT = struct.Struct('<QQQ')
+CHECKPOINT_POSITION = struct.Struct('<QQ')
+
+class Segment:
+    __slots__ = ('number', 'path', 'file', 'map')
+
+    def __init__(self, directory, number, size):
+        self.number = number
+        self.path = os.path.join(directory, f"segment-{number:08d}.log")
+        created = not os.path.exists(self.path)
+        self.file = open(self.path, 'a+b' if created else 'r+b')
+        if created:
+            # Sparse, zero-filled file: every header past the written end reads as length 0
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def lockExclusive(path):
+    """Open path and hold an exclusive lock on it until the returned file is closed.
+    RuntimeError if another process (or another open in this one) holds it."""
+    lockFile = open(path, 'a+b')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lockFile.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lockFile.close()
+        raise RuntimeError(f"{path} is locked by another process")
+    return lockFile
+
+def recordChecksum(recordId, data):
+    return zlib.crc32(data, zlib.crc32(RECORD_ID.pack(recordId)))
+
+class SegmentLog:
+    """Append-only write-ahead log of fixed-size, memory-mapped segment files.
+
+    Appends are memory copies into the current segment, so they keep up with
+    ingest however slow the database is; the writer reads records back in
+    order and moves the checkpoint once they are committed. Segments wholly
+    before the checkpoint are deleted. Each record carries a CRC, so on
+    startup a record torn by a crash ends the log instead of being replayed.
+
+    A process crash loses nothing appended: the pages belong to the OS. A
+    host crash can lose what was appended since the writer's last commit,
+    which syncs the pages appended before it (sync()).
+    """
+
+    def __init__(self, directory=INGEST_LOG_DIR, segmentSize=SEGMENT_SIZE, maxSegments=MAX_SEGMENTS):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxSegments = maxSegments
+        self.segments = {}
+        self.lockFile = None
+        self.condition = threading.Condition()
+        self.writeSegment = None
+        self.writeOffset = 0
+        self.checkpoint = (1, 0)
+        self.lastId = 0
+        self.syncedPosition = (1, 0)
+        self.appended = 0
+        self.committed = 0
+        self.blockedAppends = 0
+        self.corruptSegments = 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Two processes appending to the same segments would overwrite each other's records
+        self.lockFile = lockExclusive(os.path.join(self.directory, 'lock'))
+        self.checkpoint, committedId = self.readCheckpoint()
+        numbers = sorted(
+            int(name[8:16]) for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.log')
+        )
+        for number in numbers:
+            if number < self.checkpoint[0]:
+                os.remove(os.path.join(self.directory, f"segment-{number:08d}.log"))
+            else:
+                self.segments[number] = Segment(self.directory, number, self.segmentSize)
+        if not self.segments:
+            self.segments[self.checkpoint[0]] = Segment(self.directory, self.checkpoint[0], self.segmentSize)
+
+        self.writeSegment = self.segments[max(self.segments)]
+        start = self.checkpoint[1] if self.writeSegment.number == self.checkpoint[0] else 0
+        self.writeOffset, lastId = self.scan(self.writeSegment, start)
+        # A segment left empty by a rollover or torn at its first record holds no id: the
+        # newest one is then in an older segment, or was committed before the checkpoint
+        for number in sorted(self.segments, reverse=True)[1:]:
+            if lastId:
+                break
+            lastId = self.scan(self.segments[number], 0, repair=False)[1]
+        self.lastId = max(lastId, committedId)
+        self.syncedPosition = (self.writeSegment.number, self.writeOffset)
+
+    def readCheckpoint(self):
+        """Checkpoint position and the highest committed id (0 if the file predates it)"""
+        path = os.path.join(self.directory, 'checkpoint')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(CHECKPOINT.size)
+            if len(data) == CHECKPOINT.size:
+                number, offset, committedId = CHECKPOINT.unpack(data)
+                return (number, offset), committedId
+            return CHECKPOINT_POSITION.unpack(data), 0
+        except (OSError, struct.error):
+            return (1, 0), 0
+
+    def scan(self, segment, offset, repair=True):
+        """End of the valid records in a segment, and the last id found there. With repair, a
+        torn record is cleared so appends can continue after the valid ones."""
+        lastId = 0
+        while offset + RECORD_HEADER.size <= self.segmentSize:
+            length, checksum, recordId = RECORD_HEADER.unpack_from(segment.map, offset)
+            if length == 0:
+                break
+            end = offset + RECORD_HEADER.size + length
+            if end > self.segmentSize or recordChecksum(recordId, segment.map[offset + RECORD_HEADER.size:end]) != checksum:
+                if repair:
+                    # Torn by a crash mid-append: clear it so new appends start from clean space
+                    print(f"Ingest log: discarding torn record at {segment.path}:{offset}")
+                    segment.map[offset:] = bytes(self.segmentSize - offset)
+                break
+            lastId = recordId
+            offset = end
+        return offset, lastId
+
+    def append(self, recordId, data):
+        size = RECORD_HEADER.size + len(data)
+        if size > self.segmentSize:
+            raise ValueError(f"Record of {len(data)} bytes does not fit in a {self.segmentSize} byte segment")
+
+        with self.condition:
+            if self.writeOffset + size > self.segmentSize:
+                self.roll()
+            segment = self.writeSegment
+            offset = self.writeOffset
+            # Data first, header last: a reader only sees the record once its length is set
+            segment.map[offset + RECORD_HEADER.size:offset + size] = data
+            RECORD_HEADER.pack_into(segment.map, offset, len(data), recordChecksum(recordId, data), recordId)
+            self.writeOffset = offset + size
+            self.lastId = recordId
+            self.appended += 1
+
+    def roll(self):
+        while len(self.segments) >= self.maxSegments:
+            # Disk budget used up: wait for the writer to commit and free a segment
+            self.blockedAppends += 1
+            self.condition.wait()
+        number = self.writeSegment.number + 1
+        self.segments[number] = Segment(self.directory, number, self.segmentSize)
+        self.writeSegment = self.segments[number]
+        self.writeOffset = 0
+
+    def read(self, position, maxCount):
+        """Up to maxCount (id, data) records after position, and the position after them"""
+        number, offset = position
+        records = []
+        while len(records) < maxCount:
+            segment = self.segments.get(number)
+            if segment is None:
+                break
+            length = 0
+            if offset + RECORD_HEADER.size <= self.segmentSize:
+                length, checksum, recordId = RECORD_HEADER.unpack_from(segment.map, offset)
+            if length == 0:
+                if number < self.writeSegment.number:
+                    number, offset = number + 1, 0
+                    continue
+                break
+
+            end = offset + RECORD_HEADER.size + length
+            data = segment.map[offset + RECORD_HEADER.size:end]
+            if end > self.segmentSize or recordChecksum(recordId, data) != checksum:
+                # Damaged on disk: skip the rest of this segment rather than stall ingest
+                print(f"Ingest log: corrupt record at {segment.path}:{offset}, skipping rest of segment")
+                self.corruptSegments += 1
+                if number < self.writeSegment.number:
+                    number, offset = number + 1, 0
+                    continue
+                break
+            records.append((recordId, data))
+            offset = end
+        return records, (number, offset)
+
+    def sync(self):
+        """Write the pages appended since the last sync to disk"""
+        with self.condition:
+            end = (self.writeSegment.number, self.writeOffset)
+        number, offset = self.syncedPosition
+        while (number, offset) < end:
+            segment = self.segments.get(number)
+            stop = end[1] if number == end[0] else self.segmentSize
+            if segment is not None and stop > offset:
+                # flush() takes a page-aligned start
+                start = offset - offset % mmap.ALLOCATIONGRANULARITY
+                segment.map.flush(start, stop - start)
+            number, offset = (number + 1, 0) if number < end[0] else end
+        self.syncedPosition = end
+
+    def commit(self, position, count, lastId):
+        """Record that everything before position, up to id lastId, is in the database"""
+        self.sync()
+        path = os.path.join(self.directory, 'checkpoint')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(CHECKPOINT.pack(position[0], position[1], lastId))
+        os.replace(path + '.tmp', path)
+
+        with self.condition:
+            self.checkpoint = position
+            self.committed += count
+            for number in [number for number in self.segments if number < position[0]]:
+                segment = self.segments.pop(number)
+                segment.close()
+                os.remove(segment.path)
+            self.condition.notify_all()
+
+    def hasRecordsAfter(self, position):
+        return position < (self.writeSegment.number, self.writeOffset)
+
+    def close(self):
+        with self.condition:
+            for segment in self.segments.values():
+                segment.map.flush()
+                segment.close()
+            self.segments = {}
+        if self.lockFile is not None:
+            self.lockFile.close()
+            self.lockFile = None
+
+    def getStats(self):
+        number, offset = self.checkpoint
+        backlog = (self.writeSegment.number - number) * self.segmentSize + self.writeOffset - offset if self.writeSegment else 0
+        return {
+            "segments": len(self.segments),
+            "segmentSize": self.segmentSize,
+            "backlogBytes": backlog,
+            "appended": self.appended,
+            "committed": self.committed,
+            "blockedAppends": self.blockedAppends,
+            "corruptSegments": self.corruptSegments
+        }
@@ -0,0 +1,411 @@
+import os
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+from database import saveMessage, toDbTimestamp, topicCatalog
+from dedup import DEDUP_WINDOW, Deduplicator
+from hotCache import updateHotCache
+from metrics import histogram, gauge, callbackCounter
+from ruleEngine import evaluateRules
+from messageParser import MessageParser
+from payloadDecoders import payloadText
+from websocketManager import addMessageToQueue
+
+# Ingress buffer size and what to do when it is full:
+#   block      - the paho thread waits, which pushes back on the broker socket
+#   dropOldest - the oldest unprocessed message is discarded
+#   spill      - overflow is appended to SPILL_PATH and read back once there is room
+BUFFER_CAPACITY = 10000
+BACKPRESSURE_POLICY = 'block'
+SPILL_PATH = 'ingestSpill.bin'
+
+# Worker threads per stage. Messages can be reordered when a stage has more than one
+PARSE_WORKERS = 2
+PERSIST_WORKERS = 1
+FANOUT_WORKERS = 1
+STAGE_BUFFER_CAPACITY = 10000
+
+# Print one message in every MESSAGE_LOG_EVERY to the console (by message id); 0 prints none
+MESSAGE_LOG_EVERY = 1000
+
+POLICIES = ('block', 'dropOldest', 'spill')
+
+RawMessage = namedtuple('RawMessage', ['topic', 'payload', 'qos', 'retain', 'receivedAt'])
+
+class SpillFile:
+    """Append-only overflow file for the spill policy, read back in FIFO order.
+
+    A file left by a crash holds messages that were received but never
+    stored: the ones past the saved read offset are counted on open and read
+    back before anything spilled after them. The read offset is saved to a
+    sidecar file after every batch read back, so messages already handed to
+    the pipeline are not replayed again; like any other buffered message,
+    those still in memory are lost if the process dies.
+    """
+
+    header = struct.Struct('<IIBBd')
+    offsetFormat = struct.Struct('<Q')
+
+    def __init__(self, path):
+        self.path = path
+        self.offsetPath = path + '.offset'
+        self.lock = threading.Lock()
+        self.writeHandle = None
+        self.readOffset = 0
+        self.pending = 0
+        self.recovered = self.recover()
+
+    def loadOffset(self):
+        try:
+            with open(self.offsetPath, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return 0
+        if len(data) != self.offsetFormat.size:
+            return 0
+        return self.offsetFormat.unpack(data)[0]
+
+    def saveOffset(self):
+        # Write then rename, so a crash leaves either the old offset or the new one
+        temporaryPath = self.offsetPath + '.tmp'
+        with open(temporaryPath, 'wb') as f:
+            f.write(self.offsetFormat.pack(self.readOffset))
+        os.replace(temporaryPath, self.offsetPath)
+
+    def removeOffset(self):
+        try:
+            os.remove(self.offsetPath)
+        except OSError:
+            pass
+
+    def recover(self):
+        """Count the unread complete records in a leftover file and cut off one torn by a crash"""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            # An offset without its spill file is left from a crash while removing both
+            self.removeOffset()
+            return 0
+        readOffset = self.loadOffset()
+        total = 0
+        count = 0
+        offset = 0
+        with open(self.path, 'r+b') as f:
+            while offset + self.header.size <= size:
+                topicLength, payloadLength, _, _, _ = self.header.unpack(f.read(self.header.size))
+                end = offset + self.header.size + topicLength + payloadLength
+                if end > size:
+                    break
+                f.seek(end)
+                offset = end
+                total += 1
+                if offset > readOffset:
+                    count += 1
+            f.truncate(offset)
+        if readOffset > offset:
+            # The offset does not belong to this file, read all of it
+            readOffset = 0
+            count = total
+        self.readOffset = readOffset
+        if count:
+            print(f"Replaying {count} messages spilled to {self.path} before the last shutdown")
+        self.pending = count
+        return count
+
+    def append(self, message):
+        topic = message.topic.encode('utf-8')
+        with self.lock:
+            if self.writeHandle is None:
+                self.writeHandle = open(self.path, 'ab')
+            self.writeHandle.write(self.header.pack(
+                len(topic), len(message.payload), message.qos, int(message.retain), message.receivedAt
+            ))
+            self.writeHandle.write(topic)
+            self.writeHandle.write(message.payload)
+            self.pending += 1
+
+    def readBatch(self, maxCount):
+        with self.lock:
+            if self.pending == 0:
+                return []
+            if self.writeHandle is not None:
+                self.writeHandle.flush()
+
+            messages = []
+            with open(self.path, 'rb') as f:
+                f.seek(self.readOffset)
+                while len(messages) < maxCount and self.pending > 0:
+                    topicLength, payloadLength, qos, retain, receivedAt = self.header.unpack(f.read(self.header.size))
+                    topic = f.read(topicLength).decode('utf-8')
+                    payload = f.read(payloadLength)
+                    messages.append(RawMessage(topic, payload, qos, bool(retain), receivedAt))
+                    self.pending -= 1
+                self.readOffset = f.tell()
+
+            if self.pending == 0:
+                # Everything has been read back, start the file over
+                if self.writeHandle is not None:
+                    self.writeHandle.close()
+                    self.writeHandle = None
+                os.remove(self.path)
+                self.removeOffset()
+                self.readOffset = 0
+            else:
+                self.saveOffset()
+
+            return messages
+
+class RingBuffer:
+    """Bounded FIFO shared between threads, with a policy for when it is full"""
+
+    def __init__(self, capacity, policy='block', spillPath=SPILL_PATH):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        self.capacity = capacity
+        self.policy = policy
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.spill = SpillFile(spillPath) if policy == 'spill' else None
+        self.dropped = 0
+        self.spilled = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) >= self.capacity or (self.spill and self.spill.pending):
+                if self.policy == 'block':
+                    while len(self.items) >= self.capacity and not self.closed:
+                        self.condition.wait()
+                elif self.policy == 'dropOldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    # Keep FIFO order: once spilling, everything goes to disk until it drains
+                    self.spill.append(item)
+                    self.spilled += 1
+                    self.condition.notify_all()
+                    return
+            self.items.append(item)
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.items and self.spill and self.spill.pending:
+                self.items.extend(self.spill.readBatch(self.capacity))
+
+            if not self.items:
+                self.condition.wait(timeout)
+                if not self.items:
+                    return None
+
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items) + (self.spill.pending if self.spill else 0)
+
+class PipelineStage:
+    """Runs func over every item of inputBuffer on a pool of worker threads"""
+
+    def __init__(self, name, func, inputBuffer, outputBuffer=None, workers=1):
+        self.name = name
+        self.func = func
+        self.inputBuffer = inputBuffer
+        self.outputBuffer = outputBuffer
+        self.workers = workers
+        self.threads = []
+        self.running = False
+        self.processed = 0
+        self.errors = 0
+        self.countLock = threading.Lock()
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def run(self):
+        while self.running or len(self.inputBuffer):
+            item = self.inputBuffer.get(timeout=0.5)
+            if item is None:
+                continue
+
+            try:
+                result = self.func(item)
+            except Exception as e:
+                with self.countLock:
+                    self.errors += 1
+                print(f"Error in {self.name} stage: {e}")
+                continue
+
+            with self.countLock:
+                self.processed += 1
+            if self.outputBuffer is not None and result is not None:
+                self.outputBuffer.put(result)
+
+    def getStats(self):
+        return {
+            "workers": self.workers,
+            "queueDepth": len(self.inputBuffer),
+            "processed": self.processed,
+            "errors": self.errors
+        }
+
+def parseStage(message):
+    # Raw bytes go to the decoder registry, so binary payloads are not forced through UTF-8
+    started = time.perf_counter()
+    parsedData = MessageParser.extractSensorData(
+        topic=message.topic,
+        payload=message.payload,
+        qos=message.qos,
+        retain=message.retain
+    )
+    PARSE_SECONDS.observe(time.perf_counter() - started)
+    payload = payloadText(message.payload, parsedData['format'], parsedData.get('data'))
+    return message, payload, parsedData
+
+def persistStage(item):
+    message, payload, parsedData = item
+    # Stored as received, however long the message waited in the buffers or the spill file
+    messageId = saveMessage(
+        topic=message.topic,
+        payload=payload,
+        qos=message.qos,
+        retained=message.retain,
+        readings=parsedData['sensorInfo']['readings'],
+        timestamp=toDbTimestamp(message.receivedAt)
+    )
+    parsedData['messageId'] = messageId
+    return message, payload, parsedData, messageId
+
+def fanoutStage(item):
+    message, payload, parsedData, messageId = item
+    websocket_message = {
+        "type": "new_message",
+        "messageId": messageId,
+        "topic": message.topic,
+        "payload": payload,
+        "parsedData": parsedData,
+        "timestamp": datetime.fromtimestamp(message.receivedAt).isoformat()
+    }
+
+    addMessageToQueue(websocket_message)
+
+    sensorInfo = parsedData['sensorInfo']
+    updateHotCache(message.topic, messageId, message.receivedAt, payload, sensorInfo['readings'], sensorInfo['numericValues'])
+    evaluateRules(message.topic, message.receivedAt, sensorInfo['readings'], sensorInfo['numericValues'])
+
+    # A print per message costs more than the rest of this stage at high rates, so only a sample is logged
+    if not MESSAGE_LOG_EVERY or messageId % MESSAGE_LOG_EVERY:
+        return
+    if sensorInfo['isSensorData'] and sensorInfo['numericValues']:
+        values = sensorInfo['numericValues']
+        print(f"Message [{messageId}] {message.topic} -> {values}")
+    elif parsedData['format'] == 'json':
+        print(f"Message [{messageId}] {message.topic} -> JSON data")
+    else:
+        preview = payload[:40] + "..." if len(payload) > 40 else payload
+        print(f"Message [{messageId}] {message.topic} -> {preview}")
+
+class IngestPipeline:
+    """receive -> parse -> persist -> fan out, each stage on its own threads.
+
+    The MQTT callback only calls submit(), so a slow stage never stalls the
+    paho network loop; it fills the bounded ingress buffer instead.
+    """
+
+    def __init__(self, capacity=BUFFER_CAPACITY, policy=BACKPRESSURE_POLICY, spillPath=SPILL_PATH,
+            parseWorkers=PARSE_WORKERS, persistWorkers=PERSIST_WORKERS, fanoutWorkers=FANOUT_WORKERS):
+        self.ingress = RingBuffer(capacity, policy, spillPath)
+        self.parsed = RingBuffer(STAGE_BUFFER_CAPACITY)
+        self.persisted = RingBuffer(STAGE_BUFFER_CAPACITY)
+        self.stages = [
+            PipelineStage("parse", parseStage, self.ingress, self.parsed, parseWorkers),
+            PipelineStage("persist", persistStage, self.parsed, self.persisted, persistWorkers),
+            PipelineStage("fanout", fanoutStage, self.persisted, None, fanoutWorkers)
+        ]
+        self.running = False
+        self.startLock = threading.Lock()
+        self.received = 0
+        # Copies from overlapping subscriptions and retained replays are dropped before buffering
+        self.dedup = Deduplicator(lastStoredPayload=topicCatalog.lastPayload) if DEDUP_WINDOW > 0 else None
+
+    def start(self):
+        with self.startLock:
+            if self.running:
+                return
+            self.ingress.closed = False
+            for stage in self.stages:
+                stage.start()
+            self.running = True
+
+    def stop(self):
+        # Stop front to back so each stage drains into the next before it exits
+        self.ingress.close()
+        for stage in self.stages:
+            stage.stop()
+        self.running = False
+
+    def submit(self, topic, payload, qos=0, retain=False):
+        self.received += 1
+        receivedAt = time.time()
+        if self.dedup is not None and self.dedup.check(topic, payload, retain, receivedAt):
+            return
+        self.ingress.put(RawMessage(topic, payload, qos, retain, receivedAt))
+
+    def getStats(self):
+        return {
+            "received": self.received,
+            "policy": self.ingress.policy,
+            "capacity": self.ingress.capacity,
+            "bufferDepth": len(self.ingress),
+            "dropped": self.ingress.dropped,
+            "spilled": self.ingress.spilled,
+            "dedup": self.dedup.getStats() if self.dedup is not None else None,
+            "stages": {stage.name: stage.getStats() for stage in self.stages}
+        }
+
+# Global instance
+pipeline = IngestPipeline()
+
+PARSE_SECONDS = histogram('historian_parse_seconds', 'Time to decode and parse one message')
+callbackCounter('historian_pipeline_received_total', 'Messages handed to the ingest pipeline', lambda: pipeline.received)
+callbackCounter('historian_pipeline_dropped_total', 'Messages dropped by the dropOldest backpressure policy', lambda: pipeline.ingress.dropped)
+callbackCounter('historian_pipeline_spilled_total', 'Messages spilled to disk by the spill backpressure policy', lambda: pipeline.ingress.spilled)
+callbackCounter('historian_pipeline_deduplicated_total', 'Duplicate deliveries and unchanged retained replays not stored',
+                lambda: {(reason,): count for reason, count in pipeline.dedup.suppressed.items()}
+                if pipeline.dedup is not None else None, ('reason',))
+gauge('historian_pipeline_queue_depth', 'Messages waiting for each pipeline stage',
+      lambda: {(stage.name,): len(stage.inputBuffer) for stage in pipeline.stages}, ('stage',))
+callbackCounter('historian_pipeline_errors_total', 'Messages a pipeline stage failed on',
+                lambda: {(stage.name,): stage.errors for stage in pipeline.stages}, ('stage',))
+
+def setMessageLogEvery(every):
+    """Change console message sampling at runtime"""
+    global MESSAGE_LOG_EVERY
+    MESSAGE_LOG_EVERY = max(0, every)
+
+def startPipeline():
+    pipeline.start()
+
+def stopPipeline():
+    pipeline.stop()
+
+def getPipelineStats():
+    return pipeline.getStats()
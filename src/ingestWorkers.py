@@ -0,0 +1,253 @@
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from datetime import datetime
+from database import saveMessage, toDbTimestamp, topicCatalog, utcTimestamp
+from dedup import DEDUP_WINDOW, Deduplicator
+from hotCache import updateHotCache
+from metrics import callbackCounter
+from ruleEngine import evaluateRules
+from messageParser import MessageParser
+from mqttClient import MQTTClient, expandConnections
+from payloadDecoders import payloadText
+from websocketManager import messageStream
+
+# Records a worker sends to the collector in one pipe write, and how long it
+# waits to fill a batch
+WORKER_BATCH_SIZE = 500
+WORKER_BATCH_DELAY = 0.02
+
+# Parsed records a worker holds before its MQTT threads block, and batches in
+# flight between all workers and the collector
+WORKER_BUFFER_CAPACITY = 20000
+COLLECTOR_QUEUE_BATCHES = 64
+
+# Per-worker shared counters: messages parsed, connections up
+COUNTERS_PER_WORKER = 2
+
+def encodeStreamTail(topic, payload, parsedData, receivedAt):
+    """The WebSocket message minus its leading type and messageId fields.
+
+    Encoded in the worker, with and without parsedData, so the collector only
+    has to prepend the id the writer assigns.
+    """
+    message = {
+        "topic": topic,
+        "payload": payload,
+        "parsedData": parsedData,
+        "timestamp": datetime.fromtimestamp(receivedAt).isoformat()
+    }
+    full = json.dumps(message)
+    del message["parsedData"]
+    return full[1:], json.dumps(message)[1:]
+
+class IngestWorker:
+    """Runs in a worker process: owns some MQTT connections and parses what they receive.
+
+    Parsing runs on each connection's paho thread, inside this process, so it
+    never competes with the API process for the GIL. Results are batched onto
+    the collector queue as compact tuples.
+    """
+
+    def __init__(self, workerIndex, connections, output, counters, stopEvent):
+        self.workerIndex = workerIndex
+        self.connections = connections
+        self.output = output
+        self.counters = counters
+        self.stopEvent = stopEvent
+        self.records = queue.Queue(maxsize=WORKER_BUFFER_CAPACITY)
+        self.parsed = 0
+
+    def submit(self, topic, payload, qos=0, retain=False):
+        receivedAt = time.time()
+        parsedData = MessageParser.extractSensorData(topic, payload, qos, retain)
+        text = payloadText(payload, parsedData['format'], parsedData.get('data'))
+        sensorInfo = parsedData['sensorInfo']
+        readings = sensorInfo['readings']
+        for reading in readings:
+            # Normalise here so the writer does not have to parse timestamps
+            try:
+                reading['timestamp'] = toDbTimestamp(reading.get('timestamp'))
+            except (ValueError, OverflowError, OSError):
+                reading['timestamp'] = None
+        encoded, compact = encodeStreamTail(topic, text, parsedData, receivedAt)
+        self.records.put((topic, text, qos, retain, utcTimestamp(), readings, encoded, compact,
+                          sensorInfo['numericValues'], receivedAt))
+
+    def run(self):
+        clients = [MQTTClient(config, index, self.submit) for config, index in self.connections]
+        for client in clients:
+            client.connect()
+
+        base = self.workerIndex * COUNTERS_PER_WORKER
+        while not self.stopEvent.is_set() or not self.records.empty():
+            batch = self.nextBatch()
+            if batch:
+                self.output.put(batch)
+                self.parsed += len(batch)
+            self.counters[base] = self.parsed
+            self.counters[base + 1] = sum(client.connected for client in clients)
+
+            if self.stopEvent.is_set() and clients:
+                # Stop receiving, then send whatever is still buffered
+                for client in clients:
+                    client.disconnect()
+                clients = []
+        self.counters[base + 1] = 0
+
+    def nextBatch(self):
+        batch = []
+        deadline = time.monotonic() + WORKER_BATCH_DELAY
+        while len(batch) < WORKER_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.records.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+def runIngestWorker(workerIndex, connections, output, counters, stopEvent):
+    IngestWorker(workerIndex, connections, output, counters, stopEvent).run()
+
+class IngestWorkerPool:
+    """Multi-process ingest: N worker processes receive and parse, one writer stores.
+
+    The broker connections from brokers.json (with shared-subscription
+    connections expanded) are dealt out to the workers round robin, so give a
+    high-volume topic tree a sharedGroup with at least as many connections as
+    workers. Only receiving, decoding and parsing run in the workers. A
+    collector thread in this process takes the parsed batches off the queue,
+    drops duplicate copies (one Deduplicator sees every worker's messages, so
+    a copy delivered to two workers is still stored once), hands the rows to
+    the single DatabaseWriter, which compresses payloads, and runs the hot
+    cache, alert rules and WebSocket fan-out.
+    """
+
+    def __init__(self, workers, brokers):
+        self.workers = workers
+        self.connections = expandConnections(brokers)
+        if len(self.connections) < workers:
+            print(f"Only {len(self.connections)} broker connections for {workers} ingest workers; "
+                  f"add a sharedGroup with more connections to use every worker")
+        self.context = multiprocessing.get_context('spawn')
+        self.output = self.context.Queue(maxsize=COLLECTOR_QUEUE_BATCHES)
+        self.counters = self.context.Array('q', workers * COUNTERS_PER_WORKER, lock=False)
+        self.stopEvent = self.context.Event()
+        self.processes = []
+        self.collector = None
+        self.running = False
+        self.collected = 0
+        self.batches = 0
+        self.fanoutErrors = 0
+        self.dedup = Deduplicator(lastStoredPayload=topicCatalog.lastPayload) if DEDUP_WINDOW > 0 else None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for workerIndex in range(self.workers):
+            process = self.context.Process(
+                target=runIngestWorker,
+                args=(workerIndex, self.connections[workerIndex::self.workers], self.output,
+                      self.counters, self.stopEvent),
+                name=f"ingestWorker-{workerIndex}",
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+        self.collector = threading.Thread(target=self.collect, name="ingestCollector", daemon=True)
+        self.collector.start()
+
+    def stop(self, timeout=10.0):
+        if not self.running:
+            return
+        # Workers disconnect, flush their buffers and exit; the collector drains the queue
+        self.stopEvent.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.running = False
+        self.collector.join(timeout)
+        self.processes = []
+
+    def collect(self):
+        while self.running or not self.output.empty():
+            try:
+                batch = self.output.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            for topic, payload, qos, retain, timestamp, readings, encoded, compact, numbers, receivedAt in batch:
+                # Payloads arrive in their stored text form, which dedup compares as it is
+                if self.dedup is not None and self.dedup.check(topic, payload, retain, receivedAt):
+                    continue
+                try:
+                    messageId = saveMessage(topic, payload, qos, retain, readings, timestamp)
+                except Exception as e:
+                    print(f"Error storing message from ingest worker: {e}")
+                    continue
+                # The message is stored; a failure past this point must not stop the collector
+                try:
+                    prefix = '{"type": "new_message", "messageId": %d, ' % messageId
+                    messageStream.publishEncoded(topic, prefix + encoded, prefix + compact)
+                    updateHotCache(topic, messageId, receivedAt, payload, readings, numbers)
+                    evaluateRules(topic, receivedAt, readings, numbers)
+                except Exception as e:
+                    self.fanoutErrors += 1
+                    print(f"Error fanning out message {messageId} from ingest worker: {e}")
+            self.collected += len(batch)
+            self.batches += 1
+
+    @property
+    def connected(self):
+        return any(self.counters[i * COUNTERS_PER_WORKER + 1] for i in range(self.workers))
+
+    def getStats(self):
+        return {
+            "workers": [
+                {
+                    "alive": process.is_alive(),
+                    "connections": len(self.connections[i::self.workers]),
+                    "connected": self.counters[i * COUNTERS_PER_WORKER + 1],
+                    "parsed": self.counters[i * COUNTERS_PER_WORKER]
+                }
+                for i, process in enumerate(self.processes)
+            ],
+            "collected": self.collected,
+            "fanoutErrors": self.fanoutErrors,
+            "dedup": self.dedup.getStats() if self.dedup is not None else None,
+            "avgBatchSize": round(self.collected / self.batches, 1) if self.batches else 0
+        }
+
+# Only created in multi-process mode (main.py --workers N)
+workerPool = None
+
+callbackCounter('historian_worker_parsed_total', 'Messages parsed by each ingest worker process',
+                lambda: {(str(i),): workerPool.counters[i * COUNTERS_PER_WORKER] for i in range(workerPool.workers)}
+                if workerPool is not None else None, ('worker',))
+callbackCounter('historian_worker_deduplicated_total', 'Duplicate deliveries and unchanged retained replays the collector did not store',
+                lambda: {(reason,): count for reason, count in workerPool.dedup.suppressed.items()}
+                if workerPool is not None and workerPool.dedup is not None else None, ('reason',))
+callbackCounter('historian_worker_collected_total', 'Parsed messages the collector handed to the writer',
+                lambda: workerPool.collected if workerPool is not None else None)
+
+def startIngestWorkers(workers, brokers):
+    global workerPool
+    workerPool = IngestWorkerPool(workers, brokers)
+    workerPool.start()
+    return workerPool
+
+def stopIngestWorkers():
+    if workerPool is not None:
+        workerPool.stop()
+
+def getIngestWorkerStats():
+    return workerPool.getStats() if workerPool is not None else None
+
+def ingestWorkersConnected():
+    return workerPool is not None and workerPool.connected
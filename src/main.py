@@ -1,20 +1,46 @@
-﻿from fastapi import FastAPI
+﻿from fastapi import FastAPI, HTTPException
 import uvicorn
-import threading
+import argparse
 import time
 import asyncio
-from database import initDatabase, getRecentMessages
-from mqttClient import startMqttClient, mqttClient
+from contextlib import asynccontextmanager
+from database import getAlerts, getMessagesPage, exportMessages, getSensorReadings, getTopics, getTopicCount, getWriterStats
+from mqttClient import mqttClients, getMqttStats
+from ingestWorkers import getIngestWorkerStats, ingestWorkersConnected
+from ingestPipeline import getPipelineStats
+from payloadDecoders import getDecoderStats
+from payloadCodec import setPayloadCompression, getPayloadCodecStats
+from rollups import getSensorSeries
+from archiver import getArchiveStats, queryArchive
+from aggregation import aggregateSeries, DEFAULT_PERCENTILES
+from ruleEngine import getRules, addRule, removeRule, getRuleEngineStats
+from startup import startServices, stopServices, getReadiness
+from hotCache import getLatest, getRecent, getLatestSensors, getHotCacheStats, RECENT_WINDOW
+from metrics import renderMetrics, startProfiler, stopProfiler, getProfilerStats, PROFILER_INTERVAL
+from ingestPipeline import setMessageLogEvery
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import List
+from typing import List, Optional
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from websocketManager import manager, getQueuedMessages, processQueuedMessages
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from websocketManager import manager, messageStream, getQueuedMessages, getStreamStats
+
+# Ingest worker processes to start by default (--workers overrides)
+INGEST_WORKERS = 0
+
+@asynccontextmanager
+async def lifespan(app):
+    # MQTT threads hand messages to this loop from now on
+    messageStream.bind(asyncio.get_running_loop())
+    # Creates the schema, then brings everything else up in the background: the API serves meanwhile
+    startServices(INGEST_WORKERS)
+    yield
+    stopServices()
 
 app = FastAPI(
     title="Universal MQTT Data Historian",
     description="Real-time MQTT data storage and API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -26,12 +52,22 @@ def root():
         "docs": "Visit /docs for API documentation",
         "endpoints": [
             "/docs - Interactive API docs",
-            "/messages - Get stored messages", 
+            "/messages - Get stored messages, a page at a time", 
+            "/messages/export - Stream stored messages as NDJSON or CSV",
             "/status - System status",
+            "/ready - Startup progress per subsystem (503 until ready)",
             "/topics - Discovered topics",
+            "/sensors/{deviceId}/{sensorType} - Sensor readings in a time range",
+            "/api/archive/sensors - Aggregates over the Parquet archive",
+            "/api/aggregate - Bucketed statistics and LTTB downsampling for a sensor series",
+            "/api/latest - Latest message per topic, from memory",
+            "/api/recent/{topic} - Recent numeric samples of one topic, from memory",
+            "/api/rules - Alert rules (GET, POST, DELETE /api/rules/{name})",
+            "/api/alerts - Alerts raised by the rules",
             "/dashboard - Web Dashboard",
             "/api/stats - System statistics",
-            "/api/queued-messages - Get queued messages"
+            "/api/queued-messages - Get queued messages",
+            "/metrics - Prometheus metrics"
         ]
     }
 
@@ -40,41 +76,188 @@ def status():
     return {
         "status": "healthy",
         "service": "MQTT Data Historian",
-        "mqttConnected": mqttClient.connected,
+        "mqttConnected": mqttClients.connected or ingestWorkersConnected(),
         "timestamp": time.time()
     }
 
+@app.get("/ready")
+def ready():
+    """Each subsystem's startup state; 503 until the database, migrations and writer are up"""
+    readiness = getReadiness()
+    return JSONResponse(content=readiness, status_code=200 if readiness["ready"] else 503)
+
 @app.get("/messages")
-def getMessages(limit: int = 10):
-    messages = getRecentMessages(limit)
+def getMessages(limit: int = 10, cursor: Optional[str] = None, topic: Optional[str] = None,
+                start: Optional[str] = None, end: Optional[str] = None, order: str = "desc"):
+    """Newest messages first (order=asc for oldest); pass nextCursor back as cursor for the next page"""
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be asc or desc")
+    try:
+        page = getMessagesPage(limit, cursor, topic, start, end, order == "desc")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {
-        "count": len(messages),
+        "count": len(page["messages"]),
         "limit": limit,
-        "messages": messages
+        "messages": page["messages"],
+        "nextCursor": page["nextCursor"]
     }
 
+@app.get("/messages/export")
+def exportMessageHistory(format: str = "ndjson", topic: Optional[str] = None, start: Optional[str] = None,
+                         end: Optional[str] = None, order: str = "asc"):
+    """Every matching message, streamed in chunks straight from the database"""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be asc or desc")
+    chunks = exportMessages(format, topic, start, end, order == "desc")
+    try:
+        # Run the first query now so bad filters get a 400 instead of a broken stream
+        first = next(chunks, '')
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def stream():
+        yield first
+        yield from chunks
+
+    mediaType = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    return StreamingResponse(stream(), media_type=mediaType,
+                             headers={"Content-Disposition": f"attachment; filename=messages.{format}"})
+
 @app.get("/topics")
-def getTopics(limit: int = 20):
-    messages = getRecentMessages(limit)
-    topics = {}
-    
-    for msg in messages:
-        topic = msg['topic']
-        if topic in topics:
-            topics[topic] += 1
-        else:
-            topics[topic] = 1
-    
+def getTopicList(limit: int = 20):
+    # Served from the topic catalog: counts cover the full history, not the last N messages
+    catalog = getTopics(limit)
+    return {
+        "uniqueTopicsCount": getTopicCount(),
+        "limit": limit,
+        "topics": {entry["topic"]: entry["messageCount"] for entry in catalog},
+        "details": catalog
+    }
+
+@app.get("/sensors/{deviceId}/{sensorType}")
+def getSensorData(deviceId: str, sensorType: str, start: Optional[str] = None, end: Optional[str] = None,
+                  limit: int = 10000, resolution: Optional[int] = None):
+    try:
+        if resolution:
+            # Aggregated buckets, served from the coarsest rollup that fits
+            series = getSensorSeries(deviceId, sensorType, start, end, resolution)
+            return {
+                "deviceId": deviceId,
+                "sensorType": sensorType,
+                "start": start,
+                "end": end,
+                **series
+            }
+        series = getSensorReadings(deviceId, sensorType, start, end, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid time range: {e}")
+    return {
+        "deviceId": deviceId,
+        "sensorType": sensorType,
+        "start": start,
+        "end": end,
+        "count": len(series["readings"]),
+        "unit": series["unit"],
+        "readings": series["readings"]
+    }
+
+@app.get("/api/archive/sensors")
+def getArchivedSensorData(start: Optional[str] = None, end: Optional[str] = None, deviceId: Optional[str] = None,
+                          sensorType: Optional[str] = None, topic: Optional[str] = None, resolution: int = 3600):
+    """min/max/avg/count buckets per series from archived days, without touching SQLite"""
+    try:
+        result = queryArchive(start, end, deviceId, sensorType, topic, resolution)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "start": start,
+        "end": end,
+        **result
+    }
+
+@app.get("/api/aggregate")
+def getAggregate(field: str, topic: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None,
+                 bucket: Optional[int] = None, points: Optional[int] = None, percentiles: Optional[str] = None):
+    """Per-bucket min/max/mean/count/percentiles of one reading type (field = sensorType), and/or
+    the series downsampled to `points` points with LTTB for plotting"""
+    if bucket is None and points is None:
+        raise HTTPException(status_code=400, detail="Give bucket (seconds), points (LTTB) or both")
+    try:
+        wanted = [float(p) for p in percentiles.split(',') if p] if percentiles is not None else DEFAULT_PERCENTILES
+        result = aggregateSeries(field, topic, start, end, bucket, points, wanted)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {
-        "uniqueTopicsCount": len(topics),
-        "topics": topics
+        "start": start,
+        "end": end,
+        **result
+    }
+
+@app.get("/api/latest")
+def getLatestMessages(topic: Optional[str] = None, limit: Optional[int] = None):
+    """Latest message per topic (topic may be an MQTT filter), most recently updated first"""
+    try:
+        latest = getLatest(topic, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "count": len(latest),
+        "topics": latest
+    }
+
+@app.get("/api/recent/{topic:path}")
+def getRecentSamples(topic: str, seconds: int = RECENT_WINDOW, field: Optional[str] = None):
+    """Numeric samples from the last `seconds`, per field, served from the hot cache"""
+    if seconds <= 0:
+        raise HTTPException(status_code=400, detail="seconds must be positive")
+    return getRecent(topic, seconds, field)
+
+@app.get("/api/sensors/latest")
+def getLatestSensorValues():
+    return {"sensors": getLatestSensors()}
+
+@app.get("/api/rules")
+def listRules():
+    return {"rules": getRules()}
+
+@app.post("/api/rules")
+def createRule(rule: dict):
+    """Add a rule, or replace the rule with the same name; saved to rules.json"""
+    try:
+        return addRule(rule)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/api/rules/{name}")
+def deleteRule(name: str):
+    if not removeRule(name):
+        raise HTTPException(status_code=404, detail=f"No rule named {name}")
+    return {"deleted": name}
+
+@app.get("/api/alerts")
+def listAlerts(limit: int = 100, rule: Optional[str] = None, state: Optional[str] = None, since: Optional[str] = None):
+    """Alerts the rule engine raised, newest first; state is 'firing' or 'resolved'"""
+    try:
+        alerts = getAlerts(limit, rule, state, since)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "count": len(alerts),
+        "alerts": alerts
     }
 
 @app.post("/publish/{topic}")
 def publishMessage(topic: str, message: str):
     print(f"PUBLISH ENDPOINT CALLED: topic={topic}, message={message}")
-    if mqttClient.connected:
-        mqttClient.publishMessage(topic, message)
+    if mqttClients.connected:
+        mqttClients.publishMessage(topic, message)
         return {
             "status": "published",
             "topic": topic, 
@@ -93,55 +276,84 @@ async def dashboard():
 
 @app.get("/api/stats")
 async def get_stats():
-    from database import getMessageCount, getUniqueTopics
+    from database import getMessageCount
     return {
         "totalMessages": getMessageCount(),
-        "uniqueTopics": len(getUniqueTopics()),
-        "mqttConnected": mqttClient.connected
+        "uniqueTopics": getTopicCount(),
+        "mqttConnected": mqttClients.connected or ingestWorkersConnected(),
+        "brokers": getMqttStats(),
+        "ingestWorkers": getIngestWorkerStats(),
+        "pipeline": getPipelineStats(),
+        "decoders": getDecoderStats(),
+        "writer": getWriterStats(),
+        "payloads": getPayloadCodecStats(),
+        "archive": getArchiveStats(),
+        "hotCache": getHotCacheStats(),
+        "rules": getRuleEngineStats(),
+        "stream": getStreamStats()
     }
 
+@app.get("/metrics")
+def metrics():
+    return Response(content=renderMetrics(), media_type="text/plain; version=0.0.4")
+
+@app.post("/debug/profile/start")
+def startProfiling(interval: float = PROFILER_INTERVAL):
+    """Start sampling every thread's stack; stop with /debug/profile/stop"""
+    if not 0.001 <= interval <= 1.0:
+        raise HTTPException(status_code=400, detail="interval must be between 0.001 and 1 second")
+    started = startProfiler(interval)
+    return {"started": started, **getProfilerStats()}
+
+@app.post("/debug/profile/stop")
+def stopProfiling():
+    """Stop the profiler and return the collapsed stacks, ready for flamegraph.pl or speedscope"""
+    return Response(content=stopProfiler(), media_type="text/plain")
+
+@app.get("/debug/profile")
+def profilerStatus():
+    return getProfilerStats()
+
+@app.post("/debug/log-sampling")
+def setLogSampling(every: int):
+    """Print one ingested message in every `every` to the console; 0 turns message logging off"""
+    setMessageLogEvery(every)
+    return {"messageLogEvery": max(0, every)}
+
 @app.get("/api/queued-messages")
-async def get_queued_messages():
-    """Get queued messages for polling"""
-    messages = getQueuedMessages()
-    return {"messages": messages}
+async def get_queued_messages(cursor: Optional[int] = None):
+    """Messages after the client's cursor; pass the returned cursor on the next poll"""
+    # Messages are already JSON-encoded once in the stream, so skip re-serialization
+    return Response(content=getQueuedMessages(cursor), media_type="application/json")
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
+    # Delivery runs in its own task so it is not tied to client keep-alives
+    sender = asyncio.create_task(manager.streamTo(websocket))
     try:
         while True:
-            # Process queued messages and keep connection alive
-            await processQueuedMessages()
-            await websocket.receive_text()  # Keep this for connection keep-alive
+            # Keep-alives, and subscribe requests that set this client's filters and rate
+            text = await websocket.receive_text()
+            await manager.handleClientMessage(websocket, text)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
-
-# ADD THIS BACKGROUND TASK FUNCTION
-async def process_queued_messages_background():
-    """Background task to process queued messages"""
-    while True:
-        await processQueuedMessages()
-        await asyncio.sleep(0.5)  # Process every 500ms
-
-def startBackgroundServices():
-    print("Starting background services")
-    if startMqttClient():
-        print("MQTT client started - capturing real IoT data")
-    else:
-        print("Failed to start MQTT client")
+        sender.cancel()
 
 if __name__ == "__main__":
-    initDatabase()
-    print("Database initialized")
+    parser = argparse.ArgumentParser(description="Universal MQTT Data Historian")
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS,
+                        help="ingest worker processes; 0 receives and parses in this process")
+    parser.add_argument('--compress-payloads', dest='compressPayloads', choices=['zstd', 'zlib'],
+                        help="store new payloads compressed with per-topic-family dictionaries")
+    options = parser.parse_args()
 
-    mqttThread = threading.Thread(target=startBackgroundServices, daemon=True)
-    mqttThread.start()
-    
-    # Start background task for processing queued messages
-    import asyncio
-    loop = asyncio.get_event_loop()
-    asyncio.ensure_future(process_queued_messages_background())
+    if options.compressPayloads:
+        setPayloadCompression(options.compressPayloads)
+    # Services start in the lifespan, on uvicorn's event loop
+    INGEST_WORKERS = options.workers
     
     print("Starting FastAPI server on http://0.0.0.0:8000")
     print("API Documentation: http://localhost:8000/docs")
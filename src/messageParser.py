@@ -1,43 +1,84 @@
-import json
 import re
 from datetime import datetime
+from functools import lru_cache
+from payloadDecoders import decodePayload
+
+# Distinct topics whose classification is kept
+TOPIC_CACHE_SIZE = 4096
+
+SENSOR_KEYWORDS = re.compile('temperature|humidity|pressure|voltage|status|sensor|data')
+SENSOR_TYPE_KEYWORDS = re.compile('temperature|humidity|pressure|sensor')
+CONTROL_KEYWORDS = re.compile('cmd|control|set|command')
+STATUS_KEYWORDS = re.compile('status|state|online|offline')
+NUMBER_PATTERN = re.compile(r"[-+]?\d*\.\d+|\d+")
+
+# Keys whose numeric values are epoch times rather than readings
+TIME_KEYS = frozenset(('timestamp', 'ts', 'time'))
+
+@lru_cache(maxsize=TOPIC_CACHE_SIZE)
+def classifyTopic(topic):
+    """Everything derived from the topic string alone, computed once per distinct topic.
+
+    Returns (segments, detectedSensors, patterns) as tuples so cached results
+    cannot be changed by callers.
+    """
+    segments = tuple(topic.split('/'))
+    lowered = topic.lower()
+    detectedSensors = tuple(segment for segment in segments if SENSOR_KEYWORDS.search(segment.lower()))
+    patterns = (
+        ('hasDeviceId', len(segments) >= 2 and any(char.isdigit() for char in segments[1])),
+        ('hasSensorType', SENSOR_TYPE_KEYWORDS.search(lowered) is not None),
+        ('isControlTopic', CONTROL_KEYWORDS.search(lowered) is not None),
+        ('isStatusTopic', STATUS_KEYWORDS.search(lowered) is not None),
+        ('depth', len(segments))
+    )
+    return segments, detectedSensors, patterns
+
+def collectNumbers(data, numbers):
+    """Append every numeric leaf of a decoded payload to numbers, except values under TIME_KEYS"""
+    dataType = type(data)
+    if dataType is dict:
+        items = [value for key, value in data.items() if key not in TIME_KEYS]
+    else:
+        items = data if dataType is list else (data,)
+    for value in items:
+        # Exact type checks: they are cheaper than isinstance and leave out bools
+        valueType = type(value)
+        if valueType is float or valueType is int:
+            numbers.append(float(value))
+        elif valueType is dict or valueType is list:
+            collectNumbers(value, numbers)
 
 class MessageParser:
     @staticmethod
     def parseMessage(topic, payload, qos=0, retain=False):
+        """Decode a payload (bytes or str) with the decoder registered or learned for its topic"""
+        segments = classifyTopic(topic)[0]
         try:
-            try:
-                data = json.loads(payload)
-                return {
-                    "format": "json",
-                    "data": data,
-                    "timestamp": datetime.now().isoformat(),
-                    "topicStructure": topic.split('/'),
-                    "mqttMetadata": {
-                        "qos": qos,
-                        "retained": retain,
-                        "topic": topic
-                    }
-                }
-            except json.JSONDecodeError:
-                return {
-                    "format": "text", 
-                    "data": payload,
-                    "timestamp": datetime.now().isoformat(),
-                    "topicStructure": topic.split('/'),
-                    "length": len(payload),
-                    "mqttMetadata": {
-                        "qos": qos,
-                        "retained": retain, 
-                        "topic": topic
-                    }
+            format, data = decodePayload(topic, payload)
+            parsed = {
+                "format": format,
+                "data": data,
+                "timestamp": datetime.now().isoformat(),
+                "topicStructure": list(segments),
+                "mqttMetadata": {
+                    "qos": qos,
+                    "retained": retain,
+                    "topic": topic
                 }
+            }
+            if format == 'text':
+                parsed["length"] = len(data)
+            elif format == 'binary':
+                parsed["data"] = data.hex()
+                parsed["length"] = len(data)
+            return parsed
                 
         except Exception as e:
             return {
                 "format": "error",
                 "error": str(e),
-                "rawPayload": payload,
+                "rawPayload": payload if isinstance(payload, str) else payload.hex(),
                 "timestamp": datetime.now().isoformat(),
                 "mqttMetadata": {
                     "qos": qos,
@@ -49,40 +90,64 @@ class MessageParser:
     @staticmethod
     def extractSensorData(topic, payload, qos=0, retain=False):
         parsed = MessageParser.parseMessage(topic, payload, qos, retain)
+        detectedSensors = classifyTopic(topic)[1]
         
-        sensorTypes = ['temperature', 'humidity', 'pressure', 'voltage', 'status', 'sensor', 'data']
-        detectedSensors = []
-        
-        for segment in parsed['topicStructure']:
-            for sensorType in sensorTypes:
-                if sensorType in segment.lower():
-                    detectedSensors.append(segment)
-                    break
-        
-        numbers = re.findall(r"[-+]?\d*\.\d+|\d+", str(payload))
+        # Numbers come from the decoded structure, so digits inside ids and
+        # timestamp strings, and epoch times under TIME_KEYS, are not mistaken for readings
+        numbers = []
+        if parsed['format'] == 'text':
+            numbers = [float(num) for num in NUMBER_PATTERN.findall(parsed['data'])]
+        elif parsed['format'] not in ('binary', 'error'):
+            collectNumbers(parsed['data'], numbers)
         
         parsed['sensorInfo'] = {
-            'detectedSensors': detectedSensors,
-            'numericValues': [float(num) for num in numbers] if numbers else [],
-            'isSensorData': len(detectedSensors) > 0 or len(numbers) > 0
+            'detectedSensors': list(detectedSensors),
+            'numericValues': numbers,
+            'isSensorData': len(detectedSensors) > 0 or len(numbers) > 0,
+            'readings': MessageParser.extractReadings(topic, parsed)
         }
         
         return parsed
 
     @staticmethod
-    def analyzeTopicPattern(topic):
-        segments = topic.split('/')
+    def extractReadings(topic, parsed):
+        """Structured readings for the sensorData table.
+
+        Accepts the DeviceSimulator layout, in any structured format, ({"deviceId", "type", "value", "unit",
+        "timestamp"}) or a list of such objects. deviceId and type fall back to
+        topic segments, e.g. codePower/sensors/room1/temperature -> room1, temperature.
+        """
+        if parsed['format'] in ('text', 'binary', 'error'):
+            return []
         
-        patterns = {
-            'hasDeviceId': len(segments) >= 2 and (segments[1].isdigit() or any(char.isdigit() for char in segments[1])),
-            'hasSensorType': any(sensor in topic.lower() for sensor in ['temperature', 'humidity', 'pressure', 'sensor']),
-            'isControlTopic': any(keyword in topic.lower() for keyword in ['cmd', 'control', 'set', 'command']),
-            'isStatusTopic': any(keyword in topic.lower() for keyword in ['status', 'state', 'online', 'offline']),
-            'depth': len(segments),
-            'segments': segments
-        }
+        data = parsed['data']
+        items = data if isinstance(data, list) else [data]
+        segments = parsed['topicStructure']
+        
+        readings = []
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            value = item.get('value')
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            
+            readings.append({
+                'deviceId': str(item.get('deviceId') or (segments[-2] if len(segments) > 1 else segments[0])),
+                'sensorType': str(item.get('type') or segments[-1]),
+                'value': float(value),
+                'unit': item.get('unit'),
+                'timestamp': item.get('timestamp')
+            })
         
-        return patterns
+        return readings
+
+    @staticmethod
+    def analyzeTopicPattern(topic):
+        segments, _, patterns = classifyTopic(topic)
+        result = dict(patterns)
+        result['segments'] = list(segments)
+        return result
 
     @staticmethod
     def parseAndSave(messageId, topic, payload, qos=0, retain=False):
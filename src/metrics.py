@@ -0,0 +1,228 @@
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as StackCounter
+
+# Default histogram buckets, in seconds, and for batch sizes in rows
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Seconds between stack samples while the profiler runs
+PROFILER_INTERVAL = 0.01
+
+def formatLabels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class CounterMetric:
+    """Monotonic count, optionally split by label values"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name, labels, None, value) for labels, value in values]
+
+class HistogramMetric:
+    """Cumulative-bucket histogram in the Prometheus layout. observe() is one
+    bisect and three additions under a lock."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labelNames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelNames = labelNames
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self.lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items()]
+        samples = []
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucketCount
+                samples.append((self.name + '_bucket', labels, ('le', formatValue(bound)), cumulative))
+            samples.append((self.name + '_sum', labels, None, total))
+            samples.append((self.name + '_count', labels, None, count))
+        return samples
+
+class CallbackMetric:
+    """Gauge or counter read at scrape time from state the code already keeps,
+    so the hot path pays nothing for it. func returns a number or {labels: value}."""
+
+    def __init__(self, name, help, func, type='gauge', labelNames=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+        self.labelNames = labelNames
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [(self.name, labels, None, sampleValue) for labels, sampleValue in value.items()]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            # Modules may be imported more than once (e.g. re-running a benchmark); keep the first
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, extra, value in metric.samples():
+                lines.append(f"{name}{formatLabels(metric.labelNames, labels, extra)} {formatValue(value)}")
+        return '\n'.join(lines) + '\n'
+
+# Global instance
+registry = MetricsRegistry()
+
+def counter(name, help, labelNames=()):
+    return registry.register(CounterMetric(name, help, labelNames))
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, labelNames=()):
+    return registry.register(HistogramMetric(name, help, buckets, labelNames))
+
+def gauge(name, help, func, labelNames=()):
+    return registry.register(CallbackMetric(name, help, func, 'gauge', labelNames))
+
+def callbackCounter(name, help, func, labelNames=()):
+    return registry.register(CallbackMetric(name, help, func, 'counter', labelNames))
+
+def renderMetrics():
+    return registry.render()
+
+class SamplingProfiler:
+    """Samples every thread's stack at a fixed interval while running.
+
+    Off by default and switched on at runtime; the result is in the collapsed
+    stack format (one "frame;frame;frame count" line per stack) that
+    flamegraph.pl and speedscope read. Sampling from a separate thread costs
+    the profiled threads nothing beyond the GIL hand-off at each sample.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.startedAt = None
+        self.interval = PROFILER_INTERVAL
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval=PROFILER_INTERVAL):
+        if self.thread is not None:
+            return False
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.startedAt = time.time()
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="samplingProfiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if self.thread is None:
+            return self.collapsed()
+        self.stopEvent.set()
+        self.thread.join(5.0)
+        self.thread = None
+        return self.collapsed()
+
+    def run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stopEvent.wait(self.interval):
+            names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def getStats(self):
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "startedAt": self.startedAt,
+            "distinctStacks": len(self.stacks)
+        }
+
+# Global instance
+profiler = SamplingProfiler()
+
+def startProfiler(interval=PROFILER_INTERVAL):
+    return profiler.start(interval)
+
+def stopProfiler():
+    return profiler.stop()
+
+def getProfilerStats():
+    return profiler.getStats()
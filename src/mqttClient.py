@@ -1,112 +1,259 @@
 ﻿import paho.mqtt.client as mqtt
+import json
+import os
+import threading
 import time
-from database import saveMessage
-from messageParser import MessageParser
-from websocketManager import addMessageToQueue
-from datetime import datetime
+from ingestPipeline import pipeline
+from topicMatcher import dedupeFilters, validateFilter
+from metrics import counter, callbackCounter, gauge
+
+# Broker connections. MQTT_CONFIG_PATH, when present, replaces DEFAULT_BROKERS
+# with a JSON list of the same shape. Per connection:
+#   host, port, filters, qos         - where to connect and what to subscribe to
+#   clientId, username, password     - optional; clientId defaults to a unique name
+#   protocol                         - "3.1.1" or "5"
+#   sharedGroup, connections         - subscribe as $share/<sharedGroup>/<filter> from
+#                                      this many connections, so the broker spreads one
+#                                      topic tree over several paho network threads
+MQTT_CONFIG_PATH = 'brokers.json'
+DEFAULT_BROKERS = [
+    {
+        "name": "default",
+        "host": "test.mosquitto.org",
+        "port": 1883,
+        "filters": ["codePower/#"],
+        "qos": 0
+    }
+]
+
+# Reconnect backoff in seconds: paho doubles the delay after each failed attempt, from min to max
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 120
+
+# How long the simulators wait for their first connection before giving up
+CONNECT_TIMEOUT = 10
+
+PROTOCOLS = {"3.1": mqtt.MQTTv31, "3.1.1": mqtt.MQTTv311, "5": mqtt.MQTTv5}
+
+def loadBrokerConfig(path=MQTT_CONFIG_PATH):
+    if not os.path.exists(path):
+        return DEFAULT_BROKERS
+    with open(path) as f:
+        return json.load(f)
+
+def expandConnections(brokers):
+    """(config, index) for every client connection the broker configs describe"""
+    return [(config, index) for config in brokers for index in range(config.get("connections", 1))]
 
 class MQTTClient:
-    def __init__(self):
-        self.client = mqtt.Client()
+    """One broker connection and its subscriptions.
+
+    A publishOnly client (the simulators') subscribes to nothing and has no
+    sink, so it never hands messages to the pipeline or the writer.
+    """
+
+    def __init__(self, config, index=0, sink=None, publishOnly=False):
+        self.name = config.get("name", config["host"])
+        self.host = config["host"]
+        self.port = config.get("port", 1883)
+        self.qos = config.get("qos", 0)
+        self.keepalive = config.get("keepalive", 60)
+        self.protocol = PROTOCOLS[str(config.get("protocol", "3.1.1"))]
+        self.sharedGroup = config.get("sharedGroup")
+
+        # Overlapping filters make the broker deliver the same message once per match
+        self.filters = dedupeFilters([validateFilter(topicFilter) for topicFilter in config.get("filters", ["#"])])
+        if publishOnly:
+            self.filters = []
+        elif self.sharedGroup:
+            self.filters = [f"$share/{self.sharedGroup}/{topicFilter}" for topicFilter in self.filters]
+
+        clientId = config.get("clientId") or f"mqttHistorian-{self.name}-{os.getpid()}"
+        if config.get("connections", 1) > 1:
+            clientId = f"{clientId}-{index}"
+        if publishOnly:
+            # A broker drops the older of two sessions with one client id: never take the historian's
+            clientId = f"{clientId}-publisher"
+        self.clientId = clientId
+
+        self.client = mqtt.Client(client_id=clientId, protocol=self.protocol)
+        if config.get("username"):
+            self.client.username_pw_set(config["username"], config.get("password"))
+        if config.get("tls"):
+            self.client.tls_set()
         self.client.on_connect = self.onConnect
-        self.client.on_message = self.onMessage
+        self.client.on_connect_fail = self.onConnectFail
+        self.client.on_disconnect = self.onDisconnect
+        self.client.reconnect_delay_set(RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
+        if not publishOnly:
+            self.client.on_message = self.onMessage
+        # Where received messages go: the in-process pipeline unless an ingest worker supplies its own
+        self.sink = None if publishOnly else sink or pipeline.submit
         self.connected = False
+        self.connectedEvent = threading.Event()
+        self.state = "idle"
+        self.connectFailures = 0
+        self.lastError = None
         self.messageCount = 0
 
-    def onConnect(self, client, userdata, flags, rc):
+    def onConnect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             self.connected = True
-            print("Connected to MQTT Broker")
-            topics = [
-                "codePower/#",
-                "codePower/sensors/#",
-                "codePower/test/#",
-                "codePower/iot/#"
-            ]
-            for topic in topics:
-                client.subscribe(topic)
-                print(f"Subscribed to: {topic}")
+            self.connectedEvent.set()
+            self.state = "connected"
+            self.connectFailures = 0
+            print(f"Connected to MQTT Broker {self.host}:{self.port} as {self.clientId}")
+            # Subscriptions are renewed on every reconnect
+            if self.filters:
+                client.subscribe([(topicFilter, self.qos) for topicFilter in self.filters])
+                print(f"Subscribed to: {', '.join(self.filters)}")
         else:
-            print(f"Failed to connect, return code {rc}")
+            self.connectFailures += 1
+            self.lastError = f"connection refused, return code {rc}"
+            print(f"Failed to connect to {self.host}:{self.port}, return code {rc}")
+
+    def onConnectFail(self, client, userdata):
+        # The network thread keeps retrying with backoff; only the first failure in a row is printed
+        self.connectFailures += 1
+        self.state = "reconnecting"
+        self.lastError = f"could not reach {self.host}:{self.port}"
+        if self.connectFailures == 1:
+            print(f"Connection to {self.host}:{self.port} failed; retrying every {RECONNECT_MIN_DELAY}-{RECONNECT_MAX_DELAY}s")
+
+    def onDisconnect(self, client, userdata, rc, properties=None):
+        self.connected = False
+        self.connectedEvent.clear()
+        if self.state != "stopped":
+            self.state = "reconnecting"
+            if rc != 0:
+                self.lastError = f"connection lost, return code {rc}"
 
     def onMessage(self, client, userdata, msg):
+        # Runs on the paho network thread: only hand the raw message on
         try:
             self.messageCount += 1
-            payload = msg.payload.decode('utf-8')
-            
-            parsedData = MessageParser.extractSensorData(
-                topic=msg.topic,
-                payload=payload,
-                qos=msg.qos,
-                retain=msg.retain
-            )
-            
-            messageId = saveMessage(
-                topic=msg.topic, 
-                payload=payload,
-                qos=msg.qos,
-                retained=msg.retain
-            )
-
-            websocket_message = {
-                "type": "new_message",
-                "messageId": messageId,
-                "topic": msg.topic,
-                "payload": payload,
-                "parsedData": parsedData,
-                "timestamp": datetime.now().isoformat()
-            }
-
-            addMessageToQueue(websocket_message)
-            
-            sensorInfo = parsedData['sensorInfo']
-            if sensorInfo['isSensorData'] and sensorInfo['numericValues']:
-                values = sensorInfo['numericValues']
-                print(f"Message [{messageId}] {msg.topic} -> {values}")
-            elif parsedData['format'] == 'json':
-                print(f"Message [{messageId}] {msg.topic} -> JSON data")
-            else:
-                preview = payload[:40] + "..." if len(payload) > 40 else payload
-                print(f"Message [{messageId}] {msg.topic} -> {preview}")
-                
+            self.sink(msg.topic, msg.payload, msg.qos, msg.retain)
         except Exception as e:
-            print(f"Error processing message: {e}")
+            print(f"Error queueing message: {e}")
 
     def connect(self):
+        """Start connecting without waiting: the network thread connects, and reconnects with
+        exponential backoff, until disconnect(). False only if the configuration is unusable."""
         try:
-            print("Connecting to MQTT broker")
-            self.client.connect("test.mosquitto.org", 1883, 60)
+            print(f"Connecting to MQTT broker {self.host}:{self.port}")
+            self.state = "connecting"
+            self.client.connect_async(self.host, self.port, self.keepalive)
             self.client.loop_start()
             return True
         except Exception as e:
-            print(f"Connection failed: {e}")
+            self.state = "failed"
+            self.lastError = str(e)
+            print(f"Connection to {self.host}:{self.port} failed: {e}")
             return False
             
+    def waitConnected(self, timeout=CONNECT_TIMEOUT):
+        """Block until the connection is up; False if it is not within timeout seconds"""
+        return self.connectedEvent.wait(timeout)
+
     def disconnect(self):
+        self.state = "stopped"
         self.client.loop_stop()
         self.client.disconnect()
-        print("MQTT client disconnected")
+        print(f"MQTT client {self.clientId} disconnected")
 
     def publishMessage(self, topic, message):
         if self.connected:
             result = self.client.publish(topic, message)
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                print(f"Published to {topic}: {message}")
+                PUBLISHED.inc(labels=('ok',))
                 return True
             else:
+                PUBLISHED.inc(labels=('failed',))
                 print(f"Failed to publish to {topic}")
                 return False
         else:
             print("Not connected to MQTT broker")
             return False
 
-mqttClient = MQTTClient()
+    def getStats(self):
+        return {
+            "name": self.name,
+            "broker": f"{self.host}:{self.port}",
+            "clientId": self.clientId,
+            "connected": self.connected,
+            "state": self.state,
+            "connectFailures": self.connectFailures,
+            "lastError": self.lastError,
+            "filters": self.filters,
+            "messages": self.messageCount
+        }
+
+class MQTTClientPool:
+    """Every configured broker connection; a shared subscription expands to several clients"""
+
+    def __init__(self, brokers, sink=None, publishOnly=False):
+        if publishOnly:
+            # One connection per broker is enough to publish
+            connections = [(config, 0) for config in brokers]
+        else:
+            connections = expandConnections(brokers)
+        self.clients = [MQTTClient(config, index, sink, publishOnly) for config, index in connections]
+
+    @property
+    def connected(self):
+        return any(client.connected for client in self.clients)
+
+    def connect(self):
+        # Received messages go to the pipeline, which startup.StartupJob starts before connecting
+        results = [client.connect() for client in self.clients]
+        return any(results)
+
+    def waitConnected(self, timeout=CONNECT_TIMEOUT):
+        """Block until any connection is up; False if none is within timeout seconds"""
+        deadline = time.monotonic() + timeout
+        while not self.connected:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # Any client may connect first, so poll them all rather than wait on one
+            time.sleep(min(0.05, remaining))
+        return True
+
+    def disconnect(self):
+        for client in self.clients:
+            client.disconnect()
+
+    def publishMessage(self, topic, message):
+        for client in self.clients:
+            if client.connected:
+                return client.publishMessage(topic, message)
+        print("Not connected to MQTT broker")
+        return False
+
+    def getStats(self):
+        return [client.getStats() for client in self.clients]
+
+mqttClients = MQTTClientPool(loadBrokerConfig())
+
+PUBLISHED = counter('historian_mqtt_published_total', 'Messages published through the API', ('result',))
+callbackCounter('historian_mqtt_received_total', 'Messages received per broker connection',
+                lambda: {(client.clientId,): client.messageCount for client in mqttClients.clients}, ('client',))
+gauge('historian_mqtt_connected', 'Whether each broker connection is up',
+      lambda: {(client.clientId,): int(client.connected) for client in mqttClients.clients}, ('client',))
+
+def createPublisher(brokers=None):
+    """Publish-only connections to the configured brokers, for the simulators: nothing they
+    send is received back or stored by the process that publishes it"""
+    return MQTTClientPool(brokers or loadBrokerConfig(), publishOnly=True)
 
 def startMqttClient():
-    return mqttClient.connect()
+    return mqttClients.connect()
 
 def stopMqttClient():
-    mqttClient.disconnect()
+    mqttClients.disconnect()
 
 def publishMessage(topic, message):
-    mqttClient.publishMessage(topic, message)
\ No newline at end of file
+    return mqttClients.publishMessage(topic, message)
+
+def getMqttStats():
+    return mqttClients.getStats()
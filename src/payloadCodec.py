@@ -0,0 +1,302 @@
+import sqlite3
+import struct
+import threading
+import zlib
+from datetime import datetime
+from metrics import callbackCounter
+
+# Optional: without zstandard, compressed storage uses zlib with a preset dictionary
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 'zstd', 'zlib' or None to store payloads as plain text (main.py --compress-payloads)
+PAYLOAD_COMPRESSION = None
+
+# Payloads of one topic family collected before its dictionary is trained, the
+# dictionary size, and the most dictionaries kept (families past that are
+# compressed without one)
+TRAINING_SAMPLES = 1000
+ZSTD_DICTIONARY_SIZE = 16384
+ZLIB_DICTIONARY_SIZE = 4096
+MAX_DICTIONARIES = 1024
+
+# Shorter payloads are stored as text; they would not get smaller
+MIN_COMPRESS_BYTES = 32
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+# Raw deflate with a window just big enough for the dictionary: the compressor
+# is copied per payload, and a 32 KB window makes that copy ten times slower
+ZLIB_WBITS = -12
+ZLIB_MEM_LEVEL = 2
+
+CODECS = {'zstd': 1, 'zlib': 2}
+
+# Compressed payloads are BLOBs starting with (codec, dictionary id); id 0 is no dictionary
+HEADER = struct.Struct('<BH')
+NO_DICTIONARY = 0
+
+def topicFamily(topic):
+    """Topics that differ only in levels holding a number (device ids, indexes) share a family:
+    codePower/sensor01/temperature and codePower/sensor02/temperature -> codePower/+/temperature"""
+    return '/'.join('+' if any(c.isdigit() for c in level) else level for level in topic.split('/'))
+
+def buildZlibDictionary(samples):
+    """Distinct samples concatenated, newest last: deflate finds the closest matches cheapest"""
+    dictionary = b''
+    for sample in reversed(list(dict.fromkeys(samples))):
+        if len(dictionary) + len(sample) > ZLIB_DICTIONARY_SIZE:
+            break
+        dictionary = sample + dictionary
+    return dictionary
+
+class PayloadCodec:
+    """Compresses message payloads for storage with dictionaries trained per topic family.
+
+    Payloads of one family share their keys and most of their structure, so
+    a dictionary built from the family's first TRAINING_SAMPLES payloads
+    lets each one compress on its own, which generic compression of a
+    ~200 byte document cannot. Dictionaries are stored in the
+    payloadDictionaries table; the writer thread trains them and commits
+    each one in the same transaction as the first rows that use it.
+    Readers decode with decode(), which leaves text rows (written with
+    compression off) untouched.
+    """
+
+    def __init__(self, compression=PAYLOAD_COMPRESSION):
+        self.compression = None
+        self.dictionaries = {}
+        self.families = {}
+        self.familyNames = {}
+        self.samples = {}
+        self.unsaved = []
+        self.compressors = {}
+        self.nextId = 1
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        self.encodedRows = 0
+        self.compressedRows = 0
+        self.rawBytes = 0
+        self.storedBytes = 0
+        # Counts of the batch being written, added to the totals once it commits,
+        # so a batch that is retried or split is counted once
+        self.pending = dict.fromkeys(('encodedRows', 'compressedRows', 'rawBytes', 'storedBytes'), 0)
+        self.setCompression(compression)
+
+    @property
+    def enabled(self):
+        return self.compression is not None
+
+    def setCompression(self, compression):
+        if compression not in (None, *CODECS):
+            raise ValueError(f"Unsupported payload compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            print("zstandard is not installed; compressing payloads with zlib")
+            compression = 'zlib'
+        self.compression = compression
+        self.compressors = {}
+
+    def load(self, conn):
+        """Read the stored dictionaries; families keep using the newest one whose codec is available"""
+        try:
+            rows = conn.execute('SELECT id, family, codec, dictionary FROM payloadDictionaries ORDER BY id').fetchall()
+        except sqlite3.OperationalError:
+            # Table not created yet (initDatabase not run)
+            return
+        with self.lock:
+            for dictId, family, codec, dictionary in rows:
+                self.dictionaries[dictId] = (CODECS[codec], dictionary)
+                if codec == 'zlib' or zstandard is not None:
+                    self.families[family] = dictId
+            self.nextId = max([self.nextId] + [dictId + 1 for dictId in self.dictionaries])
+
+    def familyOf(self, topic):
+        family = self.familyNames.get(topic)
+        if family is None:
+            family = self.familyNames[topic] = topicFamily(topic)
+        return family
+
+    def encode(self, topic, payload):
+        """Value to store for payload: compressed BLOB, or the text itself when that is not smaller.
+        Writer thread only."""
+        data = payload.encode('utf-8')
+        pending = self.pending
+        pending['encodedRows'] += 1
+        pending['rawBytes'] += len(data)
+        if len(data) < MIN_COMPRESS_BYTES:
+            pending['storedBytes'] += len(data)
+            return payload
+
+        family = self.familyOf(topic)
+        dictId = self.families.get(family)
+        if dictId is None:
+            dictId = self.collect(family, data)
+        codecId = self.dictionaries[dictId][0] if dictId else CODECS[self.compression]
+        stored = HEADER.pack(codecId, dictId) + self.compressor(codecId, dictId)(data)
+        if len(stored) >= len(data):
+            pending['storedBytes'] += len(data)
+            return payload
+        pending['compressedRows'] += 1
+        pending['storedBytes'] += len(stored)
+        return stored
+
+    def collect(self, family, data):
+        """Keep data as a training sample; returns the family's new dictionary id once trained, else 0"""
+        samples = self.samples.get(family)
+        if samples is None:
+            if len(self.families) + len(self.samples) >= MAX_DICTIONARIES:
+                return NO_DICTIONARY
+            samples = self.samples[family] = []
+        samples.append(data)
+        if len(samples) < TRAINING_SAMPLES:
+            return NO_DICTIONARY
+        del self.samples[family]
+        return self.train(family, samples)
+
+    def train(self, family, samples):
+        if self.compression == 'zstd':
+            try:
+                dictionary = zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, samples).as_bytes()
+            except zstandard.ZstdError as e:
+                print(f"Could not train a payload dictionary for {family}: {e}")
+                dictionary = None
+        else:
+            dictionary = buildZlibDictionary(samples)
+        if not dictionary or self.nextId > 0xFFFF:
+            self.families[family] = NO_DICTIONARY
+            return NO_DICTIONARY
+
+        with self.lock:
+            dictId = self.nextId
+            self.nextId += 1
+            self.dictionaries[dictId] = (CODECS[self.compression], dictionary)
+        self.families[family] = dictId
+        self.unsaved.append((dictId, family, self.compression, datetime.utcnow().isoformat(' ', 'milliseconds'), dictionary))
+        return dictId
+
+    def compressor(self, codecId, dictId):
+        compress = self.compressors.get(dictId)
+        if compress is not None:
+            return compress
+        dictionary = self.dictionaries[dictId][1] if dictId else None
+        if codecId == CODECS['zstd']:
+            # Frames without the magic number, dictionary id or checksum: the row header identifies them
+            parameters = zstandard.ZstdCompressionParameters.from_level(
+                ZSTD_LEVEL, format=zstandard.FORMAT_ZSTD1_MAGICLESS, write_dict_id=False, write_checksum=False
+            )
+            compressor = zstandard.ZstdCompressor(
+                compression_params=parameters,
+                dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            )
+            compress = compressor.compress
+        else:
+            # Priming a compressor with the dictionary once and copying it per payload
+            # is cheaper than setting the dictionary on a new one every time
+            if dictionary:
+                primed = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, ZLIB_WBITS, ZLIB_MEM_LEVEL, zdict=dictionary)
+            else:
+                primed = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, ZLIB_WBITS, ZLIB_MEM_LEVEL)
+
+            def compress(data):
+                compressor = primed.copy()
+                return compressor.compress(data) + compressor.flush()
+        self.compressors[dictId] = compress
+        return compress
+
+    def saveDictionaries(self, conn):
+        """Insert dictionaries trained since the last commit; call inside the batch transaction"""
+        if self.unsaved:
+            conn.executemany('''
+                INSERT OR REPLACE INTO payloadDictionaries (id, family, codec, createdAt, dictionary)
+                VALUES (?, ?, ?, ?, ?)
+            ''', self.unsaved)
+        return len(self.unsaved)
+
+    def beginBatch(self):
+        """Start counting a batch; the counts of one that did not commit are dropped"""
+        for field in self.pending:
+            self.pending[field] = 0
+
+    def markSaved(self, count):
+        """The batch transaction committed: its dictionaries are stored and its rows counted"""
+        del self.unsaved[:count]
+        pending = self.pending
+        self.encodedRows += pending['encodedRows']
+        self.compressedRows += pending['compressedRows']
+        self.rawBytes += pending['rawBytes']
+        self.storedBytes += pending['storedBytes']
+        self.beginBatch()
+
+    def dictionary(self, dictId, cursor=None):
+        entry = self.dictionaries.get(dictId)
+        if entry is None and cursor is not None:
+            # Trained by another process since this one loaded
+            cursor.execute('SELECT codec, dictionary FROM payloadDictionaries WHERE id = ?', (dictId,))
+            row = cursor.fetchone()
+            if row:
+                entry = (CODECS[row[0]], row[1])
+                with self.lock:
+                    self.dictionaries[dictId] = entry
+        if entry is None:
+            raise ValueError(f"Unknown payload dictionary: {dictId}")
+        return entry[1]
+
+    def decode(self, value, cursor=None):
+        """Payload text of a stored value; cursor is used to fetch dictionaries not loaded yet"""
+        if not isinstance(value, bytes):
+            return value
+        codecId, dictId = HEADER.unpack_from(value)
+        body = value[HEADER.size:]
+        if codecId == CODECS['zstd']:
+            return self.zstdDecompressor(dictId, cursor).decompress(body).decode('utf-8')
+        dictionary = self.dictionary(dictId, cursor) if dictId else None
+        decompressor = zlib.decompressobj(ZLIB_WBITS, zdict=dictionary) if dictionary else zlib.decompressobj(ZLIB_WBITS)
+        return (decompressor.decompress(body) + decompressor.flush()).decode('utf-8')
+
+    def zstdDecompressor(self, dictId, cursor):
+        # Decompressors are not thread-safe; readers each keep their own
+        decompressors = getattr(self.local, 'decompressors', None)
+        if decompressors is None:
+            decompressors = self.local.decompressors = {}
+        decompressor = decompressors.get(dictId)
+        if decompressor is None:
+            if zstandard is None:
+                raise RuntimeError("zstandard is not installed; cannot read zstd-compressed payloads")
+            dictionary = self.dictionary(dictId, cursor) if dictId else None
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None,
+                format=zstandard.FORMAT_ZSTD1_MAGICLESS
+            )
+            decompressors[dictId] = decompressor
+        return decompressor
+
+    def getStats(self):
+        return {
+            "compression": self.compression,
+            "dictionaries": len(self.dictionaries),
+            "familiesTraining": len(self.samples),
+            "encodedRows": self.encodedRows,
+            "compressedRows": self.compressedRows,
+            "rawBytes": self.rawBytes,
+            "storedBytes": self.storedBytes,
+            "ratio": round(self.rawBytes / self.storedBytes, 2) if self.storedBytes else None
+        }
+
+# Global instance
+payloadCodec = PayloadCodec()
+
+callbackCounter('historian_payload_bytes_total', 'Payload bytes before and after storage compression',
+                lambda: {('raw',): payloadCodec.rawBytes, ('stored',): payloadCodec.storedBytes}
+                if payloadCodec.encodedRows else None, ('form',))
+
+def setPayloadCompression(compression):
+    payloadCodec.setCompression(compression)
+
+def decodeStoredPayload(value, cursor=None):
+    return payloadCodec.decode(value, cursor)
+
+def getPayloadCodecStats():
+    return payloadCodec.getStats()
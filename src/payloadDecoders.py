@@ -0,0 +1,243 @@
+import json
+import struct
+import threading
+from topicMatcher import TopicTrie
+
+# orjson decodes several times faster than the standard library; use it when installed
+try:
+    import orjson
+    loadJson = orjson.loads
+except ImportError:
+    loadJson = json.loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Decoders for topics whose format is known up front, e.g.
+#   {'plant/+/vibration': StructDecoder('<fffI', ['x', 'y', 'z', 'sequence'])}
+# Topics not covered here are detected from their first message.
+TOPIC_DECODERS = {}
+
+# Distinct topics whose detected decoder is remembered
+DECODER_CACHE_SIZE = 10000
+
+# Values that json.dumps writes as they are
+JSON_SCALARS = (str, int, float, bool, type(None))
+
+def plainValue(value):
+    """A decoded value with only JSON types in it, so it can be sent on as JSON: byte strings
+    become hex (as in payloadText), and other types (dates, tags, extension types) their str()"""
+    valueType = type(value)
+    if valueType is dict:
+        return {
+            key if isinstance(key, JSON_SCALARS) else key.hex() if isinstance(key, bytes) else str(key): plainValue(item)
+            for key, item in value.items()
+        }
+    if valueType is list or valueType is tuple:
+        return [plainValue(item) for item in value]
+    if isinstance(value, JSON_SCALARS):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+class PayloadDecoder:
+    """Turns raw payload bytes into typed values; decode() raises ValueError if the payload is not in its format"""
+
+    name = None
+
+    def decode(self, payload):
+        raise NotImplementedError
+
+class JsonDecoder(PayloadDecoder):
+    name = 'json'
+
+    def decode(self, payload):
+        # Both backends take bytes directly, so there is no separate UTF-8 decode
+        return loadJson(payload)
+
+class TextDecoder(PayloadDecoder):
+    name = 'text'
+
+    def decode(self, payload):
+        text = payload.decode('utf-8')
+        if not text.isprintable() and not all(char.isprintable() or char.isspace() for char in text):
+            raise ValueError("Payload is not printable text")
+        return text
+
+class MsgpackDecoder(PayloadDecoder):
+    name = 'msgpack'
+
+    def decode(self, payload):
+        try:
+            value = msgpack.unpackb(payload, raw=False)
+        except Exception as e:
+            raise ValueError(str(e))
+        # bin and ext values would break the JSON sent to WebSocket clients
+        return plainValue(value)
+
+class CborDecoder(PayloadDecoder):
+    name = 'cbor'
+
+    def decode(self, payload):
+        try:
+            value = cbor2.loads(payload)
+        except Exception as e:
+            raise ValueError(str(e))
+        # Byte strings, tags and dates would break the JSON sent to WebSocket clients
+        return plainValue(value)
+
+class BinaryDecoder(PayloadDecoder):
+    """Last resort: keeps the bytes as they are"""
+
+    name = 'binary'
+
+    def decode(self, payload):
+        return payload
+
+class StructDecoder(PayloadDecoder):
+    """Fixed binary layout, e.g. StructDecoder('<fH', ['value', 'battery']).
+
+    Several records may be packed back to back; each becomes one dict.
+    """
+
+    name = 'struct'
+
+    def __init__(self, layout, fields):
+        self.layout = struct.Struct(layout)
+        self.fields = tuple(fields)
+        if len(self.fields) != len(self.layout.unpack(bytes(self.layout.size))):
+            raise ValueError(f"{layout} does not have {len(self.fields)} fields")
+
+    def decode(self, payload):
+        if not payload or len(payload) % self.layout.size:
+            raise ValueError(f"Payload length {len(payload)} is not a multiple of {self.layout.size}")
+        # 's' and 'p' fields unpack to bytes
+        records = [plainValue(dict(zip(self.fields, values))) for values in self.layout.iter_unpack(payload)]
+        return records[0] if len(records) == 1 else records
+
+# Tried in order for topics without a configured decoder. Text comes before the
+# binary formats because msgpack accepts most short ASCII strings as integers.
+DETECTION_ORDER = [JsonDecoder(), TextDecoder()]
+if msgpack is not None:
+    DETECTION_ORDER.append(MsgpackDecoder())
+if cbor2 is not None:
+    DETECTION_ORDER.append(CborDecoder())
+DETECTION_ORDER.append(BinaryDecoder())
+
+# Fallbacks that accept nearly anything are not remembered, so a topic that
+# later switches to a structured format is detected again
+UNCACHED_DECODERS = ('text', 'binary')
+
+class DecoderRegistry:
+    """Chooses the decoder for each topic.
+
+    Configured decoders are looked up by topic filter; the most specific
+    matching filter wins. Other topics are tried against DETECTION_ORDER once,
+    and the decoder that worked is reused for later messages on that topic,
+    falling back to detection only if it stops working.
+    """
+
+    def __init__(self, decoders=None):
+        self.filters = TopicTrie()
+        self.learned = {}
+        self.lock = threading.Lock()
+        self.detections = 0
+        self.failures = 0
+        for topicFilter, decoder in (decoders or {}).items():
+            self.register(topicFilter, decoder)
+
+    def register(self, topicFilter, decoder):
+        with self.lock:
+            self.filters.add(topicFilter, (topicFilter, decoder))
+            self.learned.clear()
+
+    def configuredDecoder(self, topic):
+        matches = self.filters.match(topic)
+        if not matches:
+            return None
+        # Fewer wildcards means more specific; a longer filter breaks ties
+        topicFilter, decoder = max(matches, key=lambda match: (
+            -match[0].count('+') - match[0].count('#') * 2, len(match[0])
+        ))
+        return decoder
+
+    def decode(self, topic, payload):
+        """(format name, decoded value) for a payload"""
+        decoder = self.learned.get(topic)
+        if decoder is None:
+            decoder = self.configuredDecoder(topic)
+            if decoder is None:
+                return self.detect(topic, payload)
+            self.remember(topic, decoder)
+
+        if decoder not in DETECTION_ORDER:
+            # A configured decoder is authoritative: its errors are not retried
+            return decoder.name, decoder.decode(payload)
+
+        try:
+            return decoder.name, decoder.decode(payload)
+        except ValueError:
+            # The topic changed format; detect it again
+            self.failures += 1
+            self.learned.pop(topic, None)
+            return self.detect(topic, payload)
+
+    def detect(self, topic, payload):
+        self.detections += 1
+        for decoder in DETECTION_ORDER:
+            try:
+                value = decoder.decode(payload)
+            except ValueError:
+                continue
+            if decoder.name not in UNCACHED_DECODERS:
+                self.remember(topic, decoder)
+            return decoder.name, value
+
+    def remember(self, topic, decoder):
+        if len(self.learned) >= DECODER_CACHE_SIZE:
+            self.learned.clear()
+        self.learned[topic] = decoder
+
+    def getStats(self):
+        formats = {}
+        for decoder in list(self.learned.values()):
+            formats[decoder.name] = formats.get(decoder.name, 0) + 1
+        return {
+            "configuredFilters": len(self.filters),
+            "learnedTopics": len(self.learned),
+            "learnedFormats": formats,
+            "detections": self.detections,
+            "failures": self.failures
+        }
+
+def payloadText(payload, format, value):
+    """Text form of a payload for storage and display"""
+    if isinstance(payload, str):
+        return payload
+    if format in ('json', 'text'):
+        return payload.decode('utf-8')
+    if format in ('binary', 'error'):
+        return payload.hex()
+    return json.dumps(value, default=lambda item: item.hex() if isinstance(item, bytes) else str(item))
+
+# Global instance
+decoderRegistry = DecoderRegistry(TOPIC_DECODERS)
+
+def registerDecoder(topicFilter, decoder):
+    decoderRegistry.register(topicFilter, decoder)
+
+def decodePayload(topic, payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return decoderRegistry.decode(topic, payload)
+
+def getDecoderStats():
+    return decoderRegistry.getStats()
@@ -0,0 +1,301 @@
+import calendar
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from database import (
+    DB_PATH, SENSOR_PARTITION_PREFIX, RETENTION_DAYS, writer, listPartitions,
+    partitionsInRange, dropExpiredPartitions, toDbTimestamp, utcTimestamp
+)
+
+# (name, bucket width in seconds, table, bucket of a stored timestamp)
+RESOLUTIONS = [
+    ('1m', 60, 'sensorRollup1m', lambda value: value[:16] + ':00'),
+    ('1h', 3600, 'sensorRollup1h', lambda value: value[:13] + ':00:00'),
+    ('1d', 86400, 'sensorRollup1d', lambda value: value[:10] + ' 00:00:00')
+]
+
+# How often the job runs, and how long a bucket must have been closed before readers
+# take it from the rollups, so readings still in the writer queue are not missed
+ROLLUP_INTERVAL = 60
+ROLLUP_LAG = 120
+
+# Raw rows folded per writer task, so ingest batches commit in between
+ROLLUP_BATCH_ROWS = 200000
+
+# Recorded in schemaMigrations once rollups built by timestamp watermark have been rebuilt by rowid
+ROLLUP_PROGRESS_MIGRATION = 'rollupProgress'
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def floorTimestamp(moment, seconds):
+    """Truncate a naive UTC datetime to a multiple of `seconds` since the epoch"""
+    epoch = calendar.timegm(moment.timetuple())
+    return datetime.utcfromtimestamp(epoch - epoch % seconds)
+
+def parseTimestamp(value):
+    return datetime.strptime(value[:19], TIMESTAMP_FORMAT)
+
+def ceilTimestamp(value, seconds):
+    """First bucket boundary of width `seconds` at or after a stored timestamp, in the bucket layout"""
+    moment = datetime.fromisoformat(value)
+    boundary = floorTimestamp(moment, seconds)
+    if boundary < moment:
+        boundary += timedelta(seconds=seconds)
+    return boundary.strftime(TIMESTAMP_FORMAT)
+
+def getWatermark(cursor, resolution):
+    cursor.execute('SELECT watermark FROM rollupState WHERE resolution = ?', (resolution,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def readRollupBatch(cursor, day, lastId):
+    """1m aggregates of up to ROLLUP_BATCH_ROWS rows of one partition after rowid lastId,
+    and the last rowid they cover (lastId when there is nothing new)"""
+    table = f'{SENSOR_PARTITION_PREFIX}{day}'
+    cursor.execute(f'SELECT MAX(id) FROM (SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?)', (lastId, ROLLUP_BATCH_ROWS))
+    endId = cursor.fetchone()[0]
+    if endId is None:
+        return [], lastId
+    # A rowid range is a primary key scan, however large the partition is
+    cursor.execute(f'''
+        SELECT deviceId, sensorType, substr(timestamp, 1, 16) || ':00', MIN(value), MAX(value), SUM(value), COUNT(*)
+        FROM {table}
+        WHERE id > ? AND id <= ? AND value IS NOT NULL
+        GROUP BY 1, 2, 3
+    ''', (lastId, endId))
+    return cursor.fetchall(), endId
+
+def mergeRollupRows(rows):
+    """{resolution: {(deviceId, sensorType, bucket): [min, max, sum, count]}} from 1m aggregate rows"""
+    merged = {}
+    for name, _, _, bucketOf in RESOLUTIONS:
+        buckets = merged[name] = {}
+        for deviceId, sensorType, minute, minValue, maxValue, sumValue, count in rows:
+            mergeBucket(buckets, (deviceId, sensorType, bucketOf(minute)), minValue, maxValue, sumValue, count)
+    return merged
+
+def applyRollups(conn, day, lastId, merged):
+    """Add one batch's aggregates to every rollup table and record the partition's progress in
+    the same transaction, so no row is counted twice. Runs on the writer thread via writer.call()."""
+    with conn:
+        for name, _, table, _ in RESOLUTIONS:
+            conn.executemany(f'''
+                INSERT INTO {table} (deviceId, sensorType, bucket, minValue, maxValue, sumValue, count)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(deviceId, sensorType, bucket) DO UPDATE SET
+                    minValue = min(minValue, excluded.minValue),
+                    maxValue = max(maxValue, excluded.maxValue),
+                    sumValue = sumValue + excluded.sumValue,
+                    count = count + excluded.count
+            ''', [(deviceId, sensorType, bucket, *values) for (deviceId, sensorType, bucket), values in merged[name].items()])
+        conn.execute('''
+            INSERT INTO rollupProgress (day, lastId) VALUES (?, ?)
+            ON CONFLICT(day) DO UPDATE SET lastId = excluded.lastId
+        ''', (day, lastId))
+
+def setWatermarks(conn, moment):
+    """Buckets before each watermark are closed and folded; readers take them from the rollups"""
+    with conn:
+        for name, seconds, _, _ in RESOLUTIONS:
+            conn.execute('''
+                INSERT INTO rollupState (resolution, watermark) VALUES (?, ?)
+                ON CONFLICT(resolution) DO UPDATE SET watermark = excluded.watermark
+            ''', (name, floorTimestamp(moment, seconds).strftime(TIMESTAMP_FORMAT)))
+
+def resetRollups(conn, firstDay):
+    """Drop the rollups of the days that still have raw partitions, so they are rebuilt by rowid.
+
+    Earlier versions folded rows by timestamp watermark, which left late readings out and
+    cannot be resumed by rowid. Buckets before the oldest partition are kept as they are.
+    """
+    start = datetime.strptime(firstDay, '%Y%m%d').strftime(TIMESTAMP_FORMAT)
+    with conn:
+        for name, _, table, _ in RESOLUTIONS:
+            conn.execute(f'DELETE FROM {table} WHERE bucket >= ?', (start,))
+            conn.execute('UPDATE rollupState SET watermark = min(watermark, ?) WHERE resolution = ?', (start, name))
+        conn.execute('DELETE FROM rollupProgress')
+        conn.execute(
+            'INSERT OR REPLACE INTO schemaMigrations (name, appliedAt) VALUES (?, ?)',
+            (ROLLUP_PROGRESS_MIGRATION, utcTimestamp())
+        )
+
+def buildRollups():
+    """Fold the sensor rows committed since the previous run into every rollup resolution.
+
+    Progress is kept per partition by rowid, so a late or back-dated reading is folded
+    into its bucket whatever its timestamp. The aggregates are read on a connection of
+    their own; only adding them runs on the writer thread, one batch of
+    ROLLUP_BATCH_ROWS rows per task. Returns the number of rows read.
+    """
+    moment = datetime.utcfromtimestamp(time.time() - ROLLUP_LAG)
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+        days = listPartitions(cursor, SENSOR_PARTITION_PREFIX)
+        if not days:
+            return 0
+        cursor.execute('SELECT 1 FROM schemaMigrations WHERE name = ?', (ROLLUP_PROGRESS_MIGRATION,))
+        if cursor.fetchone() is None:
+            writer.call(lambda writeConn: resetRollups(writeConn, days[0])).result()
+
+        cursor.execute('SELECT day, lastId FROM rollupProgress')
+        progress = dict(cursor.fetchall())
+        read = 0
+        for day in days:
+            lastId = progress.get(day, 0)
+            while True:
+                rows, endId = readRollupBatch(cursor, day, lastId)
+                if endId == lastId:
+                    break
+                merged = mergeRollupRows(rows)
+                writer.call(lambda writeConn, day=day, endId=endId, merged=merged: applyRollups(writeConn, day, endId, merged)).result()
+                read += endId - lastId
+                lastId = endId
+        writer.call(lambda writeConn: setWatermarks(writeConn, moment)).result()
+        return read
+    finally:
+        conn.close()
+
+class RollupJob:
+    """Background thread that builds rollups and enforces retention every ROLLUP_INTERVAL"""
+
+    def __init__(self, interval=ROLLUP_INTERVAL, retentionDays=RETENTION_DAYS):
+        self.interval = interval
+        self.retentionDays = retentionDays
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.lastRun = None
+        self.lastError = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="rollupJob", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(5.0)
+            self.thread = None
+
+    def runOnce(self):
+        # Rollups first, so an expiring partition is summarised before it is dropped
+        buildRollups()
+        writer.call(lambda conn: dropExpiredPartitions(conn, self.retentionDays)).result()
+        self.lastRun = time.time()
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.runOnce()
+                self.lastError = None
+            except Exception as e:
+                self.lastError = str(e)
+                print(f"Rollup job failed: {e}")
+            self.stopEvent.wait(self.interval)
+
+# Global instance
+rollupJob = RollupJob()
+
+def startRollupJob():
+    rollupJob.start()
+
+def stopRollupJob():
+    rollupJob.stop()
+
+def chooseResolution(seconds):
+    """Coarsest rollup whose bucket width divides the requested resolution, or None for raw"""
+    chosen = None
+    for resolution in RESOLUTIONS:
+        if resolution[1] <= seconds and seconds % resolution[1] == 0:
+            chosen = resolution
+    return chosen
+
+def mergeBucket(buckets, key, minValue, maxValue, sumValue, count):
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = [minValue, maxValue, sumValue, count]
+    else:
+        bucket[0] = min(bucket[0], minValue)
+        bucket[1] = max(bucket[1], maxValue)
+        bucket[2] += sumValue
+        bucket[3] += count
+
+def getSensorSeries(deviceId, sensorType, start, end, resolution):
+    """min/max/avg/count per `resolution`-second bucket over [start, end).
+
+    Reads the coarsest rollup table that can represent the resolution, and falls
+    back to raw readings for the part of the range the rollups do not cover yet
+    (and for resolutions finer than a minute), aggregated in SQL so the range
+    is never cut short.
+    """
+    start = toDbTimestamp(start)
+    end = toDbTimestamp(end)
+    source = chooseResolution(resolution)
+    buckets = {}
+
+    def bucketKey(timestamp):
+        return floorTimestamp(parseTimestamp(timestamp), resolution).strftime(TIMESTAMP_FORMAT)
+
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    rawRanges = [(start, end)]
+    if source is not None:
+        name, seconds, table, _ = source
+        watermark = getWatermark(cursor, name)
+        # Only whole buckets come from the rollup; the partial ones at either end of the range are read raw
+        rollupStart = ceilTimestamp(start, seconds) if start else ''
+        rollupEnd = watermark
+        if watermark is not None and end is not None:
+            rollupEnd = min(watermark, floorTimestamp(datetime.fromisoformat(end), seconds).strftime(TIMESTAMP_FORMAT))
+        if rollupEnd is not None and rollupStart < rollupEnd:
+            cursor.execute(f'''
+                SELECT bucket, minValue, maxValue, sumValue, count
+                FROM {table}
+                WHERE deviceId = ? AND sensorType = ? AND bucket >= ? AND bucket < ?
+                ORDER BY bucket
+            ''', (deviceId, sensorType, rollupStart, rollupEnd))
+            for bucket, minValue, maxValue, sumValue, count in cursor.fetchall():
+                mergeBucket(buckets, bucketKey(bucket), minValue, maxValue, sumValue, count)
+            rawRanges = [(start, rollupStart), (rollupEnd, end)]
+
+    for rawStart, rawEnd in rawRanges:
+        if rawStart is not None and rawEnd is not None and rawStart >= rawEnd:
+            continue
+        for day in partitionsInRange(cursor, SENSOR_PARTITION_PREFIX, rawStart, rawEnd):
+            # Through the (deviceId, sensorType, timestamp, value) covering index
+            query = f'''
+                SELECT CAST(strftime('%s', timestamp) AS INTEGER) / ?, MIN(value), MAX(value), SUM(value), COUNT(*)
+                FROM {SENSOR_PARTITION_PREFIX}{day}
+                WHERE deviceId = ? AND sensorType = ? AND value IS NOT NULL
+            '''
+            params = [resolution, deviceId, sensorType]
+            if rawStart is not None:
+                query += ' AND timestamp >= ?'
+                params.append(rawStart)
+            if rawEnd is not None:
+                query += ' AND timestamp < ?'
+                params.append(rawEnd)
+            cursor.execute(query + ' GROUP BY 1', params)
+            for epochBucket, minValue, maxValue, sumValue, count in cursor.fetchall():
+                key = datetime.utcfromtimestamp(epochBucket * resolution).strftime(TIMESTAMP_FORMAT)
+                mergeBucket(buckets, key, minValue, maxValue, sumValue, count)
+    conn.close()
+
+    return {
+        "resolution": resolution,
+        "source": source[0] if source else "raw",
+        "buckets": [
+            {
+                "bucket": key,
+                "min": minValue,
+                "max": maxValue,
+                "avg": sumValue / count,
+                "count": count
+            }
+            for key, (minValue, maxValue, sumValue, count) in sorted(buckets.items())
+        ]
+    }
@@ -0,0 +1,498 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from database import toDbTimestamp, topicCatalog, writer
+from metrics import callbackCounter
+from topicMatcher import TopicTrie, validateFilter
+from websocketManager import messageStream
+
+# Rules are loaded from RULES_CONFIG_PATH, a JSON list, at startup; /api/rules changes are written back.
+# Per rule:
+#   name, filter, type              - unique name, MQTT topic filter, and one of RULE_TYPES
+#   field                           - reading type to watch (e.g. "temperature"); omitted watches every
+#                                     reading, and "value" the first number of a payload without readings
+#   above, below                    - threshold on the value, average or rate; either or both
+#   window                          - seconds of history for "average" and "rate" (rate is per second)
+#   timeout                         - seconds without a message before a topic counts as offline
+#   severity                        - copied to the alert; "warning" by default
+RULES_CONFIG_PATH = 'rules.json'
+
+# Offline checks run on a timing wheel of WHEEL_SLOTS slots, WHEEL_TICK seconds each;
+# alerts raised in between are written to systemAlerts once per tick
+WHEEL_TICK = 1.0
+WHEEL_SLOTS = 512
+
+# Series (rule, device, field) kept before the least recently updated is dropped,
+# samples kept per average/rate window, and topics whose matching rules are cached
+MAX_SERIES = 100000
+MAX_WINDOW_SAMPLES = 1000
+RULE_CACHE_SIZE = 10000
+
+def numberOption(config, key, default=None):
+    """config[key] as a float, or default if absent; ValueError unless it is a finite number"""
+    value = config.get(key, default)
+    if value is None:
+        return None
+    try:
+        if isinstance(value, bool):
+            raise TypeError
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Rule {config.get('name')}: {key} must be a number, not {value!r}") from None
+    if not math.isfinite(number):
+        raise ValueError(f"Rule {config.get('name')}: {key} must be finite")
+    return number
+
+class Rule:
+    """A condition on the readings of the topics matching filter"""
+
+    type = None
+    label = ''
+
+    def __init__(self, config):
+        try:
+            self.name = str(config['name'])
+            self.filter = validateFilter(config['filter'])
+        except KeyError as e:
+            raise ValueError(f"Rule is missing {e}") from None
+        self.field = config.get('field')
+        if self.field is not None and not isinstance(self.field, str):
+            raise ValueError(f"Rule {self.name}: field must be a string")
+        self.severity = str(config.get('severity', 'warning'))
+        # Converted here: a string threshold would fail the comparison on every message
+        self.above = numberOption(config, 'above')
+        self.below = numberOption(config, 'below')
+        self.config = dict(config, type=self.type)
+        # Saved to rules.json as the numbers they were converted to
+        for key in ('above', 'below'):
+            if getattr(self, key) is not None:
+                self.config[key] = getattr(self, key)
+        if self.above is None and self.below is None and self.type != 'offline':
+            raise ValueError(f"Rule {self.name} needs 'above' and/or 'below'")
+
+    def breached(self, value):
+        return (self.above is not None and value > self.above) or (self.below is not None and value < self.below)
+
+    def describe(self, field, value):
+        limit = f"above {self.above}" if self.above is not None and value > self.above else f"below {self.below}"
+        return f"{self.name}: {field}{self.label} {value:.4g} {limit}"
+
+    def metric(self, series, timestamp, value):
+        """Value the thresholds apply to after this sample, or None if there is none yet"""
+        return value
+
+class ThresholdRule(Rule):
+    type = 'threshold'
+
+class WindowRule(Rule):
+    def __init__(self, config):
+        super().__init__(config)
+        self.window = self.config['window'] = numberOption(config, 'window', 60)
+        if self.window <= 0:
+            raise ValueError(f"Rule {self.name} needs a positive window")
+
+    def slide(self, series, timestamp, value):
+        samples = series.samples
+        if samples is None:
+            samples = series.samples = deque()
+        samples.append((timestamp, value))
+        series.total += value
+        cutoff = timestamp - self.window
+        while samples[0][0] < cutoff or len(samples) > MAX_WINDOW_SAMPLES:
+            series.total -= samples.popleft()[1]
+        return samples
+
+class AverageRule(WindowRule):
+    type = 'average'
+    label = ' average'
+
+    def metric(self, series, timestamp, value):
+        samples = self.slide(series, timestamp, value)
+        return series.total / len(samples)
+
+class RateRule(WindowRule):
+    type = 'rate'
+    label = ' rate of change'
+
+    def metric(self, series, timestamp, value):
+        samples = self.slide(series, timestamp, value)
+        oldestTime, oldestValue = samples[0]
+        if timestamp <= oldestTime:
+            return None
+        return (value - oldestValue) / (timestamp - oldestTime)
+
+class OfflineRule(Rule):
+    type = 'offline'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.timeout = self.config['timeout'] = numberOption(config, 'timeout', 300)
+        if self.timeout <= 0:
+            raise ValueError(f"Rule {self.name} needs a positive timeout")
+
+RULE_TYPES = {cls.type: cls for cls in (ThresholdRule, AverageRule, RateRule, OfflineRule)}
+
+def buildRule(config):
+    if not isinstance(config, dict):
+        raise ValueError("A rule must be a JSON object")
+    ruleClass = RULE_TYPES.get(config.get('type', 'threshold'))
+    if ruleClass is None:
+        raise ValueError(f"Unknown rule type: {config.get('type')}")
+    return ruleClass(config)
+
+class SeriesState:
+    __slots__ = ('firing', 'samples', 'total')
+
+    def __init__(self):
+        self.firing = False
+        self.samples = None
+        self.total = 0.0
+
+class TimerWheel:
+    """Hashed timing wheel: scheduling is O(1), and each tick looks only at the
+    timers in its slot. Timers further out than one revolution stay in their
+    slot until the revolution in which they are due."""
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS, now=None):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.position = int((now or time.time()) / tick)
+        self.size = 0
+
+    def schedule(self, key, deadline):
+        # A deadline in a tick already passed goes in the next slot to be visited
+        position = max(int(deadline / self.tick), self.position)
+        slot = self.slots[position % len(self.slots)]
+        if key not in slot:
+            self.size += 1
+        slot[key] = deadline
+
+    def advance(self, now):
+        """Keys whose deadline is at or before now, removed from the wheel"""
+        due = []
+        target = int(now / self.tick)
+        if target < self.position:
+            return due
+        # After a long stall every slot is visited once, not once per missed tick
+        ticks = min(target - self.position + 1, len(self.slots))
+        for position in range(target - ticks + 1, target + 1):
+            slot = self.slots[position % len(self.slots)]
+            expired = [key for key, deadline in slot.items() if deadline <= now]
+            for key in expired:
+                del slot[key]
+            due.extend(expired)
+        self.size -= len(due)
+        self.position = target + 1
+        return due
+
+    def __len__(self):
+        return self.size
+
+def readingSamples(topic, readings, numbers):
+    """(device, field, value) samples of one message, as hotCache.sampleFields picks them"""
+    if readings:
+        return [(reading.get('deviceId') or topic, reading['sensorType'], reading['value']) for reading in readings
+                if isinstance(reading.get('value'), (int, float))]
+    if numbers:
+        return [(topic, 'value', numbers[0])]
+    return []
+
+def epochFromDb(timestamp):
+    return datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).timestamp()
+
+class RuleEngine:
+    """Evaluates alert rules against every ingested message.
+
+    Rules are indexed by topic filter in a TopicTrie, and each topic's
+    matching rules are cached, so a message costs one dict lookup plus work
+    for the rules that apply to it. Threshold, average and rate rules keep a
+    small state per (rule, device, field) and alert when the condition starts
+    and stops holding, not on every message. Offline rules only record when a
+    topic was last seen; a timing wheel, advanced once per WHEEL_TICK, checks
+    each topic when its timeout would run out. Alerts go to the WebSocket
+    stream at once and to the systemAlerts table in one write per tick.
+    """
+
+    def __init__(self, configPath=RULES_CONFIG_PATH):
+        self.configPath = configPath
+        self.rules = {}
+        self.trie = TopicTrie()
+        self.matchCache = {}
+        self.series = OrderedDict()
+        self.lastSeen = {}
+        self.scheduled = set()
+        self.offline = set()
+        self.wheel = TimerWheel()
+        self.pending = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopEvent = threading.Event()
+
+        self.evaluated = 0
+        self.alerts = 0
+        self.writtenAlerts = 0
+        self.lastError = None
+
+    def load(self):
+        if not os.path.exists(self.configPath):
+            return
+        with open(self.configPath) as f:
+            configs = json.load(f)
+        for config in configs:
+            try:
+                self.addRule(config, save=False)
+            except ValueError as e:
+                print(f"Skipping rule {config.get('name')}: {e}")
+
+    def save(self):
+        with open(self.configPath, 'w') as f:
+            json.dump([rule.config for rule in self.rules.values()], f, indent=2)
+
+    def addRule(self, config, save=True):
+        """Add a rule, or replace the one with the same name"""
+        rule = buildRule(config)
+        with self.lock:
+            self.dropRule(rule.name)
+            self.rules[rule.name] = rule
+            self.trie.add(rule.filter, rule.name)
+            self.matchCache = {}
+            if isinstance(rule, OfflineRule):
+                self.seedLastSeen(rule)
+        if save:
+            self.save()
+        return rule
+
+    def removeRule(self, name):
+        with self.lock:
+            removed = self.dropRule(name)
+        if removed:
+            self.save()
+        return removed
+
+    def dropRule(self, name):
+        rule = self.rules.pop(name, None)
+        if rule is None:
+            return False
+        self.trie.remove(rule.filter, name)
+        self.matchCache = {}
+        for state in (self.series, self.lastSeen):
+            for key in [key for key in state if key[0] == name]:
+                del state[key]
+        self.offline = {key for key in self.offline if key[0] != name}
+        # Wheel entries of the rule are discarded when they come due
+        return True
+
+    def seedLastSeen(self, rule):
+        """Start offline tracking from the catalog, so topics that stay silent after a restart are still caught"""
+        now = time.time()
+        for entry in topicCatalog.getTopics():
+            topic = entry["topic"]
+            if entry["lastSeen"] and self.matches(rule, topic):
+                key = (rule.name, topic)
+                if key not in self.lastSeen:
+                    self.lastSeen[key] = epochFromDb(entry["lastSeen"])
+                    self.scheduleOffline(key, rule, now)
+
+    def matches(self, rule, topic):
+        return rule.name in self.trie.match(topic)
+
+    def rulesFor(self, topic):
+        rules = self.matchCache.get(topic)
+        if rules is None:
+            rules = tuple(self.rules[name] for name in sorted(self.trie.match(topic)))
+            if len(self.matchCache) >= RULE_CACHE_SIZE:
+                self.matchCache = {}
+            self.matchCache[topic] = rules
+        return rules
+
+    def evaluate(self, topic, receivedAt, readings=None, numbers=None):
+        """Apply the rules matching topic to one message; cost is proportional to those rules"""
+        if not self.rules or self.matchCache.get(topic) == ():
+            # Most topics match no rule; skip the lock for them
+            return
+        with self.lock:
+            rules = self.rulesFor(topic)
+            if not rules:
+                return
+            self.evaluated += 1
+            samples = None
+            for rule in rules:
+                if isinstance(rule, OfflineRule):
+                    self.markSeen(rule, topic, receivedAt)
+                    continue
+                if samples is None:
+                    samples = readingSamples(topic, readings, numbers)
+                for device, field, value in samples:
+                    if rule.field is None or rule.field == field:
+                        self.observe(rule, topic, device, field, value, receivedAt)
+
+    def observe(self, rule, topic, device, field, value, timestamp):
+        key = (rule.name, device, field)
+        state = self.series.get(key)
+        if state is None:
+            state = self.series[key] = SeriesState()
+            if len(self.series) > MAX_SERIES:
+                self.series.popitem(last=False)
+        else:
+            self.series.move_to_end(key)
+
+        metric = rule.metric(state, timestamp, value)
+        if metric is None:
+            return
+        breached = rule.breached(metric)
+        if breached != state.firing:
+            state.firing = breached
+            message = rule.describe(field, metric) if breached else f"{rule.name}: {field} back within limits"
+            self.raiseAlert(rule, 'firing' if breached else 'resolved', topic, device, field, metric, message, timestamp)
+
+    def markSeen(self, rule, topic, timestamp):
+        key = (rule.name, topic)
+        self.lastSeen[key] = timestamp
+        if key in self.offline:
+            self.offline.discard(key)
+            self.raiseAlert(rule, 'resolved', topic, topic, None, None, f"{rule.name}: {topic} is back online", timestamp)
+        if key not in self.scheduled:
+            self.scheduleOffline(key, rule, timestamp)
+
+    def scheduleOffline(self, key, rule, now):
+        self.scheduled.add(key)
+        self.wheel.schedule(key, max(self.lastSeen[key] + rule.timeout, now))
+
+    def checkOffline(self, now):
+        """Advance the wheel: topics whose timeout ran out go offline, the rest are rescheduled"""
+        with self.lock:
+            for key in self.wheel.advance(now):
+                rule = self.rules.get(key[0])
+                lastSeen = self.lastSeen.get(key)
+                if rule is None or lastSeen is None:
+                    self.scheduled.discard(key)
+                    continue
+                deadline = lastSeen + rule.timeout
+                if deadline > now:
+                    # Seen again since this check was scheduled
+                    self.wheel.schedule(key, deadline)
+                    continue
+                self.scheduled.discard(key)
+                self.offline.add(key)
+                topic = key[1]
+                self.raiseAlert(rule, 'firing', topic, topic, None, now - lastSeen,
+                                f"{rule.name}: no message from {topic} for {now - lastSeen:.0f} s", now)
+
+    def raiseAlert(self, rule, state, topic, device, field, value, message, timestamp):
+        alert = {
+            "type": "alert",
+            "rule": rule.name,
+            "ruleType": rule.type,
+            "severity": rule.severity,
+            "state": state,
+            "topic": topic,
+            "deviceId": device,
+            "field": field,
+            "value": value,
+            "message": message,
+            "timestamp": datetime.utcfromtimestamp(timestamp).isoformat()
+        }
+        self.pending.append(alert)
+        self.alerts += 1
+        messageStream.publish(alert)
+
+    def flushAlerts(self):
+        # Taken off pending only once written: a locked database or stopped writer keeps them for the next tick
+        with self.lock:
+            alerts = self.pending[:]
+        if not alerts:
+            return
+        rows = [
+            (toDbTimestamp(alert["timestamp"]), alert["rule"], alert["severity"], alert["state"], alert["topic"],
+             alert["deviceId"], alert["field"], alert["value"], alert["message"])
+            for alert in alerts
+        ]
+
+        def insert(conn):
+            with conn:
+                conn.executemany('''
+                    INSERT INTO systemAlerts (timestamp, rule, severity, state, topic, deviceId, field, value, message)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+        writer.call(insert).result()
+        with self.lock:
+            # Alerts raised meanwhile were appended after these
+            del self.pending[:len(alerts)]
+        self.writtenAlerts += len(rows)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="ruleEngine", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(5.0)
+            self.thread = None
+
+    def run(self):
+        while not self.stopEvent.wait(WHEEL_TICK):
+            try:
+                self.checkOffline(time.time())
+                self.flushAlerts()
+                self.lastError = None
+            except Exception as e:
+                self.lastError = str(e)
+                print(f"Rule engine failed: {e}")
+        try:
+            self.flushAlerts()
+        except Exception as e:
+            print(f"Could not write pending alerts: {e}")
+
+    def getRules(self):
+        with self.lock:
+            return [dict(rule.config) for rule in self.rules.values()]
+
+    def getStats(self):
+        return {
+            "rules": len(self.rules),
+            "series": len(self.series),
+            "trackedTopics": len(self.lastSeen),
+            "offline": len(self.offline),
+            "timers": len(self.wheel),
+            "evaluated": self.evaluated,
+            "alerts": self.alerts,
+            "writtenAlerts": self.writtenAlerts,
+            "pendingAlerts": len(self.pending),
+            "lastError": self.lastError
+        }
+
+# Global instance
+ruleEngine = RuleEngine()
+
+callbackCounter('historian_rule_evaluations_total', 'Messages that matched at least one alert rule', lambda: ruleEngine.evaluated)
+callbackCounter('historian_alerts_total', 'Alerts raised by the rule engine', lambda: ruleEngine.alerts)
+
+def evaluateRules(topic, receivedAt, readings=None, numbers=None):
+    ruleEngine.evaluate(topic, receivedAt, readings, numbers)
+
+def startRuleEngine():
+    ruleEngine.load()
+    ruleEngine.start()
+
+def stopRuleEngine():
+    ruleEngine.stop()
+
+def getRules():
+    return ruleEngine.getRules()
+
+def addRule(config):
+    return ruleEngine.addRule(config).config
+
+def removeRule(name):
+    return ruleEngine.removeRule(name)
+
+def getRuleEngineStats():
+    return ruleEngine.getStats()
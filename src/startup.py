@@ -0,0 +1,204 @@
+import sqlite3
+import threading
+import time
+import database
+from database import (
+    buildPartitionIndexes, initDatabase, normaliseTimestamps, partitionsMissingIndexes, runMigrations, startWriter,
+    stopWriter, tablesWithLegacyTimestamps, writer
+)
+from archiver import startArchiveJob, stopArchiveJob
+from hotCache import warmHotCache
+from ingestPipeline import startPipeline, stopPipeline
+from ingestWorkers import startIngestWorkers, stopIngestWorkers, ingestWorkersConnected
+from mqttClient import loadBrokerConfig, mqttClients, startMqttClient, stopMqttClient
+from rollups import startRollupJob, stopRollupJob
+from ruleEngine import startRuleEngine, stopRuleEngine
+
+# Subsystems that must be up before /ready reports ready; the others are
+# reported but do not hold it back (a broker outage should not take the API
+# out of a load balancer)
+REQUIRED_SUBSYSTEMS = ('database', 'migrations', 'writer')
+
+SUBSYSTEMS = ('database', 'migrations', 'writer', 'rules', 'ingest', 'jobs', 'hotCache', 'indexes', 'timestamps')
+
+class StartupJob:
+    """Brings the services up in a background thread so the API serves at once.
+
+    Only the schema is created before the API starts; everything that can
+    take time on a large database runs here, in order: legacy migrations
+    (one committed step each, so a restart resumes them), the writer, the
+    rules, ingest, the rollup and archive jobs, warming the hot cache from
+    the newest partition and building missing partition indexes on the
+    writer thread, then rewriting timestamps that earlier migrations left in
+    the legacy layout. Each subsystem's status is kept for /ready.
+    """
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.startedAt = None
+        self.subsystems = {name: {"status": "pending", "detail": None} for name in SUBSYSTEMS}
+
+    def mark(self, name, status, detail=None):
+        self.subsystems[name] = {"status": status, "detail": detail}
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.startedAt = time.time()
+        # Create the schema only, so readers never see a table missing; slow upgrade work is left to run()
+        try:
+            initDatabase(migrate=False)
+            self.mark('database', 'ready')
+        except sqlite3.Error as e:
+            self.mark('database', 'failed', str(e))
+            print(f"Database initialization failed: {e}")
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, name="startup", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def run(self):
+        steps = [
+            ('migrations', self.migrate),
+            ('writer', self.startWriter),
+            ('rules', self.startRules),
+            ('ingest', self.startIngest),
+            ('jobs', self.startJobs),
+            ('hotCache', self.warmCache),
+            ('indexes', self.buildIndexes),
+            ('timestamps', self.normaliseTimestamps)
+        ]
+        for name, step in steps:
+            if self.stopEvent.is_set():
+                return
+            self.mark(name, 'running')
+            try:
+                detail = step()
+                self.mark(name, 'ready', detail)
+            except Exception as e:
+                self.mark(name, 'failed', str(e))
+                print(f"Startup of {name} failed: {e}")
+                # Nothing can be stored without the migrated schema and the writer
+                if name in REQUIRED_SUBSYSTEMS:
+                    return
+        print(f"Startup finished in {time.time() - self.startedAt:.1f}s")
+
+    def migrate(self):
+        # The writer is not running yet, so migrations have the database to themselves
+        conn = sqlite3.connect(database.DB_PATH)
+        try:
+            steps = runMigrations(
+                conn, lambda description, done: self.mark('migrations', 'running', f"{description} (step {done})")
+            )
+        finally:
+            conn.close()
+        return f"{steps} steps" if steps else None
+
+    def startWriter(self):
+        startWriter()
+
+    def startRules(self):
+        startRuleEngine()
+
+    def startIngest(self):
+        if self.workers > 0:
+            # This process only stores and serves; receiving and parsing happen in the workers
+            startIngestWorkers(self.workers, loadBrokerConfig())
+            return f"{self.workers} worker processes"
+        startPipeline()
+        if not startMqttClient():
+            raise RuntimeError("no usable broker connection in the configuration")
+
+    def startJobs(self):
+        startRollupJob()
+        startArchiveJob()
+
+    def warmCache(self):
+        return f"{warmHotCache()} topics"
+
+    def buildIndexes(self):
+        conn = sqlite3.connect(database.DB_PATH)
+        try:
+            days = partitionsMissingIndexes(conn.cursor())
+        finally:
+            conn.close()
+        # One writer task per partition, so ingest batches commit in between
+        for done, day in enumerate(days):
+            if self.stopEvent.is_set():
+                return f"{done} of {len(days)} partitions"
+            self.mark('indexes', 'running', f"partition {day} ({done + 1} of {len(days)})")
+            writer.call(lambda conn, day=day: buildPartitionIndexes(conn, day)).result()
+        return f"{len(days)} partitions" if days else None
+
+    def normaliseTimestamps(self):
+        conn = sqlite3.connect(database.DB_PATH)
+        try:
+            tables = tablesWithLegacyTimestamps(conn.cursor())
+        finally:
+            conn.close()
+        # Same as indexes: one table per writer task
+        for done, table in enumerate(tables):
+            if self.stopEvent.is_set():
+                return f"{done} of {len(tables)} tables"
+            self.mark('timestamps', 'running', f"{table} ({done + 1} of {len(tables)})")
+            writer.call(lambda conn, table=table: normaliseTimestamps(conn, table)).result()
+        return f"{len(tables)} tables" if tables else None
+
+    def ingestStatus(self):
+        """Ingest is reported live: the broker can drop and come back long after startup"""
+        state = self.subsystems['ingest']
+        if state["status"] != 'ready':
+            return state
+        if self.workers > 0:
+            connected = ingestWorkersConnected()
+            return {"status": "ready" if connected else "connecting", "detail": state["detail"]}
+        clients = mqttClients.clients
+        up = sum(client.connected for client in clients)
+        errors = [f"{client.name}: {client.lastError}" for client in clients if not client.connected and client.lastError]
+        return {
+            "status": "ready" if up else "connecting",
+            "detail": f"{up} of {len(clients)} broker connections up" + (f"; {', '.join(errors)}" if errors else "")
+        }
+
+    def getReadiness(self):
+        subsystems = dict(self.subsystems)
+        subsystems['ingest'] = self.ingestStatus()
+        return {
+            "ready": all(subsystems[name]["status"] == 'ready' for name in REQUIRED_SUBSYSTEMS),
+            "uptime": round(time.time() - self.startedAt, 1) if self.startedAt else None,
+            "subsystems": subsystems
+        }
+
+# Global instance, created by startServices
+startupJob = None
+
+def startServices(workers=0):
+    global startupJob
+    startupJob = StartupJob(workers)
+    startupJob.start()
+    return startupJob
+
+def stopServices():
+    if startupJob is not None:
+        startupJob.stop()
+    # Stop taking messages, drain the pipeline into the writer, then commit what the writer still has queued
+    stopRollupJob()
+    stopArchiveJob()
+    stopMqttClient()
+    stopIngestWorkers()
+    stopPipeline()
+    stopRuleEngine()
+    stopWriter()
+
+def getReadiness():
+    if startupJob is None:
+        return {"ready": False, "uptime": None, "subsystems": {}}
+    return startupJob.getReadiness()
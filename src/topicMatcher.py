@@ -0,0 +1,144 @@
+def validateFilter(topicFilter):
+    """Raise ValueError unless topicFilter is a valid MQTT subscription filter"""
+    if not topicFilter:
+        raise ValueError("Topic filter must not be empty")
+    levels = topicFilter.split('/')
+    for i, level in enumerate(levels):
+        if '#' in level and (level != '#' or i != len(levels) - 1):
+            raise ValueError(f"'#' must be the last level on its own: {topicFilter}")
+        if '+' in level and level != '+':
+            raise ValueError(f"'+' must occupy a whole level: {topicFilter}")
+    return topicFilter
+
+def topicMatches(topicFilter, topic):
+    """True if an MQTT topic filter ('+' one level, '#' the rest) matches topic"""
+    filterLevels = topicFilter.split('/')
+    topicLevels = topic.split('/')
+
+    # Wildcards in the first level never match $SYS-style topics
+    if topic.startswith('$') and filterLevels[0] in ('+', '#'):
+        return False
+
+    for i, level in enumerate(filterLevels):
+        if level == '#':
+            return True
+        if i >= len(topicLevels):
+            return False
+        if level != '+' and level != topicLevels[i]:
+            return False
+    return len(filterLevels) == len(topicLevels)
+
+class TrieNode:
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = set()
+
+class TopicTrie:
+    """Maps MQTT topic filters to values and finds every value whose filter matches a topic.
+
+    Matching walks one path per topic level (plus the '+' and '#' branches), so
+    its cost depends on the topic depth and the number of wildcard branches, not
+    on how many filters are registered.
+    """
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.size = 0
+
+    def add(self, topicFilter, value):
+        node = self.root
+        for level in validateFilter(topicFilter).split('/'):
+            node = node.children.setdefault(level, TrieNode())
+        if value not in node.values:
+            node.values.add(value)
+            self.size += 1
+
+    def remove(self, topicFilter, value):
+        path = [self.root]
+        for level in topicFilter.split('/'):
+            child = path[-1].children.get(level)
+            if child is None:
+                return False
+            path.append(child)
+
+        node = path[-1]
+        if value not in node.values:
+            return False
+        node.values.discard(value)
+        self.size -= 1
+
+        # Prune branches that no longer lead to any filter
+        levels = topicFilter.split('/')
+        for depth in range(len(levels), 0, -1):
+            node = path[depth]
+            if node.values or node.children:
+                break
+            del path[depth - 1].children[levels[depth - 1]]
+        return True
+
+    def match(self, topic):
+        """Set of values registered under filters that match topic"""
+        matched = set()
+        levels = topic.split('/')
+        self.collect(self.root, levels, 0, matched, topic.startswith('$'))
+        return matched
+
+    def collect(self, node, levels, depth, matched, systemTopic):
+        wildcardsAllowed = not (systemTopic and depth == 0)
+
+        if wildcardsAllowed:
+            hashNode = node.children.get('#')
+            if hashNode is not None:
+                # '#' also matches the parent level itself: 'a/#' matches 'a'
+                matched.update(hashNode.values)
+
+        if depth == len(levels):
+            matched.update(node.values)
+            return
+
+        child = node.children.get(levels[depth])
+        if child is not None:
+            self.collect(child, levels, depth + 1, matched, systemTopic)
+        if wildcardsAllowed:
+            plusNode = node.children.get('+')
+            if plusNode is not None:
+                self.collect(plusNode, levels, depth + 1, matched, systemTopic)
+
+    def __len__(self):
+        return self.size
+
+def filterCovers(broader, narrower):
+    """True if every topic matched by filter `narrower` is also matched by `broader`"""
+    broadLevels = broader.split('/')
+    narrowLevels = narrower.split('/')
+
+    # A leading wildcard does not reach $-topics, so it cannot cover a filter that names one
+    if narrowLevels[0].startswith('$') and broadLevels[0] in ('+', '#'):
+        return False
+
+    for i, level in enumerate(broadLevels):
+        if level == '#':
+            return True
+        if i >= len(narrowLevels):
+            return False
+        narrowLevel = narrowLevels[i]
+        if narrowLevel == '#':
+            return False
+        if level != '+' and level != narrowLevel:
+            return False
+        if level != '+' and narrowLevel == '+':
+            return False
+    return len(broadLevels) == len(narrowLevels)
+
+def dedupeFilters(filters):
+    """Drop filters already covered by another one, so a broker never delivers a message twice.
+
+    Keeps the first of two identical filters and preserves order.
+    """
+    unique = list(dict.fromkeys(filters))
+    return [
+        topicFilter for topicFilter in unique
+        if not any(other != topicFilter and filterCovers(other, topicFilter) for other in unique)
+    ]
@@ -1,46 +1,458 @@
-from typing import List
+import asyncio
+import json
+import threading
+from collections import OrderedDict, deque, namedtuple
+from itertools import islice
+from typing import Dict
 from fastapi import WebSocket
+from metrics import counter, histogram, gauge, callbackCounter
+from topicMatcher import TopicTrie, validateFilter
+
+# Messages kept for subscribers to catch up on; older ones are overwritten
+MESSAGE_BUFFER_SIZE = 1000
+
+# Per-client delivery limits
+SEND_QUEUE_FRAMES = 8
+MAX_BATCH_MESSAGES = 200
+MAX_CLIENT_LAG = 500
+SLOW_CLIENT_TIMEOUT = 10.0
+FRAME_CACHE_SIZE = 64
+
+# Frames per second a client gets unless it asks for something else; messages
+# arriving between frames are coalesced into the next one
+DEFAULT_MAX_RATE = 10.0
+MIN_MAX_RATE = 0.1
+MAX_MAX_RATE = 100.0
+MATCH_CACHE_SIZE = 10000
+
+# What a client receives: its topic filters, and whether messages carry parsedData.
+# Clients with the same subscription share the same matching results and frames.
+Subscription = namedtuple('Subscription', ['filters', 'includeParsed'])
+DEFAULT_SUBSCRIPTION = Subscription(frozenset(['#']), True)
+
+class StreamEntry:
+    __slots__ = ('message', 'encoded', 'compact', 'subscriptions')
+
+    def __init__(self, message, encoded, compact=None):
+        self.message = message
+        self.encoded = encoded
+        self.compact = compact
+        self.subscriptions = None
+
+    def text(self, includeParsed=True):
+        if includeParsed:
+            return self.encoded
+        if self.compact is None:
+            if 'parsedData' in self.message:
+                self.compact = json.dumps({key: value for key, value in self.message.items() if key != 'parsedData'})
+            else:
+                self.compact = self.encoded
+        return self.compact
+
+class MessageStream:
+    """Bounded ring of recent messages, each tagged with a sequence number.
+
+    Producer threads hand messages to the event loop with call_soon_threadsafe;
+    a burst is coalesced into a single callback. Every subscriber keeps its own
+    cursor (the last sequence number it has seen), so all of them see every
+    message while memory stays bounded by the ring size. A subscriber that falls
+    more than a ring behind skips ahead and is told how many messages it missed.
+
+    Messages are JSON-encoded once, by the producer, and batch frames are cached
+    by sequence range, so clients at the same position get the same string.
+    Each message is matched against the subscribers' topic filters once, through
+    a topic trie, when it enters the ring.
+    """
+
+    def __init__(self, capacity=MESSAGE_BUFFER_SIZE):
+        self.capacity = capacity
+        self.messages = deque(maxlen=capacity)
+        self.lastSeq = 0
+        self.loop = None
+        self.changed = None
+
+        # Handoff from producer threads, drained on the loop
+        self.lock = threading.Lock()
+        self.incoming = deque(maxlen=capacity)
+        self.drainScheduled = False
+        self.dropped = 0
+
+        self.frames = OrderedDict()
+
+        self.filters = TopicTrie()
+        self.subscriptionRefs = {}
+        self.matchCache = {}
+
+    def bind(self, loop):
+        if self.loop is None:
+            self.loop = loop
+            self.changed = asyncio.Event()
+
+    def publish(self, message: dict):
+        """Add a message from any thread"""
+        self.publishEntry(StreamEntry(message, json.dumps(message)))
+
+    def publishEncoded(self, topic, encoded, compact):
+        """Add a message that was JSON-encoded elsewhere (with and without parsedData)"""
+        self.publishEntry(StreamEntry({"topic": topic}, encoded, compact))
+
+    def publishEntry(self, entry):
+        with self.lock:
+            if len(self.incoming) == self.capacity:
+                self.dropped += 1
+            self.incoming.append(entry)
+            schedule = not self.drainScheduled and self.loop is not None
+            if schedule:
+                self.drainScheduled = True
+
+        if schedule:
+            try:
+                self.loop.call_soon_threadsafe(self.drain)
+            except RuntimeError:
+                # Loop already closed during shutdown
+                pass
+
+    def drain(self):
+        with self.lock:
+            incoming = self.incoming
+            self.incoming = deque(maxlen=self.capacity)
+            self.drainScheduled = False
+        self.append(incoming)
+
+    def append(self, entries):
+        for entry in entries:
+            entry.subscriptions = self.matchSubscriptions(entry.message.get("topic"))
+            self.lastSeq += 1
+            self.messages.append(entry)
+
+        if entries and self.changed is not None:
+            # Wake every waiting subscriber, then arm a fresh event for the next batch
+            changed = self.changed
+            self.changed = asyncio.Event()
+            changed.set()
+
+    def matchSubscriptions(self, topic):
+        if topic is None:
+            return frozenset()
+        matched = self.matchCache.get(topic)
+        if matched is None:
+            matched = frozenset(self.filters.match(topic))
+            if len(self.matchCache) >= MATCH_CACHE_SIZE:
+                self.matchCache.clear()
+            self.matchCache[topic] = matched
+        return matched
+
+    def addSubscription(self, subscription):
+        refs = self.subscriptionRefs.get(subscription, 0)
+        if refs == 0:
+            for topicFilter in subscription.filters:
+                self.filters.add(topicFilter, subscription)
+            self.matchCache.clear()
+        self.subscriptionRefs[subscription] = refs + 1
+
+    def removeSubscription(self, subscription):
+        refs = self.subscriptionRefs.get(subscription, 0) - 1
+        if refs > 0:
+            self.subscriptionRefs[subscription] = refs
+            return
+        self.subscriptionRefs.pop(subscription, None)
+        for topicFilter in subscription.filters:
+            self.filters.remove(topicFilter, subscription)
+        self.matchCache.clear()
+
+    def head(self):
+        return self.lastSeq
+
+    def read(self, cursor, maxCount=None):
+        """Entries after cursor -> (entries, newCursor, missedCount)"""
+        if self.loop is None:
+            # No loop yet: nothing is being drained, so read what producers left behind
+            with self.lock:
+                pending = list(self.incoming)
+                self.incoming.clear()
+            self.append(pending)
+
+        firstSeq = self.lastSeq - len(self.messages) + 1
+        missed = 0
+        if cursor < firstSeq - 1:
+            missed = firstSeq - 1 - cursor
+            cursor = firstSeq - 1
+
+        available = self.lastSeq - cursor
+        count = available if maxCount is None else min(available, maxCount)
+        offset = cursor - (firstSeq - 1)
+        entries = list(islice(self.messages, offset, offset + count))
+        return entries, cursor + len(entries), missed
+
+    def select(self, cursor, maxCount, subscription):
+        """Up to maxCount entries after cursor for this subscription, and the cursor
+        just past the last entry examined"""
+        entries, newCursor, missed = self.read(cursor)
+        selected = []
+        position = newCursor - len(entries)
+        for entry in entries:
+            if len(selected) == maxCount:
+                break
+            position += 1
+            if subscription in entry.subscriptions:
+                selected.append(entry)
+        return selected, position, missed
+
+    def batchFrame(self, cursor, maxCount, subscription):
+        """JSON text of one batch frame after cursor (None if nothing matches), and
+        the cursor it advances to"""
+        key = (subscription, cursor, self.lastSeq)
+        cached = self.frames.get(key)
+        if cached is not None:
+            return cached
+
+        entries, newCursor, missed = self.select(cursor, maxCount, subscription)
+        frame = None
+        if entries or missed:
+            frame = '{"type": "batch", "missed": %d, "messages": [%s]}' % (
+                missed, ', '.join(entry.text(subscription.includeParsed) for entry in entries)
+            )
+        self.frames[key] = (frame, newCursor)
+        if len(self.frames) > FRAME_CACHE_SIZE:
+            self.frames.popitem(last=False)
+        return frame, newCursor
+
+    def summaryFrame(self, cursor, head, subscription):
+        """Per-topic counts and latest message for (cursor, head], for lagging clients"""
+        entries, _, _ = self.read(cursor, head - cursor)
+        topics = {}
+        latest = {}
+        for entry in entries:
+            if subscription not in entry.subscriptions:
+                continue
+            topic = entry.message.get("topic")
+            topics[topic] = topics.get(topic, 0) + 1
+            latest[topic] = entry.text(subscription.includeParsed)
+        return '{"type": "summary", "skipped": %d, "topics": %s, "latest": [%s]}' % (
+            head - cursor, json.dumps(topics), ', '.join(latest.values())
+        )
+
+    async def wait(self, cursor):
+        """Return once there is something after cursor"""
+        while cursor >= self.lastSeq:
+            await self.changed.wait()
+
+    def getStats(self):
+        return {
+            "capacity": self.capacity,
+            "buffered": len(self.messages),
+            "lastSeq": self.lastSeq,
+            "pendingHandoff": len(self.incoming),
+            "dropped": self.dropped,
+            "subscriptions": len(self.subscriptionRefs),
+            "topicFilters": len(self.filters)
+        }
+
+class ClientSession:
+    """One WebSocket client: a pump that turns stream messages into frames on a
+    bounded per-connection send queue, and a sender that writes them out.
+
+    Clients choose what they receive by sending
+    {"action": "subscribe", "filters": ["codePower/sensors/#"], "maxRate": 5, "parsedData": false};
+    without one they get every topic at DEFAULT_MAX_RATE frames per second.
+
+    A client that stays more than MAX_CLIENT_LAG messages behind the live edge
+    is switched to summary frames (per-topic counts and latest message for the
+    skipped range) until it catches up. One that cannot take a frame for
+    SLOW_CLIENT_TIMEOUT seconds is disconnected.
+    """
+
+    def __init__(self, stream: MessageStream, websocket: WebSocket):
+        self.stream = stream
+        self.websocket = websocket
+        # New clients start at the live edge
+        self.cursor = stream.head()
+        self.sendQueue = asyncio.Queue(maxsize=SEND_QUEUE_FRAMES)
+        self.subscription = DEFAULT_SUBSCRIPTION
+        self.frameInterval = 1.0 / DEFAULT_MAX_RATE
+        self.lastFrameAt = 0.0
+        self.framesSent = 0
+        self.messagesSent = 0
+        self.summaries = 0
+        self.skipped = 0
+        self.closeReason = None
+        stream.addSubscription(self.subscription)
+
+    async def run(self):
+        tasks = {asyncio.create_task(self.pumpLoop()), asyncio.create_task(self.sendLoop())}
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        for task in done:
+            if isinstance(task.exception(), asyncio.TimeoutError):
+                self.closeReason = "too slow"
+                try:
+                    await self.websocket.close(code=1013)
+                except Exception:
+                    pass
+
+    async def pumpLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.stream.wait(self.cursor)
+
+            # Hold the frame until this client's next slot so bursts are coalesced
+            delay = self.lastFrameAt + self.frameInterval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            lag = self.stream.head() - self.cursor
+            if lag > MAX_CLIENT_LAG:
+                head = self.stream.head()
+                frame = self.stream.summaryFrame(self.cursor, head, self.subscription)
+                self.skipped += lag
+                self.summaries += 1
+                SKIPPED.inc(lag)
+                self.cursor = head
+            else:
+                frame, self.cursor = self.stream.batchFrame(self.cursor, MAX_BATCH_MESSAGES, self.subscription)
+                if frame is not None:
+                    self.messagesSent += frame.count('"type": "new_message"')
+
+            if frame is not None:
+                self.lastFrameAt = loop.time()
+                await asyncio.wait_for(self.sendQueue.put((frame, self.lastFrameAt)), SLOW_CLIENT_TIMEOUT)
+
+    async def sendLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            frame, builtAt = await self.sendQueue.get()
+            await self.websocket.send_text(frame)
+            self.framesSent += 1
+            # From the frame being built to the client's socket taking it
+            SEND_LAG_SECONDS.observe(loop.time() - builtAt)
+
+    def handleMessage(self, text):
+        """Apply a control message from the client; returns the reply frame, if any"""
+        try:
+            request = json.loads(text)
+        except ValueError:
+            # Plain keep-alive text
+            return None
+        if not isinstance(request, dict) or request.get("action") != "subscribe":
+            return None
+
+        try:
+            filters = request.get("filters") or ['#']
+            if isinstance(filters, str):
+                filters = [filters]
+            filters = frozenset(validateFilter(str(topicFilter)) for topicFilter in filters)
+            maxRate = float(request.get("maxRate", DEFAULT_MAX_RATE))
+        except (TypeError, ValueError) as e:
+            return json.dumps({"type": "error", "message": str(e)})
+
+        maxRate = min(max(maxRate, MIN_MAX_RATE), MAX_MAX_RATE)
+        subscription = Subscription(filters, bool(request.get("parsedData", True)))
+        if subscription != self.subscription:
+            self.stream.addSubscription(subscription)
+            self.stream.removeSubscription(self.subscription)
+            self.subscription = subscription
+            # Matching happens on entry, so start from the live edge with the new filters
+            self.cursor = self.stream.head()
+        self.frameInterval = 1.0 / maxRate
+
+        return json.dumps({
+            "type": "subscribed",
+            "filters": sorted(filters),
+            "maxRate": maxRate,
+            "parsedData": subscription.includeParsed
+        })
+
+    def close(self):
+        self.stream.removeSubscription(self.subscription)
+
+    def getStats(self):
+        return {
+            "filters": sorted(self.subscription.filters),
+            "maxRate": round(1.0 / self.frameInterval, 2),
+            "lag": self.stream.head() - self.cursor,
+            "queuedFrames": self.sendQueue.qsize(),
+            "framesSent": self.framesSent,
+            "messagesSent": self.messagesSent,
+            "summaries": self.summaries,
+            "skipped": self.skipped
+        }
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, stream: MessageStream):
+        self.stream = stream
+        self.active_connections: Dict[WebSocket, ClientSession] = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.stream.bind(asyncio.get_running_loop())
+        self.active_connections[websocket] = ClientSession(self.stream, websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        session = self.active_connections.pop(websocket, None)
+        if session is not None:
+            session.close()
 
-    async def broadcast_message(self, message: dict):
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except:
-                disconnected.append(connection)
-        
-        for connection in disconnected:
-            self.disconnect(connection)
+    async def streamTo(self, websocket: WebSocket):
+        """Deliver the stream to one client; each client runs independently of the others"""
+        session = self.active_connections.get(websocket)
+        if session is not None:
+            await session.run()
+
+    async def handleClientMessage(self, websocket: WebSocket, text: str):
+        session = self.active_connections.get(websocket)
+        if session is None:
+            return
+        reply = session.handleMessage(text)
+        if reply is not None:
+            await session.sendQueue.put((reply, asyncio.get_running_loop().time()))
+
+    def getStats(self):
+        return [session.getStats() for session in self.active_connections.values()]
 
-# Global instance
-manager = ConnectionManager()
+# Global instances
+messageStream = MessageStream()
+manager = ConnectionManager(messageStream)
 
-# Message queue for MQTT messages
-messageQueue = []
+SEND_LAG_SECONDS = histogram('historian_websocket_send_lag_seconds', 'Time from a frame being built to it being sent')
+gauge('historian_websocket_clients', 'Connected WebSocket clients', lambda: len(manager.active_connections))
+gauge('historian_websocket_client_lag_messages', 'Messages each WebSocket client is behind the live edge',
+      lambda: {(str(index),): session.stream.head() - session.cursor
+               for index, session in enumerate(list(manager.active_connections.values()))}, ('client',))
+SKIPPED = counter('historian_websocket_skipped_total', 'Messages replaced by summary frames for slow clients')
+callbackCounter('historian_stream_dropped_total', 'Messages dropped before reaching the stream ring', lambda: messageStream.dropped)
+gauge('historian_stream_pending_handoff', 'Messages waiting to be moved onto the event loop', lambda: len(messageStream.incoming))
 
 def addMessageToQueue(message: dict):
-    """Add message to queue from MQTT thread"""
-    messageQueue.append(message)
-
-def getQueuedMessages():
-    """Get all queued messages and clear the queue"""
-    messages = messageQueue.copy()
-    messageQueue.clear()
-    return messages
-
-async def processQueuedMessages():
-    """Process queued messages and broadcast via WebSocket"""
-    messages = getQueuedMessages()
-    for message in messages:
-        await manager.broadcast_message(message)
\ No newline at end of file
+    """Add message to the stream from the MQTT side"""
+    messageStream.publish(message)
+
+def getQueuedMessages(cursor=None):
+    """JSON text of the messages after the caller's cursor, for polling clients.
+
+    Without a cursor the caller starts at the live edge and gets only the cursor back.
+    A cursor ahead of the stream was kept across a server restart, which starts
+    sequence numbers again at 0: the caller is moved to the live edge, and
+    everything published since the restart is reported as missed.
+    """
+    if cursor is None:
+        cursor = messageStream.head()
+        entries, missed = [], 0
+    elif cursor > messageStream.head():
+        cursor = messageStream.head()
+        entries, missed = [], cursor
+    else:
+        entries, cursor, missed = messageStream.read(cursor)
+    return '{"messages": [%s], "cursor": %d, "missed": %d}' % (
+        ', '.join(entry.encoded for entry in entries), cursor, missed
+    )
+
+def getStreamStats():
+    return {
+        **messageStream.getStats(),
+        "websocketClients": len(manager.active_connections),
+        "clients": manager.getStats()
+    }
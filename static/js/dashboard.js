@@ -3,6 +3,7 @@ class Dashboard {
         this.baseUrl = window.location.origin;
         this.ws = null;
         this.messageCount = 0;
+        this.pollCursor = null;
         this.init();
     }
 
@@ -12,7 +13,7 @@ class Dashboard {
         this.loadSensors();
         this.initWebSocket();
 
-        // Poll for queued messages every second
+        // Poll for queued messages every second while the WebSocket is down
         setInterval(() => {
             this.pollForNewMessages();
         }, 1000);
@@ -54,11 +55,18 @@ class Dashboard {
         };
     }
 
-    // ADD THIS NEW METHOD
     async pollForNewMessages() {
+        // Every client sees every message on each channel, so only poll as a fallback
+        if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+            this.pollCursor = null;
+            return;
+        }
+
         try {
-            const response = await fetch(`${this.baseUrl}/api/queued-messages`);
+            const query = this.pollCursor === null ? '' : `?cursor=${this.pollCursor}`;
+            const response = await fetch(`${this.baseUrl}/api/queued-messages${query}`);
             const data = await response.json();
+            this.pollCursor = data.cursor;
 
             if (data.messages && data.messages.length > 0) {
                 data.messages.forEach(message => {
@@ -79,7 +87,12 @@ class Dashboard {
     }
 
     handleRealTimeUpdate(data) {
-        if (data.type === 'new_message') {
+        if (data.type === 'batch') {
+            data.messages.forEach(message => this.handleRealTimeUpdate(message));
+        } else if (data.type === 'summary') {
+            // Server skipped ahead because this client fell behind: show the latest per topic
+            data.latest.forEach(message => this.handleRealTimeUpdate(message));
+        } else if (data.type === 'new_message') {
             this.addNewMessage(data);
             this.updateStats();
             this.checkForSensorData(data);